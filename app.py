@@ -3,7 +3,7 @@ Meru Deliveries - Flask Application
 A food delivery web application with Flask backend and PyMySQL database connection.
 """
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response, stream_with_context
 from flask_mail import Mail, Message
 import pymysql
 from functools import wraps
@@ -16,6 +16,17 @@ from werkzeug.utils import secure_filename
 import uuid
 import requests
 import base64
+import concurrent.futures
+import queue
+import math
+import bisect
+import threading
+import collections
+import hashlib
+import pickle
+import time as time_module
+import numpy as np
+from PIL import Image, ImageOps, features
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Change this to a secure secret key in production
@@ -43,8 +54,10 @@ MPESA_ENVIRONMENT = os.getenv('MPESA_ENVIRONMENT', 'sandbox')  # 'sandbox' or 'p
 MPESA_SANDBOX_PAYBILL = '174379'  # Test Paybill number for sandbox
 MPESA_SANDBOX_TILL = '174379'     # Test Till number for sandbox
 
-# M-Pesa API URLs
-if MPESA_ENVIRONMENT == 'production':
+# M-Pesa API URLs (MPESA_BASE_URL can point at a local stub server for testing)
+if os.getenv('MPESA_BASE_URL'):
+    MPESA_BASE_URL = os.getenv('MPESA_BASE_URL').rstrip('/')
+elif MPESA_ENVIRONMENT == 'production':
     MPESA_BASE_URL = 'https://api.safaricom.co.ke'
 else:
     MPESA_BASE_URL = 'https://sandbox.safaricom.co.ke'
@@ -75,9 +88,257 @@ DB_CONFIG = {
 
 DATABASE_NAME = 'MERU_DELIVERIES'
 
+# Connection pool configuration (per process - size max_size against gunicorn workers x MySQL max_connections)
+DB_POOL_CONFIG = {
+    'enabled': os.getenv('DB_POOL_ENABLED', 'true').lower() == 'true',
+    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+    'checkout_timeout': float(os.getenv('DB_POOL_TIMEOUT', '5')),  # Seconds to wait for a free connection
+    'idle_timeout': float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300')),  # Close connections idle longer than this
+    'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),  # Recycle connections older than this
+    'ping_on_borrow': os.getenv('DB_POOL_PING', 'true').lower() == 'true'
+}
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes available within the checkout timeout."""
+
+class PooledConnection:
+    """Proxy for a pooled pymysql connection; close() returns it to the pool instead of disconnecting."""
+    
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+        self._raw = entry['connection']
+    
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+    
+    def close(self):
+        """Return the connection to the pool (safe to call more than once)."""
+        if self._entry is not None:
+            entry = self._entry
+            self._entry = None
+            self._pool.release(entry)
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of MySQL connections with health checks and recycling."""
+    
+    def __init__(self, min_size=2, max_size=10, checkout_timeout=5, idle_timeout=300,
+                 max_lifetime=3600, ping_on_borrow=True):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size)
+        self.checkout_timeout = checkout_timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_on_borrow = ping_on_borrow
+        self.pid = os.getpid()
+        self._idle = collections.deque()  # Most recently used on the right
+        self._size = 0  # Open connections (idle + checked out)
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'wait_time_ms': 0.0,
+            'created': 0,
+            'closed': 0,
+            'ping_failures': 0
+        }
+    
+    def _connect(self):
+        config = DB_CONFIG.copy()
+        if config['database'] is None:
+            config['database'] = DATABASE_NAME
+        connection = pymysql.connect(**config)
+        now = time_module.monotonic()
+        return {'connection': connection, 'created_at': now, 'last_used': now}
+    
+    def _is_stale(self, entry, now):
+        if self.max_lifetime and now - entry['created_at'] > self.max_lifetime:
+            return True
+        return bool(self.idle_timeout) and now - entry['last_used'] > self.idle_timeout
+    
+    def _close_quietly(self, entry):
+        try:
+            entry['connection'].close()
+        except Exception:
+            pass
+    
+    def _discard(self, entry):
+        """Close a connection that is leaving the pool. Caller must not hold the lock."""
+        self._close_quietly(entry)
+        with self._cond:
+            self._size -= 1
+            self._stats['closed'] += 1
+            self._cond.notify()
+    
+    def acquire(self):
+        """Borrow a connection, waiting up to checkout_timeout when the pool is exhausted."""
+        started = time_module.monotonic()
+        deadline = started + self.checkout_timeout
+        waited = False
+        while True:
+            entry = None
+            create = False
+            stale = []
+            with self._cond:
+                while True:
+                    now = time_module.monotonic()
+                    while self._idle:
+                        candidate = self._idle.pop()
+                        if self._is_stale(candidate, now):
+                            # Free the slot now so this checkout can open a replacement
+                            self._size -= 1
+                            self._stats['closed'] += 1
+                            stale.append(candidate)
+                            continue
+                        entry = candidate
+                        break
+                    if entry is not None:
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        break
+                    if not waited:
+                        waited = True
+                        self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+            for old_entry in stale:
+                self._close_quietly(old_entry)
+            
+            if create:
+                try:
+                    entry = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats['created'] += 1
+            elif entry is None:
+                raise PoolTimeoutError(f"No database connection available after {self.checkout_timeout}s")
+            elif self.ping_on_borrow:
+                try:
+                    entry['connection'].ping(reconnect=False)
+                except Exception:
+                    with self._cond:
+                        self._stats['ping_failures'] += 1
+                    self._discard(entry)
+                    continue
+            
+            with self._cond:
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['wait_time_ms'] += (time_module.monotonic() - started) * 1000
+            return PooledConnection(self, entry)
+    
+    def release(self, entry):
+        """Return a borrowed connection, ending any open transaction first."""
+        if os.getpid() != self.pid:
+            return  # Inherited across fork - never reuse or close the parent's socket
+        try:
+            # Roll back so the next borrower never inherits an open transaction or stale snapshot
+            entry['connection'].rollback()
+        except Exception:
+            self._discard(entry)
+            return
+        now = time_module.monotonic()
+        if self.max_lifetime and now - entry['created_at'] > self.max_lifetime:
+            self._discard(entry)
+            return
+        entry['last_used'] = now
+        evicted = []
+        with self._cond:
+            self._idle.append(entry)
+            # Least recently used connections sit on the left - trim them down to min_size
+            while (self._idle and self._size - len(evicted) > self.min_size
+                   and now - self._idle[0]['last_used'] > self.idle_timeout):
+                evicted.append(self._idle.popleft())
+            self._cond.notify()
+        for old_entry in evicted:
+            self._discard(old_entry)
+    
+    def warm_up(self):
+        """Open connections until min_size are idle in the pool."""
+        opened = []
+        try:
+            while len(opened) < self.min_size:
+                with self._cond:
+                    if self._size >= self.min_size:
+                        break
+                    self._size += 1
+                try:
+                    opened.append(self._connect())
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                    raise
+                with self._cond:
+                    self._stats['created'] += 1
+        finally:
+            with self._cond:
+                self._idle.extend(opened)
+                self._cond.notify_all()
+    
+    def close_all(self):
+        """Close every idle connection (checked-out connections close when released)."""
+        with self._cond:
+            entries = list(self._idle)
+            self._idle.clear()
+        for entry in entries:
+            self._discard(entry)
+    
+    def get_stats(self):
+        """Return a snapshot of pool sizing and usage counters."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['wait_time_ms'] = round(stats['wait_time_ms'], 2)
+            stats.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'pid': self.pid
+            })
+            return stats
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Return this process's connection pool, creating it on first use (and again after a fork)."""
+    global db_pool
+    pool = db_pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with db_pool_lock:
+        if db_pool is None or db_pool.pid != os.getpid():
+            db_pool = ConnectionPool(
+                min_size=DB_POOL_CONFIG['min_size'],
+                max_size=DB_POOL_CONFIG['max_size'],
+                checkout_timeout=DB_POOL_CONFIG['checkout_timeout'],
+                idle_timeout=DB_POOL_CONFIG['idle_timeout'],
+                max_lifetime=DB_POOL_CONFIG['max_lifetime'],
+                ping_on_borrow=DB_POOL_CONFIG['ping_on_borrow']
+            )
+        return db_pool
+
 def get_db_connection(use_database=True):
-    """Create and return a database connection."""
+    """Return a database connection (pooled when using the application database).
+    
+    Callers keep calling connection.close(); for pooled connections that hands
+    the connection back to the pool instead of tearing down the socket.
+    """
     try:
+        if use_database and DB_POOL_CONFIG['enabled']:
+            return get_db_pool().acquire()
         config = DB_CONFIG.copy()
         if not use_database:
             config['database'] = None
@@ -85,6 +346,9 @@ def get_db_connection(use_database=True):
             config['database'] = DATABASE_NAME
         connection = pymysql.connect(**config)
         return connection
+    except PoolTimeoutError as e:
+        print(f"Database pool exhausted: {e}")
+        return None
     except Exception as e:
         print(f"Database connection error: {e}")
         return None
@@ -170,6 +434,89 @@ def column_exists(table_name, column_name):
     columns = get_table_columns(table_name)
     return column_name in columns
 
+# ==================== SCHEMA CAPABILITIES ====================
+# Request handlers read column availability from this process-wide snapshot instead
+# of running DESCRIBE on every request. It is loaded once after init_db (or lazily on
+# first use) and dropped whenever a migration is recorded so the next read reloads it.
+
+class TableCapabilities:
+    """Snapshot of one table's columns.
+    
+    Attribute lookups answer from the snapshot, e.g. orders.has_status or
+    order_items.item_id_nullable.
+    """
+    
+    def __init__(self, table_name, columns=(), nullable_columns=()):
+        self.table_name = table_name
+        self.columns = frozenset(columns)
+        self.nullable_columns = frozenset(nullable_columns)
+    
+    def has(self, column_name):
+        return column_name in self.columns
+    
+    def __getattr__(self, name):
+        if name.startswith('has_'):
+            return name[4:] in self.columns
+        if name.endswith('_nullable'):
+            return name[:-len('_nullable')] in self.nullable_columns
+        raise AttributeError(name)
+
+schema_capabilities = None
+schema_capabilities_lock = threading.Lock()
+
+def load_schema_capabilities():
+    """Read every table's columns with a single information_schema query."""
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name, IS_NULLABLE AS is_nullable
+                FROM information_schema.columns
+                WHERE table_schema = %s
+            """, (DATABASE_NAME,))
+            rows = cursor.fetchall()
+        columns = {}
+        nullable = {}
+        for row in rows:
+            table_name = row['table_name']
+            columns.setdefault(table_name, []).append(row['column_name'])
+            if row['is_nullable'] == 'YES':
+                nullable.setdefault(table_name, []).append(row['column_name'])
+        return {
+            table_name: TableCapabilities(table_name, table_columns, nullable.get(table_name, ()))
+            for table_name, table_columns in columns.items()
+        }
+    except Exception as e:
+        print(f"Error loading schema capabilities: {e}")
+        return None
+    finally:
+        connection.close()
+
+def refresh_schema_capabilities():
+    """Rebuild the schema snapshot and swap it in."""
+    global schema_capabilities
+    snapshot = load_schema_capabilities()
+    if snapshot is not None:
+        schema_capabilities = snapshot
+    return snapshot
+
+def invalidate_schema_capabilities():
+    """Drop the snapshot so the next lookup reloads it (call after any DDL)."""
+    global schema_capabilities
+    schema_capabilities = None
+
+def get_schema_capabilities(table_name):
+    """Return the TableCapabilities for a table, loading the snapshot on first use."""
+    snapshot = schema_capabilities
+    if snapshot is None:
+        with schema_capabilities_lock:
+            snapshot = schema_capabilities
+            if snapshot is None:
+                snapshot = refresh_schema_capabilities() or {}
+    return snapshot.get(table_name) or TableCapabilities(table_name)
+
 def add_missing_columns():
     """Add missing columns to existing tables."""
     connection = get_db_connection()
@@ -388,10 +735,12 @@ def add_missing_columns():
                     'order_type': "ALTER TABLE orders ADD COLUMN order_type VARCHAR(50)",
                     'status': "ALTER TABLE orders ADD COLUMN status ENUM('pending', 'confirmed', 'preparing', 'ready', 'out_for_delivery', 'delivered', 'cancelled', 'PACKED', 'PROCESSING', 'PENDING') DEFAULT 'pending'",
                     'total_amount': "ALTER TABLE orders ADD COLUMN total_amount DECIMAL(10, 2) DEFAULT 0.00",
+                    'order_number': "ALTER TABLE orders ADD COLUMN order_number VARCHAR(50) UNIQUE",
                 'cancellation_reason': "ALTER TABLE orders ADD COLUMN cancellation_reason VARCHAR(255) DEFAULT NULL",
                 'pickup_code': "ALTER TABLE orders ADD COLUMN pickup_code VARCHAR(4) DEFAULT NULL",
                 'rider_name': "ALTER TABLE orders ADD COLUMN rider_name VARCHAR(100) DEFAULT NULL",
                 'rider_phone': "ALTER TABLE orders ADD COLUMN rider_phone VARCHAR(20) DEFAULT NULL",
+                'version': "ALTER TABLE orders ADD COLUMN version INT NOT NULL DEFAULT 0",
                 'drop_order_status': "ALTER TABLE orders DROP COLUMN IF EXISTS order_status"
                 }
                 
@@ -433,6 +782,61 @@ def add_missing_columns():
                             if 'duplicate' not in error_msg:
                                 print(f"Error adding column '{col_name}': {e}")
             
+            # The shop order feed pages on (shop_id, created_at, id); InnoDB appends id itself
+            if table_exists('orders'):
+                try:
+                    cursor.execute("SHOW INDEX FROM orders WHERE Key_name = 'idx_shop_created_at'")
+                    if not cursor.fetchone():
+                        cursor.execute("CREATE INDEX idx_shop_created_at ON orders(shop_id, created_at)")
+                        connection.commit()
+                        print("Added index idx_shop_created_at to orders table.")
+                except Exception as e:
+                    print(f"Error adding index idx_shop_created_at: {e}")
+            
+            # The dashboard changes feed scans orders by (shop_id, updated_at, id)
+            if table_exists('orders'):
+                try:
+                    cursor.execute("SHOW INDEX FROM orders WHERE Key_name = 'idx_shop_updated_at'")
+                    if not cursor.fetchone():
+                        cursor.execute("CREATE INDEX idx_shop_updated_at ON orders(shop_id, updated_at)")
+                        connection.commit()
+                        print("Added index idx_shop_updated_at to orders table.")
+                except Exception as e:
+                    print(f"Error adding index idx_shop_updated_at: {e}")
+            
+            # Shop page ETags read MAX(updated_at) and COUNT(*) of a shop's items
+            if table_exists('shop_items'):
+                try:
+                    cursor.execute("SHOW INDEX FROM shop_items WHERE Key_name = 'idx_shop_updated_at'")
+                    if not cursor.fetchone():
+                        cursor.execute("CREATE INDEX idx_shop_updated_at ON shop_items(shop_id, updated_at)")
+                        connection.commit()
+                        print("Added index idx_shop_updated_at to shop_items table.")
+                except Exception as e:
+                    print(f"Error adding index idx_shop_updated_at: {e}")
+            
+            # The customer search index catches up on edits by customers.updated_at
+            if table_exists('customers'):
+                try:
+                    cursor.execute("SHOW INDEX FROM customers WHERE Key_name = 'idx_updated_at'")
+                    if not cursor.fetchone():
+                        cursor.execute("CREATE INDEX idx_updated_at ON customers(updated_at)")
+                        connection.commit()
+                        print("Added index idx_updated_at to customers table.")
+                except Exception as e:
+                    print(f"Error adding index idx_updated_at: {e}")
+            
+            # Index receipt numbers so repeated M-Pesa callbacks can be detected cheaply
+            if table_exists('stk_push_requests'):
+                try:
+                    cursor.execute("SHOW INDEX FROM stk_push_requests WHERE Key_name = 'idx_mpesa_receipt_number'")
+                    if not cursor.fetchone():
+                        cursor.execute("CREATE INDEX idx_mpesa_receipt_number ON stk_push_requests(mpesa_receipt_number)")
+                        connection.commit()
+                        print("Added index idx_mpesa_receipt_number to stk_push_requests table.")
+                except Exception as e:
+                    print(f"Error adding index idx_mpesa_receipt_number: {e}")
+            
             # Check and modify order_items table to make item_id nullable for package deliveries
             if table_exists('order_items'):
                 try:
@@ -515,6 +919,7 @@ def record_migration(migration_name, description=""):
             """, (migration_name, description))
             connection.commit()
             print(f"Migration '{migration_name}' recorded successfully.")
+            invalidate_schema_capabilities()
             return True
     except Exception as e:
         print(f"Error recording migration: {e}")
@@ -606,6 +1011,16 @@ def init_tables():
                         INDEX idx_shop_id (shop_id)
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                 """,
+                'shop_daily_order_counts': """
+                    CREATE TABLE IF NOT EXISTS shop_daily_order_counts (
+                        shop_id INT NOT NULL,
+                        order_date DATE NOT NULL,
+                        order_count INT NOT NULL DEFAULT 0,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        PRIMARY KEY (shop_id, order_date),
+                        FOREIGN KEY (shop_id) REFERENCES shops(id) ON DELETE CASCADE
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """,
                 'shop_peak_hours': """
                     CREATE TABLE IF NOT EXISTS shop_peak_hours (
                         id INT AUTO_INCREMENT PRIMARY KEY,
@@ -662,6 +1077,65 @@ def init_tables():
                         INDEX idx_shop_id (shop_id)
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                 """,
+                'stk_push_jobs': """
+                    CREATE TABLE IF NOT EXISTS stk_push_jobs (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        order_id INT NOT NULL,
+                        phone_number VARCHAR(20) NOT NULL,
+                        amount DECIMAL(10, 2) NOT NULL,
+                        shortcode VARCHAR(20) NOT NULL,
+                        transaction_type VARCHAR(40) NOT NULL,
+                        account_reference VARCHAR(50),
+                        transaction_desc VARCHAR(100),
+                        callback_url VARCHAR(255) NOT NULL,
+                        status ENUM('queued', 'processing', 'submitted', 'failed') DEFAULT 'queued',
+                        attempts INT NOT NULL DEFAULT 0,
+                        run_after DATETIME NOT NULL,
+                        locked_at DATETIME NULL,
+                        checkout_request_id VARCHAR(100),
+                        error_message TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                        INDEX idx_order_id (order_id),
+                        INDEX idx_status_run_after (status, run_after),
+                        FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """,
+                'order_number_workers': """
+                    CREATE TABLE IF NOT EXISTS order_number_workers (
+                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        hostname VARCHAR(100),
+                        pid INT,
+                        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """,
+                'app_events': """
+                    CREATE TABLE IF NOT EXISTS app_events (
+                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        channel VARCHAR(100) NOT NULL,
+                        payload MEDIUMTEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        INDEX idx_created_at (created_at)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """,
+                'mpesa_callback_inbox': """
+                    CREATE TABLE IF NOT EXISTS mpesa_callback_inbox (
+                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                        checkout_request_id VARCHAR(100),
+                        mpesa_receipt_number VARCHAR(50),
+                        payload MEDIUMTEXT NOT NULL,
+                        status ENUM('pending', 'processing', 'processed', 'duplicate', 'unmatched', 'failed') DEFAULT 'pending',
+                        attempts INT NOT NULL DEFAULT 0,
+                        next_attempt_at DATETIME NOT NULL,
+                        locked_at DATETIME NULL,
+                        error_message TEXT,
+                        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        processed_at DATETIME NULL,
+                        INDEX idx_status_next_attempt (status, next_attempt_at),
+                        INDEX idx_checkout_request_id (checkout_request_id),
+                        INDEX idx_mpesa_receipt_number (mpesa_receipt_number)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """,
                 'stk_push_requests': """
                     CREATE TABLE IF NOT EXISTS stk_push_requests (
                         id INT AUTO_INCREMENT PRIMARY KEY,
@@ -679,6 +1153,7 @@ def init_tables():
                         INDEX idx_order_id (order_id),
                         INDEX idx_checkout_request_id (checkout_request_id),
                         INDEX idx_status (status),
+                        INDEX idx_mpesa_receipt_number (mpesa_receipt_number),
                         FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                 """,
@@ -691,7 +1166,8 @@ def init_tables():
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
                         INDEX idx_phone (phone),
-                        INDEX idx_email (email)
+                        INDEX idx_email (email),
+                        INDEX idx_updated_at (updated_at)
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                 """,
                 'employees': """
@@ -767,6 +1243,8 @@ def init_tables():
                         INDEX idx_customer_phone (customer_phone),
                         INDEX idx_payment_status (payment_status),
                         INDEX idx_created_at (created_at),
+                        INDEX idx_shop_created_at (shop_id, created_at),
+                        INDEX idx_shop_updated_at (shop_id, updated_at),
                         FOREIGN KEY (shop_id) REFERENCES shops(id) ON DELETE CASCADE
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                 """,
@@ -884,6 +1362,9 @@ def init_db():
         print("Failed to initialize tables.")
         return False
     
+    # Step 5: Snapshot table columns for request handlers
+    refresh_schema_capabilities()
+    
     print("=" * 50)
     print("Database initialization completed successfully!")
     print("=" * 50)
@@ -903,7 +1384,10 @@ def save_uploaded_file(file, subfolder):
         os.makedirs(folder_path, exist_ok=True)
         filepath = os.path.join(folder_path, unique_filename)
         file.save(filepath)
-        return f"{subfolder}/{unique_filename}"
+        saved_path = f"{subfolder}/{unique_filename}"
+        if is_image_path(unique_filename):
+            process_uploaded_image(saved_path, make_variants=subfolder in IMAGE_VARIANT_FOLDERS)
+        return saved_path
     return None
 
 def save_multiple_files(files, subfolder):
@@ -911,16 +1395,236 @@ def save_multiple_files(files, subfolder):
     saved_files = []
     if files:
         for file in files:
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4()}_{filename}"
-                folder_path = os.path.join(app.config['UPLOAD_FOLDER'], subfolder)
-                os.makedirs(folder_path, exist_ok=True)
-                filepath = os.path.join(folder_path, unique_filename)
-                file.save(filepath)
-                saved_files.append(f"{subfolder}/{unique_filename}")
+            if file and file.filename:
+                saved_path = save_uploaded_file(file, subfolder)
+                if saved_path:
+                    saved_files.append(saved_path)
     return saved_files
 
+# ==================== IMAGE DERIVATIVES ====================
+# Uploads arrive straight from phone cameras (often 4000px, several MB, with
+# EXIF location data). After saving, images are capped to IMAGE_MAX_DIMENSION
+# with EXIF stripped, and fixed-size variants are written next to them
+# (items/thumb/<name>.webp, items/medium/<name>.webp). Pages pick the variant
+# through the image_variant template filter and fall back to the original.
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', '2048'))
+IMAGE_VARIANTS = {
+    'thumb': int(os.getenv('IMAGE_THUMB_SIZE', '320')),
+    'medium': int(os.getenv('IMAGE_MEDIUM_SIZE', '960')),
+}
+IMAGE_VARIANT_FOLDERS = {'profiles', 'items'}  # documents stay untouched
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '80'))
+IMAGE_DERIVATIVE_FORMAT = os.getenv('IMAGE_DERIVATIVE_FORMAT', 'webp').lower()
+if IMAGE_DERIVATIVE_FORMAT == 'webp' and not features.check('webp'):
+    print("Warning: Pillow was built without WebP support, image derivatives will be JPEG")
+    IMAGE_DERIVATIVE_FORMAT = 'jpeg'
+IMAGE_DERIVATIVE_EXTENSION = 'webp' if IMAGE_DERIVATIVE_FORMAT == 'webp' else 'jpg'
+IMAGE_BACKFILL_ENABLED = os.getenv('IMAGE_BACKFILL_ENABLED', 'true').lower() == 'true'
+IMAGE_BACKFILL_MARKER = os.getenv('IMAGE_BACKFILL_MARKER', 'instance/image_backfill_done')
+
+def is_image_path(path):
+    return '.' in path and path.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+def image_variant_path(path, variant):
+    """Map 'items/abc.jpg' to 'items/thumb/abc.webp' (relative to UPLOAD_FOLDER)."""
+    folder, _, filename = path.rpartition('/')
+    stem = filename.rsplit('.', 1)[0]
+    return '/'.join(part for part in (folder, variant, f"{stem}.{IMAGE_DERIVATIVE_EXTENSION}") if part)
+
+def save_image_atomically(image, filepath, **params):
+    """Write to a temp file and rename so readers never see a half-written image."""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    try:
+        image.save(tmp_path, **params)
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def derivative_ready_image(image, image_format):
+    """Convert palette/alpha/CMYK images to a mode the derivative format can store."""
+    if image_format == 'jpeg':
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            return background
+        return image.convert('RGB') if image.mode != 'RGB' else image
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = image.mode in ('LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+        return image.convert('RGBA' if has_alpha else 'RGB')
+    return image
+
+def process_uploaded_image(relative_path, make_variants=True):
+    """Cap size and strip EXIF of a saved upload, then write its variants.
+    
+    Returns True when the image could be processed. Failures leave the
+    original file as uploaded, so pages keep working off it.
+    """
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], relative_path)
+    try:
+        with Image.open(filepath) as image:
+            source_format = image.format
+            animated = getattr(image, 'is_animated', False)
+            # Before draft(), which changes image.size to the reduced decode size
+            oversized = max(image.size) > IMAGE_MAX_DIMENSION
+            # JPEG can decode at 1/2, 1/4 or 1/8 scale, much cheaper than full size
+            image.draft('RGB', (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            has_exif = bool(image.info.get('exif')) or bool(image.getexif())
+            icc_profile = image.info.get('icc_profile')
+            image = ImageOps.exif_transpose(image)
+            image.load()
+        
+        if (has_exif or oversized) and not animated and source_format in ('JPEG', 'PNG', 'WEBP'):
+            image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+            params = {'format': source_format}
+            if icc_profile:
+                params['icc_profile'] = icc_profile
+            if source_format == 'JPEG':
+                params.update(quality=90, optimize=True)
+                original = image.convert('RGB') if image.mode not in ('RGB', 'L') else image
+            elif source_format == 'WEBP':
+                params['quality'] = 90
+                original = image
+            else:
+                params['optimize'] = True
+                original = image
+            save_image_atomically(original, filepath, **params)
+        
+        if make_variants:
+            variant_source = derivative_ready_image(image, IMAGE_DERIVATIVE_FORMAT)
+            params = {'format': IMAGE_DERIVATIVE_FORMAT.upper(), 'quality': IMAGE_QUALITY}
+            if icc_profile:
+                params['icc_profile'] = icc_profile
+            if IMAGE_DERIVATIVE_FORMAT == 'webp':
+                params['method'] = 4
+            else:
+                params.update(optimize=True, progressive=True)
+            for variant, size in IMAGE_VARIANTS.items():
+                derivative = variant_source.copy()
+                derivative.thumbnail((size, size), Image.LANCZOS)
+                derivative_path = os.path.join(app.config['UPLOAD_FOLDER'], image_variant_path(relative_path, variant))
+                save_image_atomically(derivative, derivative_path, **params)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Error processing uploaded image {relative_path}: {e}")
+        return False
+
+image_variant_cache = set()
+
+@app.template_filter('image_variant')
+def image_variant_filter(path, variant='thumb'):
+    """Return the variant of an upload path when it exists, else the path itself.
+    
+    Accepts both 'items/x.jpg' and 'uploads/items/x.jpg' and keeps the prefix.
+    """
+    if not path or variant not in IMAGE_VARIANTS or not is_image_path(path):
+        return path
+    prefix = ''
+    relative_path = path
+    if relative_path.startswith('uploads/'):
+        prefix, relative_path = 'uploads/', relative_path[len('uploads/'):]
+    if relative_path.split('/', 1)[0] not in IMAGE_VARIANT_FOLDERS:
+        return path
+    derivative = image_variant_path(relative_path, variant)
+    if derivative in image_variant_cache:
+        return prefix + derivative
+    if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], derivative)):
+        image_variant_cache.add(derivative)
+        return prefix + derivative
+    return path
+
+def backfill_image_derivatives():
+    """Write missing variants for uploads saved before the pipeline existed."""
+    created = 0
+    for folder in IMAGE_VARIANT_FOLDERS:
+        folder_path = os.path.join(app.config['UPLOAD_FOLDER'], folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for filename in os.listdir(folder_path):
+            relative_path = f"{folder}/{filename}"
+            if not is_image_path(filename) or not os.path.isfile(os.path.join(folder_path, filename)):
+                continue
+            missing = [variant for variant in IMAGE_VARIANTS
+                       if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], image_variant_path(relative_path, variant)))]
+            if missing and process_uploaded_image(relative_path):
+                created += 1
+    return created
+
+def image_backfill_signature():
+    """What the marker file records: redo the pass when variants or format change."""
+    return f"{sorted(IMAGE_VARIANTS.items())} {IMAGE_DERIVATIVE_FORMAT} {IMAGE_MAX_DIMENSION}"
+
+def image_backfill_done():
+    try:
+        with open(IMAGE_BACKFILL_MARKER) as marker:
+            return marker.read() == image_backfill_signature()
+    except OSError:
+        return False
+
+def run_image_backfill():
+    """Run backfill_image_derivatives in one process only, once per variant setup.
+    
+    A MySQL named lock keeps several workers from re-encoding the same files
+    at the same time, and the marker file stops later starts from rescanning.
+    Returns the number of uploads processed, or None when skipped.
+    """
+    if image_backfill_done():
+        return None
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT GET_LOCK('kwetu_image_backfill', 0) AS acquired")
+            if not cursor.fetchone()['acquired']:
+                return None
+            try:
+                # Another process may have finished while we waited for a connection
+                if image_backfill_done():
+                    return None
+                created = backfill_image_derivatives()
+                os.makedirs(os.path.dirname(IMAGE_BACKFILL_MARKER) or '.', exist_ok=True)
+                with open(IMAGE_BACKFILL_MARKER, 'w') as marker:
+                    marker.write(image_backfill_signature())
+                return created
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK('kwetu_image_backfill')")
+    except Exception as e:
+        print(f"Error backfilling image derivatives: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+    finally:
+        connection.close()
+
+class ImageBackfillWorker:
+    """Background thread that calls run_image_backfill once per process."""
+    
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """Start the thread once per process (again after a fork)."""
+        if not IMAGE_BACKFILL_ENABLED or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='image-backfill', daemon=True).start()
+            self.pid = os.getpid()
+    
+    def _run(self):
+        created = run_image_backfill()
+        if created:
+            print(f"Image derivatives: backfilled variants for {created} uploads")
+
+image_backfill_worker = ImageBackfillWorker()
+
 def validate_password(password):
     """Validate password strength (medium to strong)."""
     if len(password) < 8:
@@ -1595,6 +2299,8 @@ def signup_shop():
                 """, (shop_name, category, email, phone, login_code, hashed_password, profile_image, business_document,
                       location_name, longitude, latitude))
                 connection.commit()
+                # New shops are listed on the index as coming soon
+                invalidate_shop_pages()
                 
                 # Send email
                 send_approval_email(email, shop_name, 'Shop')
@@ -1862,6 +2568,8 @@ def update_shop(shop_id):
                 
                 cursor.execute(update_query, values)
                 connection.commit()
+                refresh_shop_spatial_index(cursor)
+                invalidate_shop_pages(shop_id)
                 
                 return jsonify({
                     'success': True,
@@ -1924,6 +2632,8 @@ def update_shop_status(shop_id):
                 # Update status
                 cursor.execute("UPDATE shops SET status = %s WHERE id = %s", (status, shop_id))
                 connection.commit()
+                refresh_shop_spatial_index(cursor)
+                invalidate_shop_pages(shop_id)
                 
                 # Send email notification if status changed to 'open' (approved) or 'rejected'
                 if old_status != status and status in ['open', 'rejected']:
@@ -1950,6 +2660,32 @@ def update_shop_status(shop_id):
         print(f"Error in update_shop_status: {e}")
         return jsonify({'success': False, 'message': 'An error occurred'}), 500
 
+@app.route('/api/admin/payments/reconcile', methods=['POST'])
+def run_stk_reconciliation():
+    """Run one STK reconciliation sweep now (normally done in the background)."""
+    if not session.get('logged_in') or session.get('user_type') != 'employee':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    
+    if session.get('employee_role') != 'KWETU_ADMIN':
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    
+    summary = reconcile_pending_stk_requests()
+    return jsonify({'success': True, 'summary': summary})
+
+@app.route('/api/admin/db-pool/stats', methods=['GET'])
+def get_db_pool_stats():
+    """Get connection pool statistics for the current worker process."""
+    if not session.get('logged_in') or session.get('user_type') != 'employee':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    
+    if session.get('employee_role') != 'KWETU_ADMIN':
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+    
+    if not DB_POOL_CONFIG['enabled']:
+        return jsonify({'success': True, 'enabled': False, 'stats': None})
+    
+    return jsonify({'success': True, 'enabled': True, 'stats': get_db_pool().get_stats()})
+
 @app.route('/api/admin/payment/shops', methods=['GET'])
 def get_payment_shops():
     """Get all shops whose status is not 'waiting_approval' for payment settings."""
@@ -2551,6 +3287,7 @@ def toggle_shop_delivery(shop_id):
             # Update the delivery mode
             cursor.execute("UPDATE shops SET delivery_mode = %s WHERE id = %s", (new_mode, shop_id))
             connection.commit()
+            invalidate_shop_pages(shop_id, index=False)
             
             mode_label = 'Delivery Only' if new_mode == 1 else 'Items with Delivery'
             return jsonify({
@@ -2564,6 +3301,220 @@ def toggle_shop_delivery(shop_id):
     finally:
         connection.close()
 
+# ==================== CUSTOMER SEARCH INDEX ====================
+# search_customers answers from an in-memory n-gram index instead of LIKE '%q%' scans.
+# Customers are numbered in (name, id) order, so posting lists are already sorted the
+# way results are ranked. Rows changed after the build (found by updated_at) live in a
+# small overlay until the next rebuild. Searches fall back to SQL while the first
+# build runs in the background.
+
+CUSTOMER_SEARCH_LIMIT = 10
+CUSTOMER_SEARCH_SYNC_INTERVAL = float(os.getenv('CUSTOMER_SEARCH_SYNC_INTERVAL', '2'))
+CUSTOMER_SEARCH_OVERLAY_LIMIT = int(os.getenv('CUSTOMER_SEARCH_OVERLAY_LIMIT', '5000'))
+
+def customer_search_key(value):
+    return (value or '').casefold()
+
+def customer_search_rank(name_key, phone_key, query):
+    """1 = name starts with query, 2 = phone starts with it, 3 = either contains it."""
+    if name_key.startswith(query):
+        return 1
+    if phone_key.startswith(query):
+        return 2
+    if query in name_key or query in phone_key:
+        return 3
+    return None
+
+def search_ngrams(value):
+    """Distinct 2- and 3-character substrings of a search key."""
+    return {value[i:i + n] for n in (2, 3) for i in range(len(value) - n + 1)}
+
+def prefix_range(sorted_keys, prefix):
+    return (bisect.bisect_left(sorted_keys, prefix),
+            bisect.bisect_left(sorted_keys, prefix + '\U0010ffff'))
+
+class CustomerSearchIndex:
+    """Bigram/trigram postings over customer names and phones.
+    
+    A customer's position is its place in (name, id) order, so for any set of
+    matching positions the smallest ones are also the first by name.
+    """
+    
+    def __init__(self, rows, watermark):
+        rows = sorted(rows, key=lambda row: (customer_search_key(row['name']), row['id']))
+        count = len(rows)
+        self.name_keys = [customer_search_key(row['name']) for row in rows]
+        self.phone_keys = [customer_search_key(row['phone']) for row in rows]
+        self.ids = np.array([row['id'] for row in rows], dtype=np.int64)
+        self.position_by_id = np.full(int(self.ids.max()) + 1 if count else 0, -1, dtype=np.int32)
+        self.position_by_id[self.ids] = np.arange(count, dtype=np.int32)
+        
+        phone_order = sorted(range(count), key=self.phone_keys.__getitem__)
+        self.sorted_phone_keys = [self.phone_keys[position] for position in phone_order]
+        self.phone_positions = np.array(phone_order, dtype=np.int32)
+        self.phone_rank = np.empty(count, dtype=np.int32)
+        self.phone_rank[self.phone_positions] = np.arange(count, dtype=np.int32)
+        
+        name_postings = {}
+        phone_postings = {}
+        for position in range(count):
+            for gram in search_ngrams(self.name_keys[position]):
+                name_postings.setdefault(gram, []).append(position)
+            for gram in search_ngrams(self.phone_keys[position]):
+                phone_postings.setdefault(gram, []).append(position)
+        self.name_postings = {gram: np.array(positions, dtype=np.int32) for gram, positions in name_postings.items()}
+        self.phone_postings = {gram: np.array(positions, dtype=np.int32) for gram, positions in phone_postings.items()}
+        
+        # Customers changed since the build: stale base entries are skipped and the
+        # current values are searched from the overlay instead
+        self.stale = np.zeros(count, dtype=bool)
+        self.overlay = {}  # customer id -> (name_key, phone_key)
+        self.watermark = watermark
+        self.synced_at = time_module.monotonic()
+        self.lock = threading.Lock()
+    
+    def apply_changes(self, rows):
+        with self.lock:
+            for row in rows:
+                customer_id = row['id']
+                self.overlay[customer_id] = (customer_search_key(row['name']), customer_search_key(row['phone']))
+                if customer_id < len(self.position_by_id) and self.position_by_id[customer_id] >= 0:
+                    self.stale[self.position_by_id[customer_id]] = True
+                if row.get('updated_at') and (self.watermark is None or row['updated_at'] > self.watermark):
+                    self.watermark = row['updated_at']
+    
+    def sync(self, cursor):
+        """Pull customers added or edited since the last sync, at most once per interval."""
+        if time_module.monotonic() - self.synced_at < CUSTOMER_SEARCH_SYNC_INTERVAL:
+            return
+        self.synced_at = time_module.monotonic()
+        # >= re-reads the last second's rows, which may have been written after we read it
+        cursor.execute("""
+            SELECT id, name, phone, updated_at FROM customers
+            WHERE updated_at >= %s
+        """, (self.watermark or datetime(1970, 1, 1),))
+        self.apply_changes(cursor.fetchall())
+    
+    def contains_positions(self, postings, query):
+        """Positions whose key may contain query: exact for queries up to 3 characters,
+        otherwise the shortest posting list among the query's trigrams."""
+        if len(query) <= 3:
+            grams = [query]
+        else:
+            grams = [query[i:i + 3] for i in range(len(query) - 2)]
+        shortest = None
+        for gram in grams:
+            positions = postings.get(gram)
+            if positions is None:
+                return np.empty(0, dtype=np.int32)
+            if shortest is None or len(positions) < len(shortest):
+                shortest = positions
+        return shortest
+    
+    def first_matches(self, positions, keep, limit, verify=None):
+        """First `limit` positions (in order) passing the vectorized `keep` mask and the
+        optional per-position `verify`, scanning in growing chunks so long posting
+        lists are not masked in full."""
+        found = []
+        start, size = 0, 64
+        while start < len(positions) and len(found) < limit:
+            chunk = positions[start:start + size]
+            for position in chunk[keep(chunk)]:
+                position = int(position)
+                if verify is None or verify(position):
+                    found.append(position)
+                    if len(found) == limit:
+                        break
+            start += size
+            size *= 4
+        return found
+    
+    def search_base(self, query, limit):
+        """Best (rank, position) matches from the built index, in result order."""
+        name_lo, name_hi = prefix_range(self.name_keys, query)
+        phone_lo, phone_hi = prefix_range(self.sorted_phone_keys, query)
+        
+        # 1: name prefix - a contiguous run of positions
+        name_prefix = self.first_matches(np.arange(name_lo, name_hi, dtype=np.int32),
+                                         lambda chunk: ~self.stale[chunk], limit)
+        
+        # 2: phone prefix (and not a name prefix) - smallest positions first
+        positions = self.phone_positions[phone_lo:phone_hi]
+        positions = positions[((positions < name_lo) | (positions >= name_hi)) & ~self.stale[positions]]
+        if len(positions) > limit:
+            positions = np.partition(positions, limit - 1)[:limit]
+        phone_prefix = sorted(int(position) for position in positions)
+        
+        # 3: contains, from each field's postings; queries longer than a trigram are
+        # candidates only and get checked against the key
+        def not_prefix(chunk):
+            phone_rank = self.phone_rank[chunk]
+            return (((chunk < name_lo) | (chunk >= name_hi))
+                    & ((phone_rank < phone_lo) | (phone_rank >= phone_hi))
+                    & ~self.stale[chunk])
+        exact = len(query) <= 3
+        contains = set()
+        for postings, keys in ((self.name_postings, self.name_keys), (self.phone_postings, self.phone_keys)):
+            verify = None if exact else (lambda position, keys=keys: query in keys[position])
+            contains.update(self.first_matches(self.contains_positions(postings, query), not_prefix, limit, verify))
+        
+        return ([(1, position) for position in name_prefix]
+                + [(2, position) for position in phone_prefix]
+                + [(3, position) for position in sorted(contains)[:limit]])
+    
+    def search(self, query, limit=CUSTOMER_SEARCH_LIMIT):
+        """Customer ids for a query, ranked like the SQL search: name prefix, phone
+        prefix, then contains; ties by name."""
+        query = customer_search_key(query)
+        ranked = [(rank, self.name_keys[position], int(self.ids[position]))
+                  for rank, position in self.search_base(query, limit)]
+        with self.lock:
+            overlay = list(self.overlay.items())
+        for customer_id, (name_key, phone_key) in overlay:
+            rank = customer_search_rank(name_key, phone_key, query)
+            if rank:
+                ranked.append((rank, name_key, customer_id))
+        ranked.sort()
+        return [customer_id for _, _, customer_id in ranked[:limit]]
+
+customer_search_index = None
+customer_search_lock = threading.Lock()
+customer_search_building = False
+
+def load_customer_search_index(cursor):
+    cursor.execute("SELECT id, name, phone, updated_at FROM customers")
+    rows = cursor.fetchall()
+    watermark = max((row['updated_at'] for row in rows if row.get('updated_at')), default=None)
+    return CustomerSearchIndex(rows, watermark)
+
+def refresh_customer_search_index():
+    """Rebuild the customer search index and swap it in."""
+    global customer_search_index, customer_search_building
+    connection = get_db_connection()
+    try:
+        if connection:
+            with connection.cursor() as cursor:
+                customer_search_index = load_customer_search_index(cursor)
+    except Exception as e:
+        print(f"Error building customer search index: {e}")
+    finally:
+        if connection:
+            connection.close()
+        customer_search_building = False
+
+def get_customer_search_index():
+    """Return the current index, or None before the first build has finished.
+    Starts a background rebuild when there is no index or its overlay is too large."""
+    global customer_search_building
+    index = customer_search_index
+    if index is None or len(index.overlay) > CUSTOMER_SEARCH_OVERLAY_LIMIT:
+        with customer_search_lock:
+            if not customer_search_building:
+                customer_search_building = True
+                threading.Thread(target=refresh_customer_search_index,
+                                 name='customer-search-build', daemon=True).start()
+    return index
+
 @app.route('/api/shop/search-customers', methods=['GET'])
 def search_customers():
     """Search customers by name or phone number."""
@@ -2580,27 +3531,41 @@ def search_customers():
     
     try:
         with connection.cursor() as cursor:
-            # Search by name or phone (case-insensitive, partial match)
-            cursor.execute("""
-                SELECT id, name, phone, email
-                FROM customers
-                WHERE name LIKE %s OR phone LIKE %s
-                ORDER BY 
-                    CASE 
-                        WHEN name LIKE %s THEN 1
-                        WHEN phone LIKE %s THEN 2
-                        ELSE 3
-                    END,
-                    name ASC
-                LIMIT 10
-            """, (
-                f'%{search_query}%',
-                f'%{search_query}%',
-                f'{search_query}%',  # Exact start match gets priority
-                f'{search_query}%'
-            ))
-            
-            customers = cursor.fetchall()
+            index = get_customer_search_index()
+            if index is not None:
+                index.sync(cursor)
+                customer_ids = index.search(search_query)
+                customers = []
+                if customer_ids:
+                    placeholders = ', '.join(['%s'] * len(customer_ids))
+                    cursor.execute(f"""
+                        SELECT id, name, phone, email
+                        FROM customers
+                        WHERE id IN ({placeholders})
+                    """, customer_ids)
+                    by_id = {customer['id']: customer for customer in cursor.fetchall()}
+                    customers = [by_id[customer_id] for customer_id in customer_ids if customer_id in by_id]
+            else:
+                # Index still building: search by name or phone (case-insensitive, partial match)
+                cursor.execute("""
+                    SELECT id, name, phone, email
+                    FROM customers
+                    WHERE name LIKE %s OR phone LIKE %s
+                    ORDER BY 
+                        CASE 
+                            WHEN name LIKE %s THEN 1
+                            WHEN phone LIKE %s THEN 2
+                            ELSE 3
+                        END,
+                        name ASC
+                    LIMIT 10
+                """, (
+                    f'%{search_query}%',
+                    f'%{search_query}%',
+                    f'{search_query}%',  # Exact start match gets priority
+                    f'{search_query}%'
+                ))
+                customers = cursor.fetchall()
             
             # Convert to list of dicts
             customers_list = []
@@ -2734,261 +3699,40 @@ def create_package_delivery():
                     """, (client_name, client_phone))
                     customer_id = cursor.lastrowid
                 
-                # 2. Generate unique order number
-                import random
-                from datetime import datetime
-                
-                def generate_order_number():
-                    """Generate a unique order number in format: ORD-YYYYMMDD-HHMMSS-XXXX"""
-                    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-                    random_suffix = f"{random.randint(1000, 9999)}"
-                    order_number = f"ORD-{timestamp}-{random_suffix}"
-                    
-                    # Check if order number exists, regenerate if needed (max 10 attempts)
-                    attempts = 0
-                    while attempts < 10:
-                        cursor.execute("SELECT id FROM orders WHERE order_number = %s", (order_number,))
-                        if not cursor.fetchone():
-                            break
-                        random_suffix = f"{random.randint(1000, 9999)}"
-                        order_number = f"ORD-{timestamp}-{random_suffix}"
-                        attempts += 1
-                    
-                    return order_number
-                
-                order_number = generate_order_number()
-                
-                # 3. Create order with PACKAGE DELIVERY type and pending status
-                # Always use status column (not order_status) and set to 'pending'
-                existing_cols = get_table_columns('orders')
-                has_status_col = 'status' in existing_cols if existing_cols else False
-                has_delivery_fee = 'delivery_fee' in existing_cols if existing_cols else False
-                
+                # 2. Create the order (PACKAGE DELIVERY, pending) with the package as its only item
                 # Use total_amount from form, default to 0.00 if not provided
                 delivery_total = total_amount if total_amount is not None else 0.00
+                order_id, order_number = write_order(cursor, {
+                    'shop_id': shop_id,
+                    'customer_id': customer_id,
+                    'customer_name': client_name,
+                    'customer_phone': client_phone,
+                    'order_type': 'PACKAGE DELIVERY',
+                    'status': 'pending',
+                    'total': delivery_total,
+                    'delivery_fee': delivery_total
+                }, [{
+                    'item_name': f'PACKAGE: {package_id}',
+                    'item_image': package_image_path,
+                    'quantity': 1,
+                    'unit_price': 0.00,
+                    'subtotal': 0.00
+                }])
                 
-                # Debug: Print detected columns
-                print(f"DEBUG: Existing columns: {existing_cols}")
-                print(f"DEBUG: has_status_col: {has_status_col}, has_delivery_fee: {has_delivery_fee}")
-                print(f"DEBUG: total_amount from form: {total_amount}, using: {delivery_total}")
-                
-                # Check if order_number column exists, if not add it
-                try:
-                    if has_status_col:
-                        # Use status column and set to 'pending'
-                        if 'customer_id' in existing_cols and 'order_type' in existing_cols and 'total_amount' in existing_cols:
-                            if has_delivery_fee:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_id, order_type, status, total_amount, delivery_fee, order_number, created_at)
-                                    VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, %s, NOW())
-                                """, (shop_id, customer_id, delivery_total, delivery_total, order_number))
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_id, order_type, status, total_amount, order_number, created_at)
-                                    VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                """, (shop_id, customer_id, delivery_total, order_number))
-                        elif 'customer_id' in existing_cols and 'order_type' in existing_cols:
-                            if has_delivery_fee:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_id, order_type, status, total, delivery_fee, order_number, created_at)
-                                    VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, %s, NOW())
-                                """, (shop_id, customer_id, delivery_total, delivery_total, order_number))
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_id, order_type, status, total, order_number, created_at)
-                                    VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                """, (shop_id, customer_id, delivery_total, order_number))
-                        else:
-                            if has_delivery_fee:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_name, customer_phone, order_type, status, total, delivery_fee, order_number, created_at)
-                                    VALUES (%s, %s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, %s, NOW())
-                                """, (shop_id, client_name, client_phone, delivery_total, delivery_total, order_number))
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_name, customer_phone, order_type, status, total, order_number, created_at)
-                                    VALUES (%s, %s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                """, (shop_id, client_name, client_phone, delivery_total, order_number))
-                    else:
-                        # No status column, use default (shouldn't happen but handle it)
-                        print("WARNING: No status column found!")
-                        if 'customer_id' in existing_cols and 'order_type' in existing_cols and 'total_amount' in existing_cols:
-                            if has_delivery_fee:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_id, order_type, total_amount, delivery_fee, order_number, created_at)
-                                    VALUES (%s, %s, 'PACKAGE DELIVERY', %s, %s, %s, NOW())
-                                """, (shop_id, customer_id, delivery_total, delivery_total, order_number))
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_id, order_type, total_amount, order_number, created_at)
-                                    VALUES (%s, %s, 'PACKAGE DELIVERY', %s, %s, NOW())
-                                """, (shop_id, customer_id, delivery_total, order_number))
-                        else:
-                            cursor.execute("""
-                                INSERT INTO orders (shop_id, customer_id, order_type, total_amount, order_number, created_at)
-                                VALUES (%s, %s, 'PACKAGE DELIVERY', 0.00, %s, NOW())
-                            """, (shop_id, customer_id, order_number))
-                except Exception as e:
-                    # If order_number column doesn't exist, add it and retry
-                    error_msg = str(e).lower()
-                    if 'order_number' in error_msg or 'unknown column' in error_msg:
-                        try:
-                            cursor.execute("ALTER TABLE orders ADD COLUMN order_number VARCHAR(50) UNIQUE")
-                            connection.commit()
-                            if has_status_col:
-                                # Use status column and set to 'pending'
-                                if 'customer_id' in existing_cols and 'order_type' in existing_cols and 'total_amount' in existing_cols:
-                                    if has_delivery_fee:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_id, order_type, status, total_amount, delivery_fee, order_number, created_at)
-                                            VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, %s, NOW())
-                                        """, (shop_id, customer_id, delivery_total, delivery_total, order_number))
-                                    else:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_id, order_type, status, total_amount, order_number, created_at)
-                                            VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                        """, (shop_id, customer_id, delivery_total, order_number))
-                                elif 'customer_id' in existing_cols and 'order_type' in existing_cols:
-                                    if has_delivery_fee:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_id, order_type, status, total, delivery_fee, order_number, created_at)
-                                            VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, %s, NOW())
-                                        """, (shop_id, customer_id, delivery_total, delivery_total, order_number))
-                                    else:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_id, order_type, status, total, order_number, created_at)
-                                            VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                        """, (shop_id, customer_id, delivery_total, order_number))
-                                else:
-                                    if has_delivery_fee:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_name, customer_phone, order_type, status, total, delivery_fee, order_number, created_at)
-                                            VALUES (%s, %s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, %s, NOW())
-                                        """, (shop_id, client_name, client_phone, delivery_total, delivery_total, order_number))
-                                    else:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_name, customer_phone, order_type, status, total, order_number, created_at)
-                                            VALUES (%s, %s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                        """, (shop_id, client_name, client_phone, delivery_total, order_number))
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_id, order_type, total_amount, order_number, created_at)
-                                    VALUES (%s, %s, 'PACKAGE DELIVERY', 0.00, %s, NOW())
-                                """, (shop_id, customer_id, order_number))
-                        except Exception as alter_error:
-                            # If column already exists or other error, try without order_number
-                            print(f"Error adding order_number column: {alter_error}")
-                            if has_status_col:
-                                # Use status column and set to 'pending'
-                                if 'customer_id' in existing_cols and 'order_type' in existing_cols and 'total_amount' in existing_cols:
-                                    if has_delivery_fee:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_id, order_type, status, total_amount, delivery_fee, created_at)
-                                            VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                        """, (shop_id, customer_id, delivery_total, delivery_total))
-                                    else:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_id, order_type, status, total_amount, created_at)
-                                            VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, NOW())
-                                        """, (shop_id, customer_id, delivery_total))
-                                elif 'customer_id' in existing_cols and 'order_type' in existing_cols:
-                                    if has_delivery_fee:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_id, order_type, status, total, delivery_fee, created_at)
-                                            VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                        """, (shop_id, customer_id, delivery_total, delivery_total))
-                                    else:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_id, order_type, status, total, created_at)
-                                            VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, NOW())
-                                        """, (shop_id, customer_id, delivery_total))
-                                else:
-                                    if has_delivery_fee:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_name, customer_phone, order_type, status, total, delivery_fee, created_at)
-                                            VALUES (%s, %s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, NOW())
-                                        """, (shop_id, client_name, client_phone, delivery_total, delivery_total))
-                                    else:
-                                        cursor.execute("""
-                                            INSERT INTO orders (shop_id, customer_name, customer_phone, order_type, status, total, created_at)
-                                            VALUES (%s, %s, %s, 'PACKAGE DELIVERY', 'pending', %s, NOW())
-                                        """, (shop_id, client_name, client_phone, delivery_total))
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO orders (shop_id, customer_id, order_type, total_amount, created_at)
-                                    VALUES (%s, %s, 'PACKAGE DELIVERY', 0.00, NOW())
-                                """, (shop_id, customer_id))
-                            order_number = None
-                    else:
-                        raise
-                
-                order_id = cursor.lastrowid
-                
-                # 4. Insert package as order item - check table structure
-                try:
-                    existing_cols = get_table_columns('order_items')
-                    if existing_cols:
-                        if 'item_id' in existing_cols and 'unit_price' in existing_cols and 'subtotal' in existing_cols:
-                            # Check if item_id is nullable
-                            cursor.execute("SHOW COLUMNS FROM order_items WHERE Field = 'item_id'")
-                            item_id_col = cursor.fetchone()
-                            if 'item_image' in existing_cols:
-                                # Include item_image if column exists
-                                if item_id_col and 'YES' in item_id_col.get('Null', ''):
-                                    cursor.execute("""
-                                        INSERT INTO order_items (order_id, item_id, item_name, item_image, quantity, unit_price, subtotal, created_at)
-                                        VALUES (%s, NULL, %s, %s, 1, 0.00, 0.00, NOW())
-                                    """, (order_id, f'PACKAGE: {package_id}', package_image_path))
-                                else:
-                                    cursor.execute("""
-                                        INSERT INTO order_items (order_id, item_id, item_name, item_image, quantity, unit_price, subtotal, created_at)
-                                        VALUES (%s, 0, %s, %s, 1, 0.00, 0.00, NOW())
-                                    """, (order_id, f'PACKAGE: {package_id}', package_image_path))
-                            else:
-                                # No item_image column
-                                if item_id_col and 'YES' in item_id_col.get('Null', ''):
-                                    cursor.execute("""
-                                        INSERT INTO order_items (order_id, item_id, item_name, quantity, unit_price, subtotal, created_at)
-                                        VALUES (%s, NULL, %s, 1, 0.00, 0.00, NOW())
-                                    """, (order_id, f'PACKAGE: {package_id}'))
-                                else:
-                                    cursor.execute("""
-                                        INSERT INTO order_items (order_id, item_id, item_name, quantity, unit_price, subtotal, created_at)
-                                        VALUES (%s, 0, %s, 1, 0.00, 0.00, NOW())
-                                    """, (order_id, f'PACKAGE: {package_id}'))
-                        elif 'price' in existing_cols:
-                            if 'item_image' in existing_cols:
-                                cursor.execute("""
-                                    INSERT INTO order_items (order_id, item_name, item_image, quantity, price, created_at)
-                                    VALUES (%s, %s, %s, 1, 0.00, NOW())
-                                """, (order_id, f'PACKAGE: {package_id}', package_image_path))
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO order_items (order_id, item_name, quantity, price, created_at)
-                                    VALUES (%s, %s, 1, 0.00, NOW())
-                                """, (order_id, f'PACKAGE: {package_id}'))
-                        else:
-                            if 'item_image' in existing_cols:
-                                cursor.execute("""
-                                    INSERT INTO order_items (order_id, item_name, item_image, quantity, created_at)
-                                    VALUES (%s, %s, %s, 1, NOW())
-                                """, (order_id, f'PACKAGE: {package_id}', package_image_path))
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO order_items (order_id, item_name, quantity, created_at)
-                                    VALUES (%s, %s, 1, NOW())
-                                """, (order_id, f'PACKAGE: {package_id}'))
-                except Exception as e:
-                    print(f"Note: Could not insert order item: {e}")
-                    pass
-                
-                # 5. Insert delivery details
+                # 3. Insert delivery details
                 cursor.execute("""
                     INSERT INTO delivery_details (order_id, delivery_location_name, delivery_latitude, delivery_longitude, shop_latitude, shop_longitude, created_at)
                     VALUES (%s, %s, %s, %s, %s, %s, NOW())
                 """, (order_id, location_name, latitude, longitude, shop['latitude'], shop['longitude']))
                 
+                error = reserve_daily_order_slot(cursor, shop_id)
+                if error:
+                    connection.rollback()
+                    return jsonify({'success': False, 'message': error}), 409
+                
+                auto_confirm_orders(cursor, order_id=order_id)
                 connection.commit()
+                publish_order_created(cursor, order_id)
                 
                 return jsonify({
                     'success': True,
@@ -3009,37 +3753,726 @@ def create_package_delivery():
         print(f"Error in create_package_delivery: {e}")
         return jsonify({'success': False, 'message': 'An error occurred'}), 500
 
-@app.route('/api/shop/stk-push', methods=['POST'])
-def initiate_stk_push():
-    """Initiate M-Pesa STK Push payment."""
-    if not session.get('logged_in') or session.get('user_type') != 'shop':
-        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
-    
-    shop_id = session.get('shop_id')
-    if not shop_id:
-        return jsonify({'success': False, 'message': 'Shop not found'}), 404
-    
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'message': 'No data provided'}), 400
+# ==================== M-PESA CLIENT ====================
+# All Daraja calls share one pooled requests.Session per process. The OAuth token is
+# cached until MPESA_TOKEN_REFRESH_MARGIN seconds before it expires; inside that
+# window one background thread renews it while callers keep using the old token.
+
+MPESA_TOKEN_REFRESH_MARGIN = int(os.getenv('MPESA_TOKEN_REFRESH_MARGIN', '120'))
+MPESA_HTTP_RETRIES = int(os.getenv('MPESA_HTTP_RETRIES', '3'))
+MPESA_HTTP_POOL_SIZE = int(os.getenv('MPESA_HTTP_POOL_SIZE', '10'))
+
+class MpesaAuthError(Exception):
+    """Raised when no access token could be obtained; str() is safe to show users."""
+    pass
+
+mpesa_session = None
+mpesa_session_pid = None
+mpesa_session_lock = threading.Lock()
+
+def get_mpesa_session():
+    """Return this process's pooled Daraja session, creating it on first use."""
+    global mpesa_session, mpesa_session_pid
+    if mpesa_session is None or mpesa_session_pid != os.getpid():
+        with mpesa_session_lock:
+            if mpesa_session is None or mpesa_session_pid != os.getpid():
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                # Only idempotent GETs are retried after a response or read error;
+                # a POST is retried only when the connection was never made, so an
+                # STK push is never sent twice.
+                retry = Retry(
+                    total=MPESA_HTTP_RETRIES,
+                    backoff_factor=0.5,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset(['GET']),
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=MPESA_HTTP_POOL_SIZE, max_retries=retry)
+                session_obj = requests.Session()
+                session_obj.mount('https://', adapter)
+                session_obj.mount('http://', adapter)
+                mpesa_session = session_obj
+                mpesa_session_pid = os.getpid()
+    return mpesa_session
+
+class MpesaTokenManager:
+    """Caches the Daraja OAuth token and renews it with at most one request in flight."""
+    
+    def __init__(self, base_url, consumer_key, consumer_secret, refresh_margin=MPESA_TOKEN_REFRESH_MARGIN):
+        self.base_url = base_url
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_at = 0
+        self.refresh_lock = threading.Lock()
+        self.stats = {'fetches': 0, 'cache_hits': 0, 'background_refreshes': 0, 'failures': 0}
+    
+    def _fetch(self):
+        """Request a new token from Daraja and store it."""
+        self.stats['fetches'] += 1
+        auth_url = f'{self.base_url}/oauth/v1/generate?grant_type=client_credentials'
+        try:
+            auth_response = get_mpesa_session().get(
+                auth_url,
+                auth=(self.consumer_key, self.consumer_secret),
+                timeout=10
+            )
+        except requests.exceptions.RequestException:
+            self.stats['failures'] += 1
+            raise
         
-        phone_number = data.get('phone_number', '').strip()
-        amount = data.get('amount', 0)
+        if auth_response.status_code != 200:
+            self.stats['failures'] += 1
+            print(f"M-Pesa Auth Error: {auth_response.status_code} - {auth_response.text}")
+            raise MpesaAuthError('Failed to authenticate with M-Pesa API. Please check your credentials.')
         
-        # Validate phone number
-        if not phone_number:
-            return jsonify({'success': False, 'message': 'Phone number is required'}), 400
+        auth_data = auth_response.json()
+        if 'access_token' not in auth_data:
+            self.stats['failures'] += 1
+            print(f"M-Pesa Auth Response: {auth_data}")
+            raise MpesaAuthError('Failed to get access token from M-Pesa API.')
         
-        # Validate amount
         try:
-            amount = float(amount)
-            if amount <= 0:
-                return jsonify({'success': False, 'message': 'Amount must be greater than 0'}), 400
-        except (ValueError, TypeError):
-            return jsonify({'success': False, 'message': 'Invalid amount'}), 400
-        
-        connection = get_db_connection()
+            expires_in = int(auth_data.get('expires_in', 3599))
+        except (TypeError, ValueError):
+            expires_in = 3599
+        self.access_token = auth_data['access_token']
+        self.expires_at = time_module.monotonic() + expires_in
+        return self.access_token
+    
+    def _background_refresh(self):
+        try:
+            self._fetch()
+        except Exception as e:
+            print(f"M-Pesa background token refresh failed: {e}")
+        finally:
+            self.refresh_lock.release()
+    
+    def get_token(self):
+        """Return a valid access token, fetching one only if none is usable."""
+        now = time_module.monotonic()
+        token = self.access_token
+        if token and now < self.expires_at:
+            self.stats['cache_hits'] += 1
+            if now >= self.expires_at - self.refresh_margin and self.refresh_lock.acquire(blocking=False):
+                # Close to expiry: renew in the background, keep serving the current token
+                self.stats['background_refreshes'] += 1
+                threading.Thread(target=self._background_refresh, daemon=True).start()
+            return token
+        
+        # No usable token: the first caller fetches, the rest wait for its result
+        with self.refresh_lock:
+            if self.access_token and time_module.monotonic() < self.expires_at:
+                return self.access_token
+            return self._fetch()
+    
+    def invalidate(self):
+        """Forget the cached token, e.g. after Daraja rejected it with 401."""
+        self.access_token = None
+        self.expires_at = 0
+
+mpesa_token_manager = MpesaTokenManager(MPESA_BASE_URL, MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET)
+
+# ==================== PAYMENT EVENTS ====================
+# Payment progress is pushed to the shop dashboard over Server-Sent Events. Publishers
+# (STK job workers, the M-Pesa callback) post to an in-process hub on a per-shop
+# channel. Streams also re-read the database every PAYMENT_STREAM_RECHECK seconds,
+# which covers events published by another worker process.
+
+PAYMENT_STREAM_TIMEOUT = int(os.getenv('PAYMENT_STREAM_TIMEOUT', '120'))
+PAYMENT_STREAM_RECHECK = int(os.getenv('PAYMENT_STREAM_RECHECK', '5'))
+
+class EventHub:
+    """In-process fan-out of events to subscribers of a channel."""
+    
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.subscribers = {}  # channel -> set of queue.Queue
+        self.lock = threading.Lock()
+    
+    def subscribe(self, channel):
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self.lock:
+            self.subscribers.setdefault(channel, set()).add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, channel, subscriber):
+        with self.lock:
+            channel_subscribers = self.subscribers.get(channel)
+            if channel_subscribers:
+                channel_subscribers.discard(subscriber)
+                if not channel_subscribers:
+                    del self.subscribers[channel]
+    
+    def publish(self, channel, event):
+        with self.lock:
+            channel_subscribers = list(self.subscribers.get(channel, ()))
+        for subscriber in channel_subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Slow reader; it will catch up from the database re-check
+                pass
+
+payment_events = EventHub()
+
+def publish_payment_event(shop_id, event):
+    """Send a payment event to every open stream for a shop."""
+    if shop_id:
+        payment_events.publish(f'shop:{shop_id}', event)
+
+def get_stk_status_payload(cursor, checkout_request_id):
+    """Build the stk-status response for one STK push.
+    Returns (shop_id, payload), or (None, None) if the push is unknown."""
+    # Check which status column exists in orders table
+    if get_schema_capabilities('orders').has_status:
+        status_col = 'o.status'
+    else:
+        status_col = "NULL"
+    
+    cursor.execute(f"""
+        SELECT sr.status, sr.result_code, sr.result_desc, sr.mpesa_receipt_number,
+               sr.phone_number, sr.amount,
+               o.id as order_id, o.shop_id, o.order_number, o.payment_status, {status_col} as status
+        FROM stk_push_requests sr
+        JOIN orders o ON sr.order_id = o.id
+        WHERE sr.checkout_request_id = %s
+    """, (checkout_request_id,))
+    
+    result = cursor.fetchone()
+    if not result:
+        return None, None
+    
+    status = result['status']
+    payment_status = result['payment_status']
+    
+    if status == 'completed' and payment_status == 'paid':
+        # Success message from M-Pesa
+        success_message = result['result_desc'] or 'Payment completed successfully!'
+        payload = {
+            'success': True,
+            'status': 'completed',
+            'message': success_message,
+            'order_id': result['order_id'],
+            'order_number': result['order_number'],
+            'receipt_number': result['mpesa_receipt_number'],
+            'phone_number': result.get('phone_number', ''),
+            'amount': float(result.get('amount', 0)) if result.get('amount') else 0
+        }
+    elif status == 'failed':
+        # Failure message with reason from M-Pesa
+        failure_reason = result['result_desc'] or 'Payment failed. Please try again.'
+        payload = {
+            'success': False,
+            'status': 'failed',
+            'message': failure_reason,
+            'reason': failure_reason,
+            'result_code': result.get('result_code', ''),
+            'order_id': result['order_id'],
+            'phone_number': result.get('phone_number', ''),
+            'amount': float(result.get('amount', 0)) if result.get('amount') else 0
+        }
+    else:
+        payload = {
+            'success': True,
+            'status': 'pending',
+            'message': 'Waiting for payment confirmation...',
+            'order_id': result['order_id']
+        }
+    return result['shop_id'], payload
+
+def get_order_payment_event(cursor, order_id):
+    """Current payment state of an order as a stream event, or None if no STK push exists."""
+    cursor.execute("""
+        SELECT checkout_request_id FROM stk_push_requests
+        WHERE order_id = %s ORDER BY id DESC LIMIT 1
+    """, (order_id,))
+    stk_request = cursor.fetchone()
+    if stk_request:
+        _, payload = get_stk_status_payload(cursor, stk_request['checkout_request_id'])
+        if payload:
+            return dict(payload, type='payment', checkout_request_id=stk_request['checkout_request_id'])
+    
+    cursor.execute("""
+        SELECT id, status, checkout_request_id, error_message FROM stk_push_jobs
+        WHERE order_id = %s ORDER BY id DESC LIMIT 1
+    """, (order_id,))
+    job = cursor.fetchone()
+    if job:
+        return {
+            'type': 'job',
+            'order_id': order_id,
+            'job_id': job['id'],
+            'status': job['status'],
+            'checkout_request_id': job['checkout_request_id'],
+            'message': job['error_message'] or ''
+        }
+    return None
+
+def read_order_payment_event(order_id):
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            return get_order_payment_event(cursor, order_id)
+    except Exception as e:
+        print(f"Error reading payment state for order {order_id}: {e}")
+        return None
+    finally:
+        connection.close()
+
+def publish_order_payment_event(cursor, order_id):
+    """Publish an order's current payment state to its shop's streams. Errors are
+    logged only; the database stays the source of truth."""
+    try:
+        event = get_order_payment_event(cursor, order_id)
+        if event:
+            cursor.execute("SELECT shop_id FROM orders WHERE id = %s", (order_id,))
+            order = cursor.fetchone()
+            publish_payment_event(order and order['shop_id'], event)
+    except Exception as e:
+        print(f"Error publishing payment event for order {order_id}: {e}")
+
+def is_final_payment_event(event):
+    if event.get('type') == 'payment':
+        return event.get('status') in ('completed', 'failed')
+    return event.get('type') == 'job' and event.get('status') == 'failed'
+
+# ==================== ORDER EVENTS ====================
+# New orders are pushed to the shop dashboard over Server-Sent Events once they are
+# committed. Publishing goes through a pluggable backend: 'memory' fans out inside this
+# process only; 'database' relays events through the app_events table, which a thread
+# in every worker polls, so multi-worker deployments need no external broker.
+
+ORDER_EVENT_BACKEND = os.getenv('ORDER_EVENT_BACKEND', 'memory').lower()
+ORDER_EVENT_POLL_INTERVAL = float(os.getenv('ORDER_EVENT_POLL_INTERVAL', '1'))
+ORDER_EVENT_RETENTION = int(os.getenv('ORDER_EVENT_RETENTION', '3600'))
+ORDER_STREAM_TIMEOUT = int(os.getenv('ORDER_STREAM_TIMEOUT', '300'))
+ORDER_STREAM_KEEPALIVE = int(os.getenv('ORDER_STREAM_KEEPALIVE', '15'))
+
+class MemoryEventBackend:
+    """Deliver events straight to this process's hub (single-process deployments)."""
+    
+    def __init__(self, hub):
+        self.hub = hub
+    
+    def start(self):
+        pass
+    
+    def publish(self, channel, event):
+        self.hub.publish(channel, event)
+
+class DatabaseEventBackend:
+    """Relay events through the app_events table so every worker process delivers them.
+    
+    publish() inserts a row; a poller thread in each process hands rows newer than the
+    last one it saw to the local hub and prunes rows older than the retention window.
+    """
+    
+    def __init__(self, hub, poll_interval=ORDER_EVENT_POLL_INTERVAL, retention=ORDER_EVENT_RETENTION):
+        self.hub = hub
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.last_id = None
+        self.last_prune = 0
+        self.pid = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """Start the poller once per process (again after a fork)."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.last_id = None
+            threading.Thread(target=self._run, name='event-relay', daemon=True).start()
+            self.pid = os.getpid()
+    
+    def publish(self, channel, event):
+        connection = get_db_connection()
+        if not connection:
+            print(f"Error publishing event on {channel}: database connection error")
+            return
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO app_events (channel, payload) VALUES (%s, %s)",
+                               (channel, json.dumps(event, default=str)))
+            connection.commit()
+        except Exception as e:
+            print(f"Error publishing event on {channel}: {e}")
+        finally:
+            connection.close()
+    
+    def poll(self):
+        """Deliver events published since the last poll; returns how many were delivered."""
+        connection = get_db_connection()
+        if not connection:
+            return 0
+        try:
+            with connection.cursor() as cursor:
+                if self.last_id is None:
+                    # Start from the current tail; streams catch up from the changes feed
+                    cursor.execute("SELECT COALESCE(MAX(id), 0) AS last_id FROM app_events")
+                    self.last_id = cursor.fetchone()['last_id']
+                    return 0
+                cursor.execute("""
+                    SELECT id, channel, payload FROM app_events
+                    WHERE id > %s ORDER BY id LIMIT 500
+                """, (self.last_id,))
+                rows = cursor.fetchall()
+                
+                now = time_module.monotonic()
+                if now - self.last_prune >= 60:
+                    self.last_prune = now
+                    cursor.execute("""
+                        DELETE FROM app_events
+                        WHERE created_at < NOW() - INTERVAL %s SECOND
+                        LIMIT 1000
+                    """, (self.retention,))
+                    connection.commit()
+        finally:
+            connection.close()
+        
+        for row in rows:
+            self.last_id = row['id']
+            try:
+                self.hub.publish(row['channel'], json.loads(row['payload']))
+            except ValueError:
+                print(f"Skipping malformed event {row['id']} on {row['channel']}")
+        return len(rows)
+    
+    def _run(self):
+        while True:
+            try:
+                delivered = self.poll()
+            except Exception as e:
+                print(f"Error relaying events: {e}")
+                delivered = 0
+            if delivered < 500:
+                time_module.sleep(self.poll_interval)
+
+def create_event_backend(hub, name=ORDER_EVENT_BACKEND):
+    if name == 'database':
+        return DatabaseEventBackend(hub)
+    if name != 'memory':
+        print(f"Unknown ORDER_EVENT_BACKEND '{name}', using 'memory'")
+    return MemoryEventBackend(hub)
+
+order_events = EventHub()
+order_event_backend = create_event_backend(order_events)
+
+def publish_order_created(cursor, order_id):
+    """Push a just-committed order to its shop's dashboard streams. Errors are logged
+    only; dashboards also catch up from the orders changes feed."""
+    try:
+        fields, join = shop_order_select_clause()
+        cursor.execute(f"""
+            SELECT o.shop_id AS event_shop_id, {fields}
+            FROM orders o
+            {join}
+            WHERE o.id = %s
+        """, (order_id,))
+        row = cursor.fetchone()
+        if row:
+            order = serialize_shop_orders(build_shop_orders(cursor, [row]))[0]
+            order_event_backend.publish(f"shop:{row['event_shop_id']}", {'type': 'order_created', 'order': order})
+    except Exception as e:
+        print(f"Error publishing order event for order {order_id}: {e}")
+
+# ==================== STK PUSH JOBS ====================
+# initiate_stk_push records a row in stk_push_jobs and returns straight away. A pool
+# of worker threads in each process claims jobs (atomically, by status), calls Daraja
+# and stores the CheckoutRequestID. Queued jobs live in MySQL, so jobs left behind by a
+# restart or another process are picked up by the poller.
+
+STK_PUSH_WORKERS = int(os.getenv('STK_PUSH_WORKERS', '4'))
+STK_PUSH_MAX_ATTEMPTS = int(os.getenv('STK_PUSH_MAX_ATTEMPTS', '3'))
+STK_PUSH_POLL_INTERVAL = int(os.getenv('STK_PUSH_POLL_INTERVAL', '5'))
+STK_PUSH_STALE_AFTER = int(os.getenv('STK_PUSH_STALE_AFTER', '120'))
+
+class StkPushRetry(Exception):
+    """The push was not sent and may be tried again."""
+    pass
+
+def enqueue_stk_push_job(cursor, order_id, phone_number, amount, shortcode, transaction_type,
+                         account_reference, transaction_desc, callback_url):
+    """Insert a queued STK push job with the caller's cursor and return its id.
+    
+    The caller commits, then hands the id to stk_push_workers.submit().
+    """
+    cursor.execute("""
+        INSERT INTO stk_push_jobs (order_id, phone_number, amount, shortcode, transaction_type,
+                                   account_reference, transaction_desc, callback_url, status, run_after)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'queued', NOW())
+    """, (order_id, phone_number, amount, shortcode, transaction_type,
+          account_reference, transaction_desc, callback_url))
+    return cursor.lastrowid
+
+def claim_stk_push_job(job_id):
+    """Move a due job from queued to processing. Returns the job row, or None if
+    another worker got it first or it is not due yet."""
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE stk_push_jobs
+                SET status = 'processing', attempts = attempts + 1, locked_at = NOW()
+                WHERE id = %s AND status = 'queued' AND run_after <= NOW()
+            """, (job_id,))
+            claimed = cursor.rowcount == 1
+            connection.commit()
+            if not claimed:
+                return None
+            cursor.execute("SELECT * FROM stk_push_jobs WHERE id = %s", (job_id,))
+            return cursor.fetchone()
+    finally:
+        connection.close()
+
+def send_stk_push(job):
+    """Call the Daraja STK push API for a job. Returns the CheckoutRequestID.
+    
+    Raises StkPushRetry when nothing reached Safaricom, and Exception with a
+    user-facing message when the push was rejected or its outcome is unknown.
+    """
+    try:
+        access_token = mpesa_token_manager.get_token()
+    except (MpesaAuthError, requests.exceptions.RequestException) as e:
+        raise StkPushRetry(str(e))
+    
+    # Password is base64(shortcode + passkey + timestamp)
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    password_string = f"{job['shortcode']}{MPESA_PASSKEY}{timestamp}"
+    password = base64.b64encode(password_string.encode()).decode()
+    
+    stk_url = f'{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest'
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    payload = {
+        'BusinessShortCode': job['shortcode'],
+        'Password': password,
+        'Timestamp': timestamp,
+        'TransactionType': job['transaction_type'],
+        'Amount': int(job['amount']),
+        'PartyA': job['phone_number'],
+        'PartyB': job['shortcode'],
+        'PhoneNumber': job['phone_number'],
+        'CallBackURL': job['callback_url'],
+        'AccountReference': job['account_reference'],
+        'TransactionDesc': job['transaction_desc']
+    }
+    
+    print(f"STK Push Request - Job: {job['id']}, Shortcode: {job['shortcode']}, Type: {job['transaction_type']}, Amount: {job['amount']}, Phone: {job['phone_number']}")
+    
+    try:
+        stk_response = get_mpesa_session().post(stk_url, json=payload, headers=headers, timeout=30)
+    except requests.exceptions.ConnectionError as e:
+        raise StkPushRetry(f'Network error connecting to M-Pesa API: {e}')
+    except requests.exceptions.RequestException as e:
+        # The request may have reached Safaricom; do not send it again
+        raise Exception(f'Network error connecting to M-Pesa API: {e}')
+    
+    if stk_response.status_code == 401:
+        # Token revoked or expired early; the retry fetches a fresh one
+        mpesa_token_manager.invalidate()
+        raise StkPushRetry('M-Pesa rejected the access token')
+    
+    if stk_response.status_code != 200:
+        error_text = stk_response.text
+        print(f"M-Pesa STK Push Error: {stk_response.status_code} - {error_text}")
+        try:
+            error_data = stk_response.json()
+            error_message = error_data.get('errorMessage', error_data.get('error', error_text))
+        except ValueError:
+            error_message = error_text
+        raise Exception(f'Failed to initiate STK Push: {error_message}')
+    
+    result = stk_response.json()
+    if result.get('ResponseCode', '') != '0':
+        raise Exception(result.get('CustomerMessage', result.get('errorMessage', 'Failed to initiate STK Push')))
+    
+    return result.get('CheckoutRequestID', '')
+
+def finish_stk_push_job(job, checkout_request_id=None, error_message=None, retry=False):
+    """Record the outcome of a job: submitted, requeued with backoff, or failed."""
+    connection = get_db_connection()
+    if not connection:
+        print(f"STK push job {job['id']}: database unavailable while recording outcome")
+        return
+    try:
+        with connection.cursor() as cursor:
+            if checkout_request_id:
+                cursor.execute("""
+                    INSERT INTO stk_push_requests (order_id, checkout_request_id, phone_number, amount, status, created_at)
+                    VALUES (%s, %s, %s, %s, 'pending', NOW())
+                """, (job['order_id'], checkout_request_id, job['phone_number'], job['amount']))
+                cursor.execute("""
+                    UPDATE stk_push_jobs
+                    SET status = 'submitted', checkout_request_id = %s, error_message = NULL
+                    WHERE id = %s
+                """, (checkout_request_id, job['id']))
+            elif retry and job['attempts'] < STK_PUSH_MAX_ATTEMPTS:
+                backoff_seconds = 2 ** job['attempts']
+                cursor.execute("""
+                    UPDATE stk_push_jobs
+                    SET status = 'queued', error_message = %s,
+                        run_after = NOW() + INTERVAL %s SECOND
+                    WHERE id = %s
+                """, (error_message, backoff_seconds, job['id']))
+            else:
+                cursor.execute("""
+                    UPDATE stk_push_jobs SET status = 'failed', error_message = %s WHERE id = %s
+                """, (error_message, job['id']))
+                # Payment initiation failed - mark order as failed
+                applied = False
+                if get_schema_capabilities('orders').has_status:
+                    applied, _ = transition_order(cursor, job['order_id'], 'payment_failed',
+                                                  fields={'payment_status': 'failed'})
+                if not applied:
+                    cursor.execute("""
+                        UPDATE orders SET payment_status = 'failed' WHERE id = %s
+                    """, (job['order_id'],))
+            connection.commit()
+            publish_order_payment_event(cursor, job['order_id'])
+    except Exception as e:
+        connection.rollback()
+        print(f"Error recording STK push job {job['id']}: {e}")
+        import traceback
+        traceback.print_exc()
+    finally:
+        connection.close()
+
+def process_stk_push_job(job_id):
+    """Claim one job and run it to its next state. No DB connection is held
+    while waiting on Daraja."""
+    job = claim_stk_push_job(job_id)
+    if not job:
+        return
+    try:
+        checkout_request_id = send_stk_push(job)
+    except StkPushRetry as e:
+        print(f"STK push job {job_id} attempt {job['attempts']} not sent: {e}")
+        finish_stk_push_job(job, error_message=str(e), retry=True)
+        return
+    except Exception as e:
+        print(f"STK push job {job_id} failed: {e}")
+        finish_stk_push_job(job, error_message=str(e))
+        return
+    finish_stk_push_job(job, checkout_request_id=checkout_request_id)
+
+def sweep_stk_push_jobs():
+    """Fail jobs whose worker died mid-call and return the ids of queued jobs now due."""
+    connection = get_db_connection()
+    if not connection:
+        return []
+    try:
+        with connection.cursor() as cursor:
+            # A push may already have reached Safaricom, so these are not resent
+            cursor.execute("""
+                SELECT id, order_id FROM stk_push_jobs
+                WHERE status = 'processing' AND locked_at < NOW() - INTERVAL %s SECOND
+            """, (STK_PUSH_STALE_AFTER,))
+            for stale in cursor.fetchall():
+                finish_stk_push_job(
+                    {'id': stale['id'], 'order_id': stale['order_id'], 'attempts': STK_PUSH_MAX_ATTEMPTS},
+                    error_message='STK Push was interrupted. Please try again.'
+                )
+            cursor.execute("""
+                SELECT id FROM stk_push_jobs
+                WHERE status = 'queued' AND run_after <= NOW()
+                ORDER BY id ASC
+                LIMIT 100
+            """)
+            return [row['id'] for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"Error sweeping STK push jobs: {e}")
+        return []
+    finally:
+        connection.close()
+
+class StkPushWorkerPool:
+    """Background threads that drain the STK push job queue for this process."""
+    
+    def __init__(self, size=STK_PUSH_WORKERS, poll_interval=STK_PUSH_POLL_INTERVAL):
+        self.size = size
+        self.poll_interval = poll_interval
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """Start the threads once per process (again after a fork)."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue()
+            for number in range(self.size):
+                threading.Thread(target=self._work, name=f'stk-push-{number}', daemon=True).start()
+            threading.Thread(target=self._poll, name='stk-push-poller', daemon=True).start()
+            self.pid = os.getpid()
+    
+    def submit(self, job_id):
+        self.start()
+        self.queue.put(job_id)
+    
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                process_stk_push_job(job_id)
+            except Exception as e:
+                print(f"Error processing STK push job {job_id}: {e}")
+                import traceback
+                traceback.print_exc()
+    
+    def _poll(self):
+        while True:
+            time_module.sleep(self.poll_interval)
+            for job_id in sweep_stk_push_jobs():
+                self.queue.put(job_id)
+
+stk_push_workers = StkPushWorkerPool()
+
+@app.route('/api/shop/stk-push', methods=['POST'])
+def initiate_stk_push():
+    """Initiate M-Pesa STK Push payment."""
+    if not session.get('logged_in') or session.get('user_type') != 'shop':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    
+    shop_id = session.get('shop_id')
+    if not shop_id:
+        return jsonify({'success': False, 'message': 'Shop not found'}), 404
+    
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'success': False, 'message': 'No data provided'}), 400
+        
+        phone_number = data.get('phone_number', '').strip()
+        amount = data.get('amount', 0)
+        
+        # Validate phone number
+        if not phone_number:
+            return jsonify({'success': False, 'message': 'Phone number is required'}), 400
+        
+        # Validate amount
+        try:
+            amount = float(amount)
+            if amount <= 0:
+                return jsonify({'success': False, 'message': 'Amount must be greater than 0'}), 400
+        except (ValueError, TypeError):
+            return jsonify({'success': False, 'message': 'Invalid amount'}), 400
+        
+        connection = get_db_connection()
         if not connection:
             return jsonify({'success': False, 'message': 'Database connection error'}), 500
         
@@ -3065,201 +4498,8 @@ def initiate_stk_push():
                 if not all([client_name, client_phone, package_id, latitude, longitude, location_name]):
                     return jsonify({'success': False, 'message': 'All order fields are required'}), 400
                 
-                # Ensure customers table exists
-                try:
-                    cursor.execute("SELECT 1 FROM customers LIMIT 1")
-                except:
-                    # Table doesn't exist, create it
-                    cursor.execute("""
-                        CREATE TABLE IF NOT EXISTS customers (
-                            id INT AUTO_INCREMENT PRIMARY KEY,
-                            name VARCHAR(100) NOT NULL,
-                            phone VARCHAR(20) NOT NULL,
-                            email VARCHAR(100),
-                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                            INDEX idx_phone (phone),
-                            INDEX idx_email (email)
-                        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-                    """)
-                    connection.commit()
-                
-                # Insert or get customer
-                cursor.execute("SELECT id FROM customers WHERE phone = %s", (client_phone,))
-                customer = cursor.fetchone()
-                if customer:
-                    customer_id = customer['id']
-                    cursor.execute("UPDATE customers SET name = %s WHERE id = %s", (client_name, customer_id))
-                else:
-                    cursor.execute("INSERT INTO customers (name, phone, created_at) VALUES (%s, %s, NOW())", (client_name, client_phone))
-                    customer_id = cursor.lastrowid
-                
-                # Generate order number
-                import random
-                from datetime import datetime
-                timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-                random_suffix = f"{random.randint(1000, 9999)}"
-                order_number = f"ORD-{timestamp}-{random_suffix}"
-                
-                # Check if order number exists
-                attempts = 0
-                while attempts < 10:
-                    cursor.execute("SELECT id FROM orders WHERE order_number = %s", (order_number,))
-                    if not cursor.fetchone():
-                        break
-                    random_suffix = f"{random.randint(1000, 9999)}"
-                    order_number = f"ORD-{timestamp}-{random_suffix}"
-                    attempts += 1
-                
-                # Create order with pending payment
-                # Check which columns exist and use appropriate INSERT statement
-                existing_order_columns = get_table_columns('orders')
-                
-                # Build INSERT statement based on available columns
-                # Check which status column exists - use status column
-                has_status_col = 'status' in existing_order_columns if existing_order_columns else False
-                
-                # Debug: Print detected columns
-                print(f"DEBUG STK: Existing columns: {existing_order_columns}")
-                print(f"DEBUG STK: has_status_col: {has_status_col}")
-                
-                # Use status column
-                if 'customer_id' in existing_order_columns and 'order_type' in existing_order_columns and has_status_col and 'total_amount' in existing_order_columns:
-                    # Use new columns with status column
-                    cursor.execute("""
-                        INSERT INTO orders (shop_id, customer_id, order_type, status, total_amount, order_number, 
-                                          payment_method, payment_status, created_at)
-                        VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, 'mpesa', 'pending', NOW())
-                    """, (shop_id, customer_id, amount, order_number))
-                elif 'customer_id' in existing_order_columns and 'order_type' in existing_order_columns and has_status_col:
-                    # Use total instead of total_amount, with status column
-                    cursor.execute("""
-                        INSERT INTO orders (shop_id, customer_id, order_type, status, total, order_number, 
-                                          payment_method, payment_status, created_at)
-                        VALUES (%s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, 'mpesa', 'pending', NOW())
-                    """, (shop_id, customer_id, amount, order_number))
-                elif 'order_type' in existing_order_columns and has_status_col:
-                    # Use customer_name/phone instead of customer_id, with status column
-                    cursor.execute("""
-                        INSERT INTO orders (shop_id, customer_name, customer_phone, order_type, status, total, order_number, 
-                                          payment_method, payment_status, created_at)
-                        VALUES (%s, %s, %s, 'PACKAGE DELIVERY', 'pending', %s, %s, 'mpesa', 'pending', NOW())
-                    """, (shop_id, client_name, client_phone, amount, order_number))
-                else:
-                    # Use basic columns only
-                    cursor.execute("""
-                        INSERT INTO orders (shop_id, customer_name, customer_phone, total, order_number, 
-                                          payment_method, payment_status, created_at)
-                        VALUES (%s, %s, %s, %s, %s, 'mpesa', 'pending', NOW())
-                    """, (shop_id, client_name, client_phone, amount, order_number))
-                
-                order_id = cursor.lastrowid
-                
-                # Insert package as order item
-                # Check if order_items table exists and what columns it has
-                try:
-                    existing_cols = get_table_columns('order_items')
-                    if existing_cols:
-                        if 'item_id' in existing_cols and 'unit_price' in existing_cols and 'subtotal' in existing_cols:
-                            # Use full schema with item_id (set to 0 or NULL if nullable)
-                            if 'item_id' in existing_cols:
-                                # Check if item_id is nullable
-                                cursor.execute("SHOW COLUMNS FROM order_items WHERE Field = 'item_id'")
-                                item_id_col = cursor.fetchone()
-                                if 'item_image' in existing_cols:
-                                    # Include item_image if column exists
-                                    if item_id_col and 'YES' in item_id_col.get('Null', ''):
-                                        cursor.execute("""
-                                            INSERT INTO order_items (order_id, item_id, item_name, item_image, quantity, unit_price, subtotal, created_at)
-                                            VALUES (%s, NULL, %s, %s, 1, %s, %s, NOW())
-                                        """, (order_id, f'PACKAGE: {package_id}', package_image_path, amount, amount))
-                                    else:
-                                        cursor.execute("""
-                                            INSERT INTO order_items (order_id, item_id, item_name, item_image, quantity, unit_price, subtotal, created_at)
-                                            VALUES (%s, 0, %s, %s, 1, %s, %s, NOW())
-                                        """, (order_id, f'PACKAGE: {package_id}', package_image_path, amount, amount))
-                                else:
-                                    # No item_image column
-                                    if item_id_col and 'YES' in item_id_col.get('Null', ''):
-                                        cursor.execute("""
-                                            INSERT INTO order_items (order_id, item_id, item_name, quantity, unit_price, subtotal, created_at)
-                                            VALUES (%s, NULL, %s, 1, %s, %s, NOW())
-                                        """, (order_id, f'PACKAGE: {package_id}', amount, amount))
-                                    else:
-                                        cursor.execute("""
-                                            INSERT INTO order_items (order_id, item_id, item_name, quantity, unit_price, subtotal, created_at)
-                                            VALUES (%s, 0, %s, 1, %s, %s, NOW())
-                                        """, (order_id, f'PACKAGE: {package_id}', amount, amount))
-                            else:
-                                # No item_id column
-                                if 'item_image' in existing_cols:
-                                    cursor.execute("""
-                                        INSERT INTO order_items (order_id, item_name, item_image, quantity, unit_price, subtotal, created_at)
-                                        VALUES (%s, %s, %s, 1, %s, %s, NOW())
-                                    """, (order_id, f'PACKAGE: {package_id}', package_image_path, amount, amount))
-                                else:
-                                    cursor.execute("""
-                                        INSERT INTO order_items (order_id, item_name, quantity, unit_price, subtotal, created_at)
-                                        VALUES (%s, %s, 1, %s, %s, NOW())
-                                    """, (order_id, f'PACKAGE: {package_id}', amount, amount))
-                        elif 'price' in existing_cols:
-                            # Use price column if it exists
-                            cursor.execute("""
-                                INSERT INTO order_items (order_id, item_name, quantity, price, created_at)
-                                VALUES (%s, %s, 1, %s, NOW())
-                            """, (order_id, f'PACKAGE: {package_id}', amount))
-                        else:
-                            # Minimal insert
-                            cursor.execute("""
-                                INSERT INTO order_items (order_id, item_name, quantity, created_at)
-                                VALUES (%s, %s, 1, NOW())
-                            """, (order_id, f'PACKAGE: {package_id}'))
-                except Exception as e:
-                    # Table doesn't exist or error, skip order_items insert
-                    print(f"Note: Could not insert order item: {e}")
-                    pass
-                
-                # Insert delivery details
-                try:
-                    cursor.execute("""
-                        INSERT INTO delivery_details (order_id, delivery_location_name, delivery_latitude, 
-                                                     delivery_longitude, shop_latitude, shop_longitude, created_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, NOW())
-                    """, (order_id, location_name, latitude, longitude, shop_location['latitude'], shop_location['longitude']))
-                except Exception as e:
-                    # If table doesn't exist, create it
-                    if 'doesn\'t exist' in str(e).lower() or '1146' in str(e):
-                        print(f"Creating delivery_details table...")
-                        cursor.execute("""
-                            CREATE TABLE IF NOT EXISTS delivery_details (
-                                id INT AUTO_INCREMENT PRIMARY KEY,
-                                order_id INT NOT NULL,
-                                delivery_location_name VARCHAR(255) NOT NULL,
-                                delivery_latitude DECIMAL(10, 8) NOT NULL,
-                                delivery_longitude DECIMAL(10, 8) NOT NULL,
-                                shop_latitude DECIMAL(10, 8),
-                                shop_longitude DECIMAL(10, 8),
-                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                                INDEX idx_order_id (order_id),
-                                FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
-                            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-                        """)
-                        connection.commit()
-                        # Retry insert
-                        cursor.execute("""
-                            INSERT INTO delivery_details (order_id, delivery_location_name, delivery_latitude, 
-                                                         delivery_longitude, shop_latitude, shop_longitude, created_at)
-                            VALUES (%s, %s, %s, %s, %s, %s, NOW())
-                        """, (order_id, location_name, latitude, longitude, shop_location['latitude'], shop_location['longitude']))
-                    else:
-                        print(f"Error inserting delivery details: {e}")
-                        pass  # Continue anyway
-                
-                connection.commit()
-                
-                # STEP 2: Now initiate STK Push payment
-                # Get shop payment settings
+                # Resolve the M-Pesa account before creating anything, so an order that
+                # cannot be charged never takes one of the shop's daily order slots
                 cursor.execute("""
                     SELECT payments_to_shop, mpesa_type, mpesa_paybill_business_number, 
                            mpesa_paybill_account, mpesa_buy_goods_till
@@ -3332,147 +4572,122 @@ def initiate_stk_push():
                         'message': f'Invalid Paybill/Till number: {MPESA_SHORTCODE}. Please configure a valid M-Pesa business number in payment settings.'
                     }), 400
                 
-                # Simple callback URL - use production URL or environment variable
-                callback_url = os.getenv('MPESA_CALLBACK_URL', 'https://kwetudeliveries.com/api/shop/stk-callback')
+                # Ensure customers table exists
+                try:
+                    cursor.execute("SELECT 1 FROM customers LIMIT 1")
+                except:
+                    # Table doesn't exist, create it
+                    cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS customers (
+                            id INT AUTO_INCREMENT PRIMARY KEY,
+                            name VARCHAR(100) NOT NULL,
+                            phone VARCHAR(20) NOT NULL,
+                            email VARCHAR(100),
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                            INDEX idx_phone (phone),
+                            INDEX idx_email (email)
+                        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                    """)
+                    connection.commit()
+                
+                # Insert or get customer
+                cursor.execute("SELECT id FROM customers WHERE phone = %s", (client_phone,))
+                customer = cursor.fetchone()
+                if customer:
+                    customer_id = customer['id']
+                    cursor.execute("UPDATE customers SET name = %s WHERE id = %s", (client_name, customer_id))
+                else:
+                    cursor.execute("INSERT INTO customers (name, phone, created_at) VALUES (%s, %s, NOW())", (client_name, client_phone))
+                    customer_id = cursor.lastrowid
+                
+                # Create order with pending payment and the package as its only item
+                order_id, order_number = write_order(cursor, {
+                    'shop_id': shop_id,
+                    'customer_id': customer_id,
+                    'customer_name': client_name,
+                    'customer_phone': client_phone,
+                    'order_type': 'PACKAGE DELIVERY',
+                    'status': 'pending',
+                    'total': amount,
+                    'payment_method': 'mpesa',
+                    'payment_status': 'pending'
+                }, [{
+                    'item_name': f'PACKAGE: {package_id}',
+                    'item_image': package_image_path,
+                    'quantity': 1,
+                    'unit_price': amount,
+                    'subtotal': amount
+                }])
                 
+                # Insert delivery details
                 try:
-                    # Step 1: Get access token from M-Pesa OAuth API
-                    auth_url = f'{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials'
-                    auth_response = requests.get(
-                        auth_url,
-                        auth=(MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET),
-                        timeout=10
-                    )
-                    
-                    if auth_response.status_code != 200:
-                        print(f"M-Pesa Auth Error: {auth_response.status_code} - {auth_response.text}")
-                        return jsonify({
-                            'success': False,
-                            'message': 'Failed to authenticate with M-Pesa API. Please check your credentials.'
-                        }), 500
-                    
-                    auth_data = auth_response.json()
-                    if 'access_token' not in auth_data:
-                        print(f"M-Pesa Auth Response: {auth_data}")
-                        return jsonify({
-                            'success': False,
-                            'message': 'Failed to get access token from M-Pesa API.'
-                        }), 500
-                    
-                    access_token = auth_data['access_token']
-                    
-                    # Step 2: Generate password (base64 encoded timestamp + passkey)
-                    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-                    password_string = f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}"
-                    password = base64.b64encode(password_string.encode()).decode()
-                    
-                    # Step 3: Prepare STK Push request
-                    stk_url = f'{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest'
-                    headers = {
-                        'Authorization': f'Bearer {access_token}',
-                        'Content-Type': 'application/json'
-                    }
-                    
-                    # Determine transaction type based on mpesa_type
-                    transaction_type = 'CustomerPayBillOnline' if mpesa_type == 'paybill' else 'CustomerBuyGoodsOnline'
-                    
-                    payload = {
-                        'BusinessShortCode': MPESA_SHORTCODE,
-                        'Password': password,
-                        'Timestamp': timestamp,
-                        'TransactionType': transaction_type,
-                        'Amount': int(amount),
-                        'PartyA': phone_number,
-                        'PartyB': MPESA_SHORTCODE,
-                        'PhoneNumber': phone_number,
-                        'CallBackURL': callback_url,
-                        'AccountReference': account_number or f'ORD-{order_number}',
-                        'TransactionDesc': f'Package Delivery - {package_id}'
-                    }
-                    
-                    print(f"STK Push Request - Shortcode: {MPESA_SHORTCODE}, Type: {transaction_type}, Amount: {amount}, Phone: {phone_number}")
-                    
-                    # Step 4: Make STK Push request
-                    stk_response = requests.post(stk_url, json=payload, headers=headers, timeout=30)
-                    
-                    if stk_response.status_code != 200:
-                        error_text = stk_response.text
-                        print(f"M-Pesa STK Push Error: {stk_response.status_code} - {error_text}")
-                        try:
-                            error_data = stk_response.json()
-                            error_message = error_data.get('errorMessage', error_data.get('error', error_text))
-                        except:
-                            error_message = error_text
-                        return jsonify({
-                            'success': False,
-                            'message': f'Failed to initiate STK Push: {error_message}'
-                        }), 500
-                    
-                    result = stk_response.json()
-                    
-                    # Check response code
-                    response_code = result.get('ResponseCode', '')
-                    if response_code == '0':
-                        checkout_request_id = result.get('CheckoutRequestID', '')
-                        customer_message = result.get('CustomerMessage', 'STK Push initiated successfully')
-                        
-                        # Save STK Push request to database
-                        try:
-                            cursor.execute("""
-                                INSERT INTO stk_push_requests (order_id, checkout_request_id, phone_number, amount, status, created_at)
-                                VALUES (%s, %s, %s, %s, 'pending', NOW())
-                            """, (order_id, checkout_request_id, phone_number, amount))
-                            connection.commit()
-                        except Exception as e:
-                            print(f"Error saving STK Push request: {e}")
-                            # Continue anyway - order is created
-                        
-                        return jsonify({
-                            'success': True,
-                            'message': customer_message,
-                            'checkout_request_id': checkout_request_id,
-                            'order_id': order_id,
-                            'order_number': order_number
-                        })
-                    else:
-                        # Payment initiation failed - mark order as failed
-                        try:
-                            # Update order - check which status column exists
-                            existing_cols = get_table_columns('orders')
-                            if 'status' in existing_cols:
-                                cursor.execute("""
-                                    UPDATE orders SET payment_status = 'failed', status = 'cancelled' WHERE id = %s
-                                """, (order_id,))
-                            # Status column is handled separately
-                            else:
-                                cursor.execute("""
-                                    UPDATE orders SET payment_status = 'failed' WHERE id = %s
-                                """, (order_id,))
-                            connection.commit()
-                        except:
-                            pass
-                        
-                        error_message = result.get('CustomerMessage', result.get('errorMessage', 'Failed to initiate STK Push'))
-                        return jsonify({
-                            'success': False,
-                            'message': error_message,
-                            'order_id': order_id
-                        }), 400
-                        
-                except requests.exceptions.RequestException as e:
-                    print(f"M-Pesa API Request Error: {e}")
-                    return jsonify({
-                        'success': False,
-                        'message': f'Network error connecting to M-Pesa API: {str(e)}'
-                    }), 500
+                    cursor.execute("""
+                        INSERT INTO delivery_details (order_id, delivery_location_name, delivery_latitude, 
+                                                     delivery_longitude, shop_latitude, shop_longitude, created_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, NOW())
+                    """, (order_id, location_name, latitude, longitude, shop_location['latitude'], shop_location['longitude']))
                 except Exception as e:
-                    print(f"M-Pesa STK Push Error: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    return jsonify({
-                        'success': False,
-                        'message': f'Error initiating STK Push: {str(e)}'
-                    }), 500
+                    # If table doesn't exist, create it
+                    if 'doesn\'t exist' in str(e).lower() or '1146' in str(e):
+                        print(f"Creating delivery_details table...")
+                        cursor.execute("""
+                            CREATE TABLE IF NOT EXISTS delivery_details (
+                                id INT AUTO_INCREMENT PRIMARY KEY,
+                                order_id INT NOT NULL,
+                                delivery_location_name VARCHAR(255) NOT NULL,
+                                delivery_latitude DECIMAL(10, 8) NOT NULL,
+                                delivery_longitude DECIMAL(10, 8) NOT NULL,
+                                shop_latitude DECIMAL(10, 8),
+                                shop_longitude DECIMAL(10, 8),
+                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                                INDEX idx_order_id (order_id),
+                                FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
+                            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                        """)
+                        connection.commit()
+                        # Retry insert
+                        cursor.execute("""
+                            INSERT INTO delivery_details (order_id, delivery_location_name, delivery_latitude, 
+                                                         delivery_longitude, shop_latitude, shop_longitude, created_at)
+                            VALUES (%s, %s, %s, %s, %s, %s, NOW())
+                        """, (order_id, location_name, latitude, longitude, shop_location['latitude'], shop_location['longitude']))
+                    else:
+                        print(f"Error inserting delivery details: {e}")
+                        pass  # Continue anyway
+                
+                error = reserve_daily_order_slot(cursor, shop_id)
+                if error:
+                    connection.rollback()
+                    return jsonify({'success': False, 'message': error}), 409
+                
+                auto_confirm_orders(cursor, order_id=order_id)
+                connection.commit()
+                publish_order_created(cursor, order_id)
+                
+                # STEP 2: Now initiate STK Push payment
+                # Simple callback URL - use production URL or environment variable
+                callback_url = os.getenv('MPESA_CALLBACK_URL', 'https://kwetudeliveries.com/api/shop/stk-callback')
+                
+                # Determine transaction type based on mpesa_type
+                transaction_type = 'CustomerPayBillOnline' if mpesa_type == 'paybill' else 'CustomerBuyGoodsOnline'
+                
+                # Queue the Daraja call; a background worker sends it and records the CheckoutRequestID
+                job_id = enqueue_stk_push_job(
+                    cursor, order_id, phone_number, amount, MPESA_SHORTCODE, transaction_type,
+                    account_number or f'ORD-{order_number}', f'Package Delivery - {package_id}', callback_url
+                )
+                connection.commit()
+                stk_push_workers.submit(job_id)
+                
+                return jsonify({
+                    'success': True,
+                    'message': 'STK Push queued. Waiting for M-Pesa...',
+                    'job_id': job_id,
+                    'order_id': order_id,
+                    'order_number': order_number
+                })
                 
         except Exception as e:
             connection.rollback()
@@ -3484,188 +4699,556 @@ def initiate_stk_push():
             connection.close()
             
     except Exception as e:
-        print(f"Error in initiate_stk_push: {e}")
-        return jsonify({'success': False, 'message': 'An error occurred'}), 500
+        print(f"Error in initiate_stk_push: {e}")
+        return jsonify({'success': False, 'message': 'An error occurred'}), 500
+
+# ==================== M-PESA CALLBACK INBOX ====================
+# stk_push_callback only stores the raw body in mpesa_callback_inbox and acknowledges.
+# A consumer thread per process applies pending rows in arrival order. Applying is
+# idempotent: a push that already has a final status, or a receipt number that was
+# already recorded, is marked duplicate, so Safaricom retries and replays are harmless.
+
+CALLBACK_INBOX_POLL_INTERVAL = int(os.getenv('CALLBACK_INBOX_POLL_INTERVAL', '5'))
+CALLBACK_INBOX_MAX_ATTEMPTS = int(os.getenv('CALLBACK_INBOX_MAX_ATTEMPTS', '6'))
+CALLBACK_INBOX_STALE_AFTER = int(os.getenv('CALLBACK_INBOX_STALE_AFTER', '60'))
+
+def parse_stk_callback(data):
+    """Extract the fields we use from an STK callback body."""
+    # Extract callback data - handle different M-Pesa callback formats
+    body = data.get('Body', data)  # Some callbacks send data directly
+    stk_callback = body.get('stkCallback', body)  # Fallback to body if stkCallback doesn't exist
+    
+    # Handle both string and integer result codes
+    result_code_raw = stk_callback.get('ResultCode', '')
+    result_code = int(result_code_raw) if result_code_raw != '' and result_code_raw is not None else -1
+    result_desc = stk_callback.get('ResultDesc', '')
+    customer_message = stk_callback.get('CustomerMessage', '')
+    callback_metadata = stk_callback.get('CallbackMetadata', {}) or {}
+    items = callback_metadata.get('Item', [])
+    
+    # Extract transaction details
+    transaction_data = {}
+    for item in items:
+        if isinstance(item, dict):
+            transaction_data[item.get('Name', '')] = item.get('Value', '')
+    
+    # Build comprehensive message from M-Pesa
+    # ResultDesc contains the main message, CustomerMessage may have additional info
+    mpesa_message = result_desc
+    if customer_message and customer_message != result_desc:
+        mpesa_message = f"{result_desc}. {customer_message}"
+    
+    return {
+        'result_code': result_code,
+        'result_desc': result_desc,
+        'merchant_request_id': stk_callback.get('MerchantRequestID', ''),
+        'checkout_request_id': stk_callback.get('CheckoutRequestID', ''),
+        'customer_message': customer_message,
+        'mpesa_message': mpesa_message,
+        'mpesa_receipt_number': str(transaction_data.get('MpesaReceiptNumber', '') or ''),
+        'transaction_date': str(transaction_data.get('TransactionDate', '') or ''),
+        'phone_number': str(transaction_data.get('PhoneNumber', '') or ''),
+        'amount': transaction_data.get('Amount', 0)
+    }
+
+def apply_stk_callback(cursor, callback):
+    """Apply a parsed STK result to stk_push_requests and orders. The caller commits.
+    
+    Returns (order_id, outcome) where outcome is 'applied', 'duplicate' or 'unknown'
+    (no push with that CheckoutRequestID has been recorded yet).
+    """
+    checkout_request_id = callback['checkout_request_id']
+    result_code = callback['result_code']
+    result_desc = callback['result_desc']
+    mpesa_message = callback['mpesa_message']
+    mpesa_receipt_number = callback['mpesa_receipt_number']
+    transaction_date = callback['transaction_date']
+    phone_number = callback['phone_number']
+    
+    cursor.execute("""
+        SELECT id, order_id, status FROM stk_push_requests 
+        WHERE checkout_request_id = %s
+        FOR UPDATE
+    """, (checkout_request_id,))
+    stk_request = cursor.fetchone()
+    if not stk_request:
+        return None, 'unknown'
+    
+    order_id = stk_request['order_id']
+    if stk_request['status'] != 'pending':
+        return order_id, 'duplicate'
+    
+    if mpesa_receipt_number:
+        cursor.execute("""
+            SELECT id FROM stk_push_requests
+            WHERE mpesa_receipt_number = %s AND id != %s
+            LIMIT 1
+        """, (mpesa_receipt_number, stk_request['id']))
+        if cursor.fetchone():
+            return order_id, 'duplicate'
+    
+    if result_code == 0:
+        print(f"✓ Payment SUCCESS for order {order_id}")
+        # Payment successful - store full message and update phone number if provided
+        success_message = mpesa_message or result_desc or "Payment completed successfully"
+        # Update phone number if provided in callback (may be more accurate)
+        if phone_number:
+            cursor.execute("""
+                UPDATE stk_push_requests 
+                SET status = 'completed', mpesa_receipt_number = %s, 
+                    transaction_date = %s, result_code = %s, result_desc = %s,
+                    phone_number = %s, updated_at = NOW()
+                WHERE checkout_request_id = %s
+            """, (mpesa_receipt_number, transaction_date, str(result_code), success_message, phone_number, checkout_request_id))
+        else:
+            cursor.execute("""
+                UPDATE stk_push_requests 
+                SET status = 'completed', mpesa_receipt_number = %s, 
+                    transaction_date = %s, result_code = %s, result_desc = %s,
+                    updated_at = NOW()
+                WHERE checkout_request_id = %s
+            """, (mpesa_receipt_number, transaction_date, str(result_code), success_message, checkout_request_id))
+        
+        # Package deliveries go to PROCESSING (rider just picks and delivers), other
+        # orders to confirmed. An order that already moved on (e.g. auto-confirmed to
+        # preparing) keeps its status and is only marked paid.
+        applied = False
+        if get_schema_capabilities('orders').has_status:
+            cursor.execute("SELECT order_type FROM orders WHERE id = %s", (order_id,))
+            order_info = cursor.fetchone()
+            is_package_delivery = order_info and order_info.get('order_type') == 'PACKAGE DELIVERY'
+            action = 'package_paid' if is_package_delivery else 'payment_confirmed'
+            applied, _ = transition_order(cursor, order_id, action, fields={'payment_status': 'paid'})
+        if not applied:
+            cursor.execute("""
+                UPDATE orders 
+                SET payment_status = 'paid', updated_at = NOW()
+                WHERE id = %s
+            """, (order_id,))
+        
+        print(f"✓ Order {order_id} payment completed! Receipt: {mpesa_receipt_number}")
+    else:
+        # Payment failed - store full failure message with reason
+        print(f"✗ Payment FAILED for order {order_id}. Code: {result_code}, Desc: {result_desc}")
+        failure_message = mpesa_message or result_desc or f"Payment failed with code {result_code}"
+        # Update phone number if provided in callback
+        if phone_number:
+            cursor.execute("""
+                UPDATE stk_push_requests 
+                SET status = 'failed', result_code = %s, result_desc = %s, 
+                    phone_number = %s, updated_at = NOW()
+                WHERE checkout_request_id = %s
+            """, (str(result_code), failure_message, phone_number, checkout_request_id))
+        else:
+            cursor.execute("""
+                UPDATE stk_push_requests 
+                SET status = 'failed', result_code = %s, result_desc = %s, updated_at = NOW()
+                WHERE checkout_request_id = %s
+            """, (str(result_code), failure_message, checkout_request_id))
+        
+        # Cancel the order unless it has already gone out (ready or later)
+        applied = False
+        if get_schema_capabilities('orders').has_status:
+            applied, _ = transition_order(cursor, order_id, 'payment_failed', fields={'payment_status': 'failed'})
+        if not applied:
+            cursor.execute("""
+                UPDATE orders 
+                SET payment_status = 'failed', updated_at = NOW()
+                WHERE id = %s
+            """, (order_id,))
+        
+        print(f"✗ Order {order_id} payment failed: {result_desc}")
+    
+    return order_id, 'applied'
+
+def insert_callback_inbox_entry(cursor, checkout_request_id, mpesa_receipt_number, payload):
+    """Append a raw STK result to the inbox. The caller commits and notifies the consumer."""
+    cursor.execute("""
+        INSERT INTO mpesa_callback_inbox (checkout_request_id, mpesa_receipt_number, payload, status, next_attempt_at)
+        VALUES (%s, %s, %s, 'pending', NOW())
+    """, (checkout_request_id or None, mpesa_receipt_number or None, payload))
+
+def process_callback_inbox_entry(entry_id):
+    """Claim one pending inbox row and apply it."""
+    connection = get_db_connection()
+    if not connection:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE mpesa_callback_inbox
+                SET status = 'processing', attempts = attempts + 1, locked_at = NOW()
+                WHERE id = %s AND status = 'pending' AND next_attempt_at <= NOW()
+            """, (entry_id,))
+            claimed = cursor.rowcount == 1
+            connection.commit()
+            if not claimed:
+                return
+            
+            cursor.execute("SELECT payload, attempts FROM mpesa_callback_inbox WHERE id = %s", (entry_id,))
+            entry = cursor.fetchone()
+            try:
+                callback = parse_stk_callback(json.loads(entry['payload']))
+                order_id, outcome = apply_stk_callback(cursor, callback)
+                if outcome == 'unknown':
+                    # The STK job may not have recorded the CheckoutRequestID yet
+                    connection.rollback()
+                    retry_callback_inbox_entry(cursor, entry_id, entry['attempts'],
+                                               'No STK Push request with this CheckoutRequestID yet', 'unmatched')
+                    connection.commit()
+                else:
+                    cursor.execute("""
+                        UPDATE mpesa_callback_inbox
+                        SET status = %s, processed_at = NOW(), error_message = NULL
+                        WHERE id = %s
+                    """, ('processed' if outcome == 'applied' else 'duplicate', entry_id))
+                    connection.commit()
+                    print(f"M-Pesa callback {entry_id} ({callback['checkout_request_id']}): {outcome}")
+                    if outcome == 'applied':
+                        publish_order_payment_event(cursor, order_id)
+            except Exception as e:
+                connection.rollback()
+                print(f"Error applying M-Pesa callback {entry_id}: {e}")
+                import traceback
+                traceback.print_exc()
+                retry_callback_inbox_entry(cursor, entry_id, entry['attempts'], str(e), 'failed')
+                connection.commit()
+    finally:
+        connection.close()
+
+def retry_callback_inbox_entry(cursor, entry_id, attempts, error_message, final_status):
+    """Put an inbox row back with backoff, or park it once attempts run out."""
+    if attempts < CALLBACK_INBOX_MAX_ATTEMPTS:
+        cursor.execute("""
+            UPDATE mpesa_callback_inbox
+            SET status = 'pending', error_message = %s, next_attempt_at = NOW() + INTERVAL %s SECOND
+            WHERE id = %s
+        """, (error_message, 2 ** attempts, entry_id))
+    else:
+        cursor.execute("""
+            UPDATE mpesa_callback_inbox SET status = %s, error_message = %s WHERE id = %s
+        """, (final_status, error_message, entry_id))
+
+def next_callback_inbox_batch(limit=100):
+    """Requeue rows whose consumer died and return ids of due rows, oldest first."""
+    connection = get_db_connection()
+    if not connection:
+        return []
+    try:
+        with connection.cursor() as cursor:
+            # Safe to redo: applying a callback twice is a no-op
+            cursor.execute("""
+                UPDATE mpesa_callback_inbox SET status = 'pending'
+                WHERE status = 'processing' AND locked_at < NOW() - INTERVAL %s SECOND
+            """, (CALLBACK_INBOX_STALE_AFTER,))
+            connection.commit()
+            cursor.execute("""
+                SELECT id FROM mpesa_callback_inbox
+                WHERE status = 'pending' AND next_attempt_at <= NOW()
+                ORDER BY id ASC
+                LIMIT %s
+            """, (limit,))
+            return [row['id'] for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"Error reading M-Pesa callback inbox: {e}")
+        return []
+    finally:
+        connection.close()
+
+class CallbackInboxConsumer:
+    """Single background thread per process that drains mpesa_callback_inbox in order."""
+    
+    def __init__(self, poll_interval=CALLBACK_INBOX_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """Start the thread once per process (again after a fork)."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.wakeup = threading.Event()
+            threading.Thread(target=self._run, name='mpesa-callback-inbox', daemon=True).start()
+            self.pid = os.getpid()
+    
+    def notify(self):
+        self.start()
+        self.wakeup.set()
+    
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            try:
+                batch = next_callback_inbox_batch()
+                while batch:
+                    for entry_id in batch:
+                        process_callback_inbox_entry(entry_id)
+                    batch = next_callback_inbox_batch()
+            except Exception as e:
+                print(f"Error draining M-Pesa callback inbox: {e}")
+                import traceback
+                traceback.print_exc()
+
+callback_inbox_consumer = CallbackInboxConsumer()
+
+# ==================== STK RECONCILIATION ====================
+# Pushes whose callback never arrived are resolved with the Daraja STK query API. Every
+# STK_RECONCILE_INTERVAL seconds one process (a MySQL named lock decides which) queries
+# a batch of stale pending pushes with bounded concurrency and a request rate cap. Final
+# answers are written to the callback inbox, so they are applied exactly like callbacks.
+# Pushes still pending after STK_RECONCILE_MAX_AGE are failed the same way.
+
+STK_RECONCILE_ENABLED = os.getenv('STK_RECONCILE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+STK_RECONCILE_INTERVAL = int(os.getenv('STK_RECONCILE_INTERVAL', '60'))
+STK_RECONCILE_AFTER = int(os.getenv('STK_RECONCILE_AFTER', '90'))
+STK_RECONCILE_MAX_AGE = int(os.getenv('STK_RECONCILE_MAX_AGE', '3600'))
+STK_RECONCILE_BATCH = int(os.getenv('STK_RECONCILE_BATCH', '50'))
+STK_RECONCILE_CONCURRENCY = int(os.getenv('STK_RECONCILE_CONCURRENCY', '4'))
+STK_EXPIRED_RESULT_CODE = 1037  # Daraja's "no response from user" code, used for expired pushes
+STK_QUERY_RATE_PER_SECOND = float(os.getenv('STK_QUERY_RATE_PER_SECOND', '5'))
+
+class RateLimiter:
+    """Token bucket shared by threads; acquire() blocks until a request may go out."""
+    
+    def __init__(self, rate_per_second, burst=None):
+        self.rate = rate_per_second
+        self.capacity = burst or max(1, int(rate_per_second))
+        self.tokens = self.capacity
+        self.updated_at = time_module.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time_module.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time_module.sleep(wait)
+
+stk_query_rate_limiter = RateLimiter(STK_QUERY_RATE_PER_SECOND)
+
+def query_stk_push_status(shortcode, checkout_request_id):
+    """Ask Daraja for the result of one STK push.
+    
+    Returns the query response (it carries ResultCode/ResultDesc) once the
+    transaction is final, or None while Safaricom is still processing it.
+    """
+    stk_query_rate_limiter.acquire()
+    access_token = mpesa_token_manager.get_token()
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    password = base64.b64encode(f"{shortcode}{MPESA_PASSKEY}{timestamp}".encode()).decode()
+    
+    response = get_mpesa_session().post(
+        f'{MPESA_BASE_URL}/mpesa/stkpushquery/v1/query',
+        json={
+            'BusinessShortCode': shortcode,
+            'Password': password,
+            'Timestamp': timestamp,
+            'CheckoutRequestID': checkout_request_id
+        },
+        headers={'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'},
+        timeout=15
+    )
+    if response.status_code == 401:
+        mpesa_token_manager.invalidate()
+    
+    try:
+        result = response.json()
+    except ValueError:
+        result = {}
+    if result.get('ResultCode') not in (None, ''):
+        return result
+    # e.g. 500.001.1001 "The transaction is being processed"
+    if response.status_code != 200:
+        print(f"STK query for {checkout_request_id}: {response.status_code} - {result.get('errorMessage', response.text)}")
+    return None
+
+def reconcile_pending_stk_requests():
+    """Query Daraja for stale pending pushes and queue the final results. Returns a summary."""
+    summary = {'checked': 0, 'resolved': 0, 'expired': 0, 'skipped': False}
+    connection = get_db_connection()
+    if not connection:
+        return summary
+    try:
+        with connection.cursor() as cursor:
+            # Only one process sweeps at a time
+            cursor.execute("SELECT GET_LOCK('kwetu_stk_reconciler', 0) AS acquired")
+            if not cursor.fetchone()['acquired']:
+                summary['skipped'] = True
+                return summary
+            try:
+                # Pushes whose result is already waiting in the inbox are left to the consumer
+                cursor.execute("""
+                    SELECT sr.checkout_request_id, j.shortcode
+                    FROM stk_push_requests sr
+                    LEFT JOIN stk_push_jobs j ON j.checkout_request_id = sr.checkout_request_id
+                    WHERE sr.status = 'pending'
+                    AND sr.created_at < NOW() - INTERVAL %s SECOND
+                    AND sr.created_at > NOW() - INTERVAL %s SECOND
+                    AND NOT EXISTS (
+                        SELECT 1 FROM mpesa_callback_inbox i
+                        WHERE i.checkout_request_id = sr.checkout_request_id
+                        AND i.status IN ('pending', 'processing')
+                    )
+                    ORDER BY sr.created_at ASC
+                    LIMIT %s
+                """, (STK_RECONCILE_AFTER, STK_RECONCILE_MAX_AGE, STK_RECONCILE_BATCH))
+                pending = cursor.fetchall()
+                connection.commit()
+                
+                def check(row):
+                    # Pushes sent before jobs recorded the shortcode can only be queried in sandbox
+                    shortcode = row['shortcode'] or (MPESA_SANDBOX_PAYBILL if MPESA_ENVIRONMENT == 'sandbox' else None)
+                    if not shortcode:
+                        return row, None
+                    try:
+                        return row, query_stk_push_status(shortcode, row['checkout_request_id'])
+                    except Exception as e:
+                        print(f"STK query for {row['checkout_request_id']} failed: {e}")
+                        return row, None
+                
+                with concurrent.futures.ThreadPoolExecutor(max_workers=STK_RECONCILE_CONCURRENCY) as executor:
+                    results = list(executor.map(check, pending))
+                
+                summary['checked'] = len(results)
+                for row, result in results:
+                    if not result:
+                        continue
+                    payload = {'Body': {'stkCallback': {
+                        'MerchantRequestID': result.get('MerchantRequestID', ''),
+                        'CheckoutRequestID': row['checkout_request_id'],
+                        'ResultCode': result.get('ResultCode'),
+                        'ResultDesc': result.get('ResultDesc', ''),
+                        'Source': 'stk_query'
+                    }}}
+                    insert_callback_inbox_entry(cursor, row['checkout_request_id'], None, json.dumps(payload))
+                    summary['resolved'] += 1
+                
+                # Past STK_RECONCILE_MAX_AGE no answer is coming: fail the push so the
+                # order does not stay pending forever
+                cursor.execute("""
+                    SELECT sr.checkout_request_id FROM stk_push_requests sr
+                    WHERE sr.status = 'pending'
+                    AND sr.created_at <= NOW() - INTERVAL %s SECOND
+                    AND NOT EXISTS (
+                        SELECT 1 FROM mpesa_callback_inbox i
+                        WHERE i.checkout_request_id = sr.checkout_request_id
+                        AND i.status IN ('pending', 'processing')
+                    )
+                    ORDER BY sr.created_at ASC
+                    LIMIT %s
+                """, (STK_RECONCILE_MAX_AGE, STK_RECONCILE_BATCH))
+                for row in cursor.fetchall():
+                    payload = {'Body': {'stkCallback': {
+                        'MerchantRequestID': '',
+                        'CheckoutRequestID': row['checkout_request_id'],
+                        'ResultCode': STK_EXPIRED_RESULT_CODE,
+                        'ResultDesc': f'No payment result received within {STK_RECONCILE_MAX_AGE // 60} minutes',
+                        'Source': 'stk_expired'
+                    }}}
+                    insert_callback_inbox_entry(cursor, row['checkout_request_id'], None, json.dumps(payload))
+                    summary['expired'] += 1
+                connection.commit()
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK('kwetu_stk_reconciler')")
+        if summary['resolved'] or summary['expired']:
+            callback_inbox_consumer.notify()
+        return summary
+    except Exception as e:
+        connection.rollback()
+        print(f"Error reconciling STK Push requests: {e}")
+        import traceback
+        traceback.print_exc()
+        return summary
+    finally:
+        connection.close()
+
+class StkReconciler:
+    """Background thread that runs reconcile_pending_stk_requests on a timer."""
+    
+    def __init__(self, interval=STK_RECONCILE_INTERVAL):
+        self.interval = interval
+        self.pid = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """Start the thread once per process (again after a fork)."""
+        if not STK_RECONCILE_ENABLED or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='stk-reconciler', daemon=True).start()
+            self.pid = os.getpid()
+    
+    def _run(self):
+        while True:
+            time_module.sleep(self.interval)
+            summary = reconcile_pending_stk_requests()
+            if summary['resolved']:
+                print(f"STK reconciliation: {summary['resolved']} of {summary['checked']} pending pushes resolved")
+            if summary['expired']:
+                print(f"STK reconciliation: {summary['expired']} pushes expired without a result")
+
+stk_reconciler = StkReconciler()
+
+@app.before_request
+def start_background_workers():
+    """Make sure this process is draining durable job queues and relaying events."""
+    stk_push_workers.start()
+    callback_inbox_consumer.start()
+    stk_reconciler.start()
+    order_event_backend.start()
+    image_backfill_worker.start()
 
 @app.route('/api/shop/stk-callback', methods=['POST'])
 def stk_push_callback():
-    """Handle M-Pesa STK Push callback."""
+    """Handle M-Pesa STK Push callback: store it in the inbox and acknowledge."""
     try:
-        # Log raw request data for debugging
         raw_data = request.get_data(as_text=True)
-        print(f"=== M-Pesa STK Push Callback Received ===")
-        print(f"Raw data: {raw_data}")
-        print(f"Content-Type: {request.content_type}")
-        
-        data = request.get_json()
+        data = request.get_json(silent=True)
         if not data:
             print("Warning: No JSON data received in callback")
             return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'}), 200
         
-        print(f"Parsed JSON: {data}")
-        
-        # Extract callback data - handle different M-Pesa callback formats
-        body = data.get('Body', data)  # Some callbacks send data directly
-        stk_callback = body.get('stkCallback', body)  # Fallback to body if stkCallback doesn't exist
-        
-        # Handle both string and integer result codes
-        result_code_raw = stk_callback.get('ResultCode', '')
-        result_code = int(result_code_raw) if result_code_raw else -1
-        result_desc = stk_callback.get('ResultDesc', '')
-        merchant_request_id = stk_callback.get('MerchantRequestID', '')
-        checkout_request_id = stk_callback.get('CheckoutRequestID', '')
-        customer_message = stk_callback.get('CustomerMessage', '')
-        callback_metadata = stk_callback.get('CallbackMetadata', {})
-        items = callback_metadata.get('Item', [])
-        
-        # Extract transaction details
-        transaction_data = {}
-        for item in items:
-            if isinstance(item, dict):
-                transaction_data[item.get('Name', '')] = item.get('Value', '')
-        
-        mpesa_receipt_number = transaction_data.get('MpesaReceiptNumber', '')
-        transaction_date = transaction_data.get('TransactionDate', '')
-        phone_number = transaction_data.get('PhoneNumber', '')
-        amount = transaction_data.get('Amount', 0)
-        
-        # Build comprehensive message from M-Pesa
-        # ResultDesc contains the main message, CustomerMessage may have additional info
-        mpesa_message = result_desc
-        if customer_message and customer_message != result_desc:
-            mpesa_message = f"{result_desc}. {customer_message}"
+        try:
+            callback = parse_stk_callback(data)
+        except Exception as e:
+            # Keep the raw body anyway; the consumer records why it could not be applied
+            print(f"Unreadable STK Push callback: {e}")
+            callback = {'checkout_request_id': None, 'mpesa_receipt_number': None, 'result_code': None}
         
-        print(f"=== M-Pesa Payment Notification ===")
-        print(f"Result Code: {result_code}")
-        print(f"Result Description: {result_desc}")
-        print(f"Customer Message: {customer_message}")
-        print(f"Full Message: {mpesa_message}")
-        print(f"CheckoutRequestID: {checkout_request_id}")
-        print(f"MerchantRequestID: {merchant_request_id}")
-        print(f"Phone Number: {phone_number}")
-        print(f"Amount: {amount}")
-        print(f"Receipt Number: {mpesa_receipt_number}")
-        print(f"Transaction Date: {transaction_date}")
+        print(f"M-Pesa STK Push callback: CheckoutRequestID={callback['checkout_request_id']}, ResultCode={callback['result_code']}")
         
+        # Only acknowledge once the callback is stored; a non-2xx makes M-Pesa redeliver it
         connection = get_db_connection()
-        if connection:
-            try:
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        SELECT id, order_id FROM stk_push_requests 
-                        WHERE checkout_request_id = %s
-                    """, (checkout_request_id,))
-                    stk_request = cursor.fetchone()
-                    
-                    if stk_request:
-                        order_id = stk_request['order_id']
-                        print(f"Found STK request for order_id: {order_id}")
-                        
-                        if result_code == 0:
-                            print(f"✓ Payment SUCCESS for order {order_id}")
-                            # Payment successful - store full message and update phone number if provided
-                            success_message = mpesa_message or result_desc or "Payment completed successfully"
-                            # Update phone number if provided in callback (may be more accurate)
-                            if phone_number:
-                                cursor.execute("""
-                                    UPDATE stk_push_requests 
-                                    SET status = 'completed', mpesa_receipt_number = %s, 
-                                        transaction_date = %s, result_code = %s, result_desc = %s,
-                                        phone_number = %s, updated_at = NOW()
-                                    WHERE checkout_request_id = %s
-                                """, (mpesa_receipt_number, transaction_date, str(result_code), success_message, phone_number, checkout_request_id))
-                            else:
-                                cursor.execute("""
-                                    UPDATE stk_push_requests 
-                                    SET status = 'completed', mpesa_receipt_number = %s, 
-                                        transaction_date = %s, result_code = %s, result_desc = %s,
-                                        updated_at = NOW()
-                                    WHERE checkout_request_id = %s
-                                """, (mpesa_receipt_number, transaction_date, str(result_code), success_message, checkout_request_id))
-                            
-                            # Update order - check which status column exists
-                            # For package deliveries, keep status as 'PROCESSING'/'preparing' (rider just picks and delivers)
-                            # For other orders, update to 'confirmed'
-                            existing_cols = get_table_columns('orders')
-                            
-                            # Check if this is a package delivery order
-                            cursor.execute("SELECT order_type FROM orders WHERE id = %s", (order_id,))
-                            order_info = cursor.fetchone()
-                            is_package_delivery = order_info and order_info.get('order_type') == 'PACKAGE DELIVERY'
-                            
-                            if 'status' in existing_cols:
-                                if is_package_delivery:
-                                    # Package deliveries stay as PROCESSING - rider just picks and delivers
-                                    cursor.execute("""
-                                        UPDATE orders 
-                                        SET payment_status = 'paid', status = 'PROCESSING', updated_at = NOW()
-                                        WHERE id = %s
-                                    """, (order_id,))
-                                else:
-                                    # Regular orders go to confirmed after payment
-                                    cursor.execute("""
-                                        UPDATE orders 
-                                        SET payment_status = 'paid', status = 'confirmed', updated_at = NOW()
-                                        WHERE id = %s
-                                    """, (order_id,))
-                            # Status column is handled separately
-                            else:
-                                cursor.execute("""
-                                    UPDATE orders 
-                                    SET payment_status = 'paid', updated_at = NOW()
-                                    WHERE id = %s
-                                """, (order_id,))
-                            
-                            print(f"✓ Order {order_id} payment completed! Receipt: {mpesa_receipt_number}")
-                            connection.commit()
-                            print(f"✓ Database updated successfully for order {order_id}")
-                        else:
-                            # Payment failed - store full failure message with reason
-                            print(f"✗ Payment FAILED for order {order_id}. Code: {result_code}, Desc: {result_desc}")
-                            failure_message = mpesa_message or result_desc or f"Payment failed with code {result_code}"
-                            # Update phone number if provided in callback
-                            if phone_number:
-                                cursor.execute("""
-                                    UPDATE stk_push_requests 
-                                    SET status = 'failed', result_code = %s, result_desc = %s, 
-                                        phone_number = %s, updated_at = NOW()
-                                    WHERE checkout_request_id = %s
-                                """, (str(result_code), failure_message, phone_number, checkout_request_id))
-                            else:
-                                cursor.execute("""
-                                    UPDATE stk_push_requests 
-                                    SET status = 'failed', result_code = %s, result_desc = %s, updated_at = NOW()
-                                    WHERE checkout_request_id = %s
-                                """, (str(result_code), failure_message, checkout_request_id))
-                            
-                            # Update order - check which status column exists
-                            existing_cols = get_table_columns('orders')
-                            if 'status' in existing_cols:
-                                cursor.execute("""
-                                    UPDATE orders 
-                                    SET payment_status = 'failed', status = 'cancelled', updated_at = NOW()
-                                    WHERE id = %s
-                                """, (order_id,))
-                            # Status column is handled separately
-                            else:
-                                cursor.execute("""
-                                    UPDATE orders 
-                                    SET payment_status = 'failed', updated_at = NOW()
-                                    WHERE id = %s
-                                """, (order_id,))
-                            
-                            print(f"✗ Order {order_id} payment failed: {result_desc}")
-                        
-                        connection.commit()
-            except Exception as e:
-                connection.rollback()
-                print(f"Error updating order from callback: {e}")
-                import traceback
-                traceback.print_exc()
-            finally:
-                connection.close()
+        if not connection:
+            print(f"Database unavailable, M-Pesa callback not stored: {raw_data}")
+            return jsonify({'ResultCode': 1, 'ResultDesc': 'Temporarily unavailable, retry'}), 503
+        try:
+            with connection.cursor() as cursor:
+                insert_callback_inbox_entry(cursor, callback['checkout_request_id'], callback['mpesa_receipt_number'], raw_data)
+                connection.commit()
+        except Exception as e:
+            connection.rollback()
+            print(f"Error storing M-Pesa callback: {e}")
+            print(f"Raw data: {raw_data}")
+            import traceback
+            traceback.print_exc()
+            return jsonify({'ResultCode': 1, 'ResultDesc': 'Temporarily unavailable, retry'}), 503
+        finally:
+            connection.close()
+        callback_inbox_consumer.notify()
         
-        # Always return success to M-Pesa (they expect 200 OK)
         return jsonify({
             'ResultCode': 0,
             'ResultDesc': 'Callback received successfully'
@@ -3675,11 +5258,7 @@ def stk_push_callback():
         print(f"Error processing STK Push callback: {e}")
         import traceback
         traceback.print_exc()
-        # Still return success to M-Pesa
-        return jsonify({
-            'ResultCode': 0,
-            'ResultDesc': 'Callback received'
-        }), 200
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Temporarily unavailable, retry'}), 503
 
 @app.route('/api/shop/stk-status/<checkout_request_id>', methods=['GET'])
 def check_stk_status(checkout_request_id):
@@ -3693,69 +5272,15 @@ def check_stk_status(checkout_request_id):
     
     try:
         with connection.cursor() as cursor:
-            # Check which status column exists in orders table
-            existing_cols = get_table_columns('orders')
-            if 'status' in existing_cols:
-                status_col = 'o.status'
-            # Use status column only
-            if 'status' in existing_cols:
-                status_col = 'o.status'
-            else:
-                status_col = "NULL"
-            
-            cursor.execute(f"""
-                SELECT sr.status, sr.result_code, sr.result_desc, sr.mpesa_receipt_number,
-                       sr.phone_number, sr.amount,
-                       o.id as order_id, o.order_number, o.payment_status, {status_col} as status
-                FROM stk_push_requests sr
-                JOIN orders o ON sr.order_id = o.id
-                WHERE sr.checkout_request_id = %s
-            """, (checkout_request_id,))
-            
-            result = cursor.fetchone()
+            _, payload = get_stk_status_payload(cursor, checkout_request_id)
             
-            if not result:
+            if not payload:
                 return jsonify({
                     'success': False,
                     'message': 'Payment request not found'
                 }), 404
             
-            status = result['status']
-            payment_status = result['payment_status']
-            
-            if status == 'completed' and payment_status == 'paid':
-                # Success message from M-Pesa
-                success_message = result['result_desc'] or 'Payment completed successfully!'
-                return jsonify({
-                    'success': True,
-                    'status': 'completed',
-                    'message': success_message,
-                    'order_id': result['order_id'],
-                    'order_number': result['order_number'],
-                    'receipt_number': result['mpesa_receipt_number'],
-                    'phone_number': result.get('phone_number', ''),
-                    'amount': float(result.get('amount', 0)) if result.get('amount') else 0
-                })
-            elif status == 'failed':
-                # Failure message with reason from M-Pesa
-                failure_reason = result['result_desc'] or 'Payment failed. Please try again.'
-                return jsonify({
-                    'success': False,
-                    'status': 'failed',
-                    'message': failure_reason,
-                    'reason': failure_reason,
-                    'result_code': result.get('result_code', ''),
-                    'order_id': result['order_id'],
-                    'phone_number': result.get('phone_number', ''),
-                    'amount': float(result.get('amount', 0)) if result.get('amount') else 0
-                })
-            else:
-                return jsonify({
-                    'success': True,
-                    'status': 'pending',
-                    'message': 'Waiting for payment confirmation...',
-                    'order_id': result['order_id']
-                })
+            return jsonify(payload)
     except Exception as e:
         print(f"Error checking STK status: {e}")
         import traceback
@@ -3764,6 +5289,105 @@ def check_stk_status(checkout_request_id):
     finally:
         connection.close()
 
+@app.route('/api/shop/payment-events/<int:order_id>', methods=['GET'])
+def stream_payment_events(order_id):
+    """Server-Sent Events stream of STK Push progress for one of the shop's orders.
+    
+    Each event is a JSON object: type 'job' while the push is queued/being sent,
+    type 'payment' (same fields as stk-status) once M-Pesa accepted it, and a final
+    type 'timeout' if nothing conclusive happened within PAYMENT_STREAM_TIMEOUT.
+    """
+    if not session.get('logged_in') or session.get('user_type') != 'shop':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    
+    shop_id = session.get('shop_id')
+    connection = get_db_connection()
+    if not connection:
+        return jsonify({'success': False, 'message': 'Database connection error'}), 500
+    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM orders WHERE id = %s AND shop_id = %s", (order_id, shop_id))
+            if not cursor.fetchone():
+                return jsonify({'success': False, 'message': 'Order not found'}), 404
+    finally:
+        connection.close()
+    
+    channel = f'shop:{shop_id}'
+    # Subscribe before the first read so nothing published in between is missed
+    subscriber = payment_events.subscribe(channel)
+    
+    def generate():
+        last_event = None
+        try:
+            deadline = time_module.monotonic() + PAYMENT_STREAM_TIMEOUT
+            event = read_order_payment_event(order_id)
+            while True:
+                if event and event.get('order_id') == order_id and event != last_event:
+                    last_event = event
+                    yield f"data: {json.dumps(event, default=str)}\n\n"
+                    if is_final_payment_event(event):
+                        return
+                
+                remaining = deadline - time_module.monotonic()
+                if remaining <= 0:
+                    yield f"data: {json.dumps({'type': 'timeout', 'order_id': order_id})}\n\n"
+                    return
+                
+                try:
+                    event = subscriber.get(timeout=min(PAYMENT_STREAM_RECHECK, remaining))
+                except queue.Empty:
+                    # Nothing published here; the update may have landed in another process
+                    event = read_order_payment_event(order_id)
+                    if event == last_event:
+                        yield ": keep-alive\n\n"
+        finally:
+            payment_events.unsubscribe(channel, subscriber)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/shop/order-events', methods=['GET'])
+def stream_order_events():
+    """Server-Sent Events stream of new orders for the logged-in shop.
+    
+    Each event is {'type': 'order_created', 'order': {...}} with the same order fields
+    as /api/shop/orders/changes. The stream ends after ORDER_STREAM_TIMEOUT and the
+    browser reconnects; clients should catch up from the changes feed on reconnect.
+    """
+    if not session.get('logged_in') or session.get('user_type') != 'shop':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    
+    shop_id = session.get('shop_id')
+    if not shop_id:
+        return jsonify({'success': False, 'message': 'Shop not found'}), 404
+    
+    channel = f'shop:{shop_id}'
+    subscriber = order_events.subscribe(channel)
+    
+    def generate():
+        try:
+            deadline = time_module.monotonic() + ORDER_STREAM_TIMEOUT
+            yield "retry: 3000\n\n"
+            while True:
+                remaining = deadline - time_module.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event = subscriber.get(timeout=min(ORDER_STREAM_KEEPALIVE, remaining))
+                    yield f"data: {json.dumps(event, default=str)}\n\n"
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+        finally:
+            order_events.unsubscribe(channel, subscriber)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 # ==================== DELIVERY SETTINGS API ====================
 
 def convert_time_to_string(time_obj):
@@ -3784,6 +5408,731 @@ def convert_time_to_string(time_obj):
     else:
         return str(time_obj)[:5] if len(str(time_obj)) >= 5 else str(time_obj)
 
+# ==================== DISTANCE HELPERS ====================
+
+EARTH_RADIUS_KM = 6371
+ESTIMATED_SPEED_KMH = 30
+DISTANCE_MATRIX_MAX_CELLS = int(os.getenv('DISTANCE_MATRIX_MAX_CELLS', '250000'))
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km. Accepts scalars or NumPy arrays, which broadcast."""
+    lat1, lon1, lat2, lon2 = (np.asarray(value, dtype=float) for value in (lat1, lon1, lat2, lon2))
+    dlat = np.radians(lat2 - lat1)
+    dlon = np.radians(lon2 - lon1)
+    a = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arcsin(np.sqrt(a))
+
+def estimate_travel_minutes(distance_km):
+    """Rough rider ETA at 30 km/h, clamped to 10-60 minutes. Works on arrays too."""
+    minutes = np.trunc(np.asarray(distance_km, dtype=float) / ESTIMATED_SPEED_KMH * 60).astype(int)
+    return np.clip(minutes, 10, 60)
+
+# ==================== SHOP SPATIAL INDEX ====================
+# Open shops with coordinates are bucketed into a grid of roughly SHOP_INDEX_CELL_KM
+# cells per category, so "nearest shops" only measures shops in nearby cells.
+# update_shop/update_shop_status rebuild it; other workers reload after SHOP_INDEX_TTL.
+
+KM_PER_DEGREE_LAT = 111.32
+SHOP_INDEX_CELL_KM = float(os.getenv('SHOP_INDEX_CELL_KM', '2'))
+SHOP_INDEX_TTL = int(os.getenv('SHOP_INDEX_TTL', '300'))
+SHOP_NEARBY_RADIUS_KM = float(os.getenv('SHOP_NEARBY_RADIUS_KM', '10'))
+SHOP_NEARBY_LIMIT = int(os.getenv('SHOP_NEARBY_LIMIT', '10'))
+
+class ShopSpatialIndex:
+    """Grid index over open shop coordinates, bucketed per category."""
+    
+    def __init__(self, shops, cell_km=SHOP_INDEX_CELL_KM):
+        self.cell_deg = cell_km / KM_PER_DEGREE_LAT
+        self.shops = []
+        self.cells = {}  # category -> {(row, col): [position, ...]}
+        for shop in shops:
+            if shop.get('latitude') is None or shop.get('longitude') is None:
+                continue
+            shop = dict(shop)
+            shop['category'] = shop.get('category') or 'UNCATEGORIZED'
+            shop['latitude'] = float(shop['latitude'])
+            shop['longitude'] = float(shop['longitude'])
+            position = len(self.shops)
+            self.shops.append(shop)
+            cell = self._cell(shop['latitude'], shop['longitude'])
+            self.cells.setdefault(shop['category'], {}).setdefault(cell, []).append(position)
+        self.latitudes = np.array([shop['latitude'] for shop in self.shops], dtype=float)
+        self.longitudes = np.array([shop['longitude'] for shop in self.shops], dtype=float)
+        self.loaded_at = time_module.monotonic()
+    
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+    
+    def is_expired(self):
+        return time_module.monotonic() - self.loaded_at > SHOP_INDEX_TTL
+    
+    def _candidates(self, cells, lat, lng, radius_km):
+        lat_span = radius_km / KM_PER_DEGREE_LAT
+        lng_span = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+        min_row, min_col = self._cell(lat - lat_span, lng - lng_span)
+        max_row, max_col = self._cell(lat + lat_span, lng + lng_span)
+        window = (max_row - min_row + 1) * (max_col - min_col + 1)
+        positions = []
+        if window > len(cells):
+            # Fewer occupied cells than cells in the window: walk the occupied ones
+            for (row, col), members in cells.items():
+                if min_row <= row <= max_row and min_col <= col <= max_col:
+                    positions.extend(members)
+        else:
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    positions.extend(cells.get((row, col), ()))
+        return positions
+    
+    def nearest(self, lat, lng, radius_km=SHOP_NEARBY_RADIUS_KM, limit=SHOP_NEARBY_LIMIT, category=None):
+        """Return {category: [shop, ...]} with up to `limit` shops per category within
+        radius_km, nearest first. Each shop dict gets a distance_km key."""
+        categories = [category] if category else sorted(self.cells)
+        results = {}
+        for name in categories:
+            positions = self._candidates(self.cells.get(name, {}), lat, lng, radius_km)
+            if not positions:
+                continue
+            positions = np.array(positions)
+            distances = haversine_km(lat, lng, self.latitudes[positions], self.longitudes[positions])
+            within = distances <= radius_km
+            positions, distances = positions[within], distances[within]
+            order = np.argsort(distances, kind='stable')[:limit]
+            if len(order):
+                results[name] = [
+                    dict(self.shops[position], distance_km=round(float(distance), 2))
+                    for position, distance in zip(positions[order].tolist(), distances[order].tolist())
+                ]
+        return results
+
+shop_spatial_index = None
+shop_spatial_index_lock = threading.Lock()
+
+def load_shop_spatial_index(cursor):
+    """Read open shops with an open cursor and index them."""
+    cursor.execute("""
+        SELECT id, name, category, profile_image, status, rating, location_name, latitude, longitude
+        FROM shops
+        WHERE status = 'open' AND latitude IS NOT NULL AND longitude IS NOT NULL
+        ORDER BY rating DESC
+    """)
+    return ShopSpatialIndex(cursor.fetchall())
+
+def refresh_shop_spatial_index(cursor=None):
+    """Rebuild the shop index and swap it in. Returns the new index or None."""
+    global shop_spatial_index
+    try:
+        if cursor is not None:
+            index = load_shop_spatial_index(cursor)
+        else:
+            connection = get_db_connection()
+            if not connection:
+                return None
+            try:
+                with connection.cursor() as own_cursor:
+                    index = load_shop_spatial_index(own_cursor)
+            finally:
+                connection.close()
+    except Exception as e:
+        print(f"Error building shop spatial index: {e}")
+        shop_spatial_index = None
+        return None
+    shop_spatial_index = index
+    return index
+
+def get_shop_spatial_index():
+    """Return the current shop index, building it if missing or expired."""
+    index = shop_spatial_index
+    if index is None or index.is_expired():
+        with shop_spatial_index_lock:
+            index = shop_spatial_index
+            if index is None or index.is_expired():
+                index = refresh_shop_spatial_index()
+    return index
+
+def parse_location_args(args):
+    """Read lat/lng (and optional radius_km, limit, category) from query args.
+    Returns None when no usable location was given."""
+    try:
+        lat = float(args.get('lat', ''))
+        lng = float(args.get('lng', ''))
+    except ValueError:
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lng)) or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    try:
+        radius_km = float(args.get('radius_km', SHOP_NEARBY_RADIUS_KM))
+    except ValueError:
+        radius_km = SHOP_NEARBY_RADIUS_KM
+    # NaN would slip through min/max (every comparison with it is false)
+    radius_km = min(max(radius_km, 0.1), 100) if math.isfinite(radius_km) else SHOP_NEARBY_RADIUS_KM
+    try:
+        limit = min(max(int(args.get('limit', SHOP_NEARBY_LIMIT)), 1), 50)
+    except ValueError:
+        limit = SHOP_NEARBY_LIMIT
+    category = (args.get('category') or '').strip().upper() or None
+    return {'lat': lat, 'lng': lng, 'radius_km': radius_km, 'limit': limit, 'category': category}
+
+# ==================== SHOP SCHEDULES ====================
+# Each shop's order_processing_time and shop_peak_hours are compiled once into a
+# ShopSchedule: sorted, merged minute-of-day peak windows answered with a bisect.
+# The whole book is loaded with two queries, so pages can show an ETA for every
+# listed shop without per-shop reads. Saving order settings recompiles that shop;
+# other workers reload after SHOP_SCHEDULE_TTL.
+
+SHOP_SCHEDULE_TTL = int(os.getenv('SHOP_SCHEDULE_TTL', '300'))
+SHOP_PEAK_PREP_FACTOR = float(os.getenv('SHOP_PEAK_PREP_FACTOR', '1.5'))
+DEFAULT_PROCESSING_MINUTES = 30
+
+class ShopSchedule:
+    """One shop's prep time and peak windows, precompiled for O(log n) lookups."""
+    
+    def __init__(self, processing_minutes=DEFAULT_PROCESSING_MINUTES, peak_hours=()):
+        self.processing_minutes = int(processing_minutes or DEFAULT_PROCESSING_MINUTES)
+        windows = []
+        for start_time, end_time in peak_hours:
+            # Same TIME parsing as the delivery pricing model's surcharge windows
+            start, end = time_to_second_of_day(start_time) // 60, time_to_second_of_day(end_time) // 60
+            if start < end:
+                windows.append((start, end))
+            elif start > end:
+                # Runs past midnight, e.g. 22:00-02:00
+                windows += [(start, MINUTES_PER_DAY), (0, end)]
+        merged = []
+        for start, end in sorted(windows):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.peak_starts = [start for start, _ in merged]
+        self.peak_ends = [end for _, end in merged]
+    
+    def is_peak(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        i = bisect.bisect_right(self.peak_starts, minute) - 1
+        return i >= 0 and minute < self.peak_ends[i]
+    
+    def prep_minutes(self, now=None):
+        if self.is_peak(now):
+            return int(math.ceil(self.processing_minutes * SHOP_PEAK_PREP_FACTOR))
+        return self.processing_minutes
+
+DEFAULT_SHOP_SCHEDULE = ShopSchedule()
+
+class ShopScheduleBook:
+    """Compiled schedules for every shop that has order settings or peak hours."""
+    
+    def __init__(self, settings_rows, peak_rows):
+        peak_hours = {}
+        for row in peak_rows:
+            peak_hours.setdefault(row['shop_id'], []).append((row['start_time'], row['end_time']))
+        processing = {row['shop_id']: row.get('order_processing_time') for row in settings_rows}
+        self.schedules = {
+            shop_id: ShopSchedule(processing.get(shop_id), peak_hours.get(shop_id, ()))
+            for shop_id in set(processing) | set(peak_hours)
+        }
+        self.loaded_at = time_module.monotonic()
+    
+    def is_expired(self):
+        return time_module.monotonic() - self.loaded_at > SHOP_SCHEDULE_TTL
+    
+    def get(self, shop_id):
+        return self.schedules.get(shop_id, DEFAULT_SHOP_SCHEDULE)
+    
+    def replace(self, shop_id, schedule):
+        # Copy-on-write so readers never see a dict being resized
+        schedules = dict(self.schedules)
+        schedules[shop_id] = schedule
+        self.schedules = schedules
+    
+    def eta(self, shop_id, distance_km=None, now=None):
+        """Prep time (peak-adjusted) plus rider travel time when distance_km is known."""
+        schedule = self.get(shop_id)
+        prep_minutes = schedule.prep_minutes(now)
+        travel_minutes = int(estimate_travel_minutes(distance_km)) if distance_km is not None else None
+        return {
+            'is_peak': schedule.is_peak(now),
+            'prep_minutes': prep_minutes,
+            'travel_minutes': travel_minutes,
+            'total_minutes': prep_minutes + (travel_minutes or 0)
+        }
+
+shop_schedule_book = None
+shop_schedule_book_lock = threading.Lock()
+
+def load_shop_schedule_book(cursor):
+    """Read every shop's order settings and peak hours with an open cursor."""
+    cursor.execute("SELECT shop_id, order_processing_time FROM shop_order_settings")
+    settings_rows = cursor.fetchall()
+    cursor.execute("SELECT shop_id, start_time, end_time FROM shop_peak_hours")
+    return ShopScheduleBook(settings_rows, cursor.fetchall())
+
+def refresh_shop_schedule_book():
+    """Rebuild the schedule book and swap it in. Returns the new book or None."""
+    global shop_schedule_book
+    connection = get_db_connection()
+    if not connection:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            book = load_shop_schedule_book(cursor)
+    except Exception as e:
+        print(f"Error building shop schedules: {e}")
+        return None
+    finally:
+        connection.close()
+    shop_schedule_book = book
+    return book
+
+def get_shop_schedule_book():
+    """Return the current schedule book, building it if missing or expired."""
+    book = shop_schedule_book
+    if book is None or book.is_expired():
+        with shop_schedule_book_lock:
+            book = shop_schedule_book
+            if book is None or book.is_expired():
+                book = refresh_shop_schedule_book() or book
+    return book
+
+def refresh_shop_schedule(cursor, shop_id):
+    """Recompile one shop's schedule after its settings were saved."""
+    book = shop_schedule_book
+    if book is None:
+        return
+    cursor.execute("SELECT order_processing_time FROM shop_order_settings WHERE shop_id = %s", (shop_id,))
+    settings = cursor.fetchone()
+    cursor.execute("SELECT start_time, end_time FROM shop_peak_hours WHERE shop_id = %s", (shop_id,))
+    peak_hours = [(row['start_time'], row['end_time']) for row in cursor.fetchall()]
+    book.replace(shop_id, ShopSchedule(settings.get('order_processing_time') if settings else None, peak_hours))
+
+def add_shop_etas(shops_by_category):
+    """Copy of a shop listing with an 'eta' on every shop, using distance_km when the
+    listing has it. The input is left untouched, so cached listings can be passed."""
+    book = get_shop_schedule_book()
+    if not book:
+        return shops_by_category
+    now = datetime.now()
+    return {
+        category: [dict(shop, eta=book.eta(shop['id'], shop.get('distance_km'), now)) for shop in shops]
+        for category, shops in shops_by_category.items()
+    }
+
+# ==================== PAGE CACHE ====================
+# The public index and shop pages cache the data they read from MySQL (shops grouped
+# by category, a shop and its active items) so anonymous browsing rarely needs the
+# database. Live values - ETAs and "full today" - are added per request. Entries
+# expire after PAGE_CACHE_TTL and are dropped by the shop and item edit routes.
+# Backends: 'memory' (per process) or 'file' (PAGE_CACHE_DIR, shared by the workers
+# on one host, so an invalidation in one worker is seen by the others).
+
+PAGE_CACHE_BACKEND = os.getenv('PAGE_CACHE_BACKEND', 'memory').lower()
+PAGE_CACHE_TTL = int(os.getenv('PAGE_CACHE_TTL', '300'))
+PAGE_CACHE_DIR = os.getenv('PAGE_CACHE_DIR', os.path.join('instance', 'page_cache'))
+INDEX_PAGE_KEY = 'page:index'
+
+class MemoryPageCache:
+    """Entries in a dict, private to this process."""
+    
+    def __init__(self, ttl=PAGE_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] > time_module.monotonic():
+            return entry[1]
+        return None
+    
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time_module.monotonic() + self.ttl, value)
+    
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+class FilePageCache:
+    """Pickled entries in a local directory, one file per key; age comes from mtime.
+    Only this app writes the directory, so loading its pickles is safe."""
+    
+    def __init__(self, directory=PAGE_CACHE_DIR, ttl=PAGE_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.pickle')
+    
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time_module.time():
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+    
+    def set(self, key, value):
+        path = self._path(key)
+        # Write then rename, so readers in other workers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing page cache entry {key}: {e}")
+    
+    def delete(self, *keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error removing page cache entry {key}: {e}")
+
+def create_page_cache(name=PAGE_CACHE_BACKEND):
+    if name == 'file':
+        try:
+            return FilePageCache()
+        except OSError as e:
+            print(f"Page cache directory {PAGE_CACHE_DIR} is not usable ({e}), using 'memory'")
+    elif name != 'memory':
+        print(f"Unknown PAGE_CACHE_BACKEND '{name}', using 'memory'")
+    return MemoryPageCache()
+
+page_cache = create_page_cache()
+
+def shop_page_key(shop_id):
+    return f"page:shop:{shop_id}"
+
+def invalidate_shop_pages(shop_id=None, index=True):
+    """Drop cached public pages after a shop or its items changed."""
+    keys = [INDEX_PAGE_KEY] if index else []
+    if shop_id is not None:
+        keys.append(shop_page_key(shop_id))
+    page_cache.delete(*keys)
+
+# ==================== CONDITIONAL GET ====================
+# Public pages carry a strong ETag (and Last-Modified) so repeat views are answered
+# with 304 Not Modified before anything is rendered. The ETag hashes the validators
+# captured with the page data (latest updated_at and row counts - counts catch
+# deletes), the live values shown on the page and the template version. Data changed
+# within PAGE_SETTLE_SECONDS gets no validators: TIMESTAMPs only have whole seconds,
+# so two edits in the same second would otherwise share an ETag.
+
+PAGE_SETTLE_SECONDS = 2
+
+template_versions = {}
+
+def template_version(*names):
+    """Modification times of the given templates, read once per process."""
+    if names not in template_versions:
+        mtimes = []
+        for name in names:
+            try:
+                mtimes.append(str(os.path.getmtime(os.path.join(app.root_path, app.template_folder, name))))
+            except OSError:
+                mtimes.append('0')
+        template_versions[names] = '|'.join(mtimes)
+    return template_versions[names]
+
+def page_validators(timestamps, row_count, db_now):
+    """Return (validator, last_modified) for loaded page data, or (None, None) while
+    its latest change is too recent to tell apart from the next one."""
+    stamps = [stamp for stamp in timestamps if stamp]
+    last_modified = max(stamps) if stamps else None
+    if last_modified and db_now and (db_now - last_modified).total_seconds() < PAGE_SETTLE_SECONDS:
+        return None, None
+    return '|'.join([str(stamp) for stamp in timestamps] + [str(row_count)]), last_modified
+
+def page_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def conditional_page(etag, last_modified, render):
+    """Answer 304 when the client's copy matches, else render. render() is only called
+    when a body is needed."""
+    if etag is None:
+        return render()
+    if last_modified:
+        last_modified = last_modified.astimezone()  # TIMESTAMPs come back in server local time
+    if request.if_none_match:
+        unmodified = request.if_none_match.contains(etag)
+    elif last_modified and request.if_modified_since:
+        unmodified = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        unmodified = False
+    response = Response(status=304) if unmodified else Response(render())
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Let browsers keep the page but check back every time
+    response.cache_control.no_cache = True
+    return response
+
+# ==================== DELIVERY PRICING MODEL ====================
+# Quotes are computed from an in-memory copy of the delivery_* tables. The admin
+# delivery-settings handlers rebuild and swap it after every write; other workers
+# pick changes up once DELIVERY_PRICING_TTL seconds have passed.
+
+DELIVERY_PRICING_TTL = int(os.getenv('DELIVERY_PRICING_TTL', '60'))
+DELIVERY_QUOTE_BATCH_LIMIT = int(os.getenv('DELIVERY_QUOTE_BATCH_LIMIT', '5000'))
+MINUTES_PER_DAY = 24 * 60
+
+def time_to_second_of_day(time_obj):
+    """Convert a TIME column value (time/timedelta/str) to seconds after midnight."""
+    if isinstance(time_obj, timedelta):
+        return int(time_obj.total_seconds()) % (MINUTES_PER_DAY * 60)
+    if isinstance(time_obj, (time, datetime)):
+        return time_obj.hour * 3600 + time_obj.minute * 60 + time_obj.second
+    parts = [int(part) for part in str(time_obj).split(':')]
+    while len(parts) < 3:
+        parts.append(0)
+    return (parts[0] * 3600 + parts[1] * 60 + parts[2]) % (MINUTES_PER_DAY * 60)
+
+class IntervalTable:
+    """Lookup table for inclusive [low, high] ranges.
+    
+    The ranges are cut into elementary segments at every boundary so a lookup is a
+    single bisect. Where ranges touch or overlap, the one with the lowest start wins,
+    matching the ORDER BY start ASC LIMIT 1 queries this replaces.
+    """
+    
+    def __init__(self, ranges):
+        ranges = sorted(ranges, key=lambda r: r[0])
+        self.points = sorted({bound for low, high, _ in ranges for bound in (low, high)})
+        self.point_values = [self._match(ranges, point) for point in self.points]
+        self.gap_values = [
+            self._match(ranges, (self.points[i] + self.points[i + 1]) / 2)
+            for i in range(len(self.points) - 1)
+        ]
+        # Array copies for lookup_many(); NaN marks "no range"
+        self.points_array = np.array(self.points, dtype=float)
+        self.point_values_array = np.array([np.nan if v is None else v for v in self.point_values], dtype=float)
+        self.gap_values_array = np.array([np.nan if v is None else v for v in self.gap_values], dtype=float)
+    
+    @staticmethod
+    def _match(ranges, value):
+        for low, high, result in ranges:
+            if low <= value <= high:
+                return result
+        return None
+    
+    def lookup(self, value):
+        index = bisect.bisect_left(self.points, value)
+        if index < len(self.points) and self.points[index] == value:
+            return self.point_values[index]
+        if 0 < index < len(self.points):
+            return self.gap_values[index - 1]
+        return None
+    
+    def lookup_many(self, values):
+        """Vectorized lookup(); returns a float array with NaN where no range matches."""
+        values = np.asarray(values, dtype=float)
+        result = np.full(values.shape, np.nan)
+        count = len(self.points_array)
+        if count == 0:
+            return result
+        index = np.searchsorted(self.points_array, values, side='left')
+        clipped = np.minimum(index, count - 1)
+        exact = (index < count) & (self.points_array[clipped] == values)
+        result[exact] = self.point_values_array[clipped[exact]]
+        in_gap = ~exact & (index > 0) & (index < count)
+        result[in_gap] = self.gap_values_array[index[in_gap] - 1]
+        return result
+
+def build_surcharge_table(rows, percentage_field):
+    """Expand peak/night hour rows into a percentage for every minute of the day.
+    
+    Ranges are inclusive and may cross midnight; the first row that covers a minute
+    wins, as in the original per-request scan.
+    """
+    table = [None] * MINUTES_PER_DAY
+    for row in reversed(rows):
+        start = time_to_second_of_day(row['start_time'])
+        end = time_to_second_of_day(row['end_time'])
+        percentage = float(row[percentage_field])
+        for minute in range(MINUTES_PER_DAY):
+            second = minute * 60
+            if start <= end:
+                covered = start <= second <= end
+            else:
+                covered = second >= start or second <= end
+            if covered:
+                table[minute] = percentage
+    return table
+
+class DeliveryPricingModel:
+    """Compiled delivery pricing rules; quote() does no database work."""
+    
+    def __init__(self, settings=None, distance_tiers=(), weight_tiers=(), peak_hours=(), night_hours=()):
+        if settings:
+            self.minimum_fee = float(settings['minimum_fee'])
+            self.weather_fee = float(settings['weather_fee'])
+            self.priority_percentage = float(settings['priority_percentage'])
+        else:
+            # Default values if no settings exist
+            self.minimum_fee = 150.00
+            self.weather_fee = 0.00
+            self.priority_percentage = 0.00
+        
+        self.distance_tiers = IntervalTable([
+            (float(t['start_km']), float(t['end_km']), float(t['price_per_km'])) for t in distance_tiers
+        ])
+        self.weight_tiers = IntervalTable([
+            (float(t['min_kg']), float(t['max_kg']), float(t['fee_amount'])) for t in weight_tiers
+        ])
+        self.peak_table = build_surcharge_table(list(peak_hours), 'percentage_increase')
+        self.night_table = build_surcharge_table(list(night_hours), 'night_percentage')
+        self.peak_array = np.array([np.nan if v is None else v for v in self.peak_table], dtype=float)
+        self.night_array = np.array([np.nan if v is None else v for v in self.night_table], dtype=float)
+        self.loaded_at = time_module.monotonic()
+    
+    def is_expired(self):
+        return time_module.monotonic() - self.loaded_at > DELIVERY_PRICING_TTL
+    
+    @staticmethod
+    def delivery_minute(delivery_time):
+        if isinstance(delivery_time, str):
+            parsed = datetime.strptime(delivery_time, '%H:%M')
+            return parsed.hour * 60 + parsed.minute
+        return delivery_time.hour * 60 + delivery_time.minute
+    
+    def quote(self, distance_km, weight_kg=0, is_weather=False, is_priority=False, tip=0, delivery_time=None):
+        price_per_km = self.distance_tiers.lookup(distance_km)
+        if price_per_km is None:
+            # Default price if no tier matches
+            price_per_km = 10.00
+        
+        base_cost = max(self.minimum_fee, distance_km * price_per_km)
+        
+        weight_fee = 0.00
+        if weight_kg > 0:
+            weight_fee = self.weight_tiers.lookup(weight_kg) or 0.00
+        
+        priority_fee = base_cost * (self.priority_percentage / 100) if is_priority else 0.00
+        
+        peak_fee = 0.00
+        night_fee = 0.00
+        if delivery_time:
+            try:
+                minute = self.delivery_minute(delivery_time)
+                peak_percentage = self.peak_table[minute]
+                night_percentage = self.night_table[minute]
+                if peak_percentage is not None:
+                    peak_fee = base_cost * (peak_percentage / 100)
+                if night_percentage is not None:
+                    night_fee = base_cost * (night_percentage / 100)
+            except Exception as e:
+                print(f"Error calculating peak/night fee: {e}")
+        
+        weather_fee = self.weather_fee if is_weather else 0
+        total = base_cost + weather_fee + weight_fee + priority_fee + peak_fee + night_fee + tip
+        
+        return {
+            'base_cost': round(base_cost, 2),
+            'weather_fee': round(weather_fee, 2),
+            'weight_fee': round(weight_fee, 2),
+            'priority_fee': round(priority_fee, 2),
+            'peak_fee': round(peak_fee, 2),
+            'night_fee': round(night_fee, 2),
+            'tip': round(tip, 2),
+            'total': round(total, 2)
+        }
+    
+    def quote_many(self, distance_km, weight_kg, is_weather, is_priority, tip, delivery_minute):
+        """Price many legs at once. Arguments are equal-length sequences; delivery_minute
+        is minutes after midnight, or -1 when no peak/night surcharge applies.
+        Returns a list of breakdowns in the same shape as quote()."""
+        distance_km = np.asarray(distance_km, dtype=float)
+        weight_kg = np.asarray(weight_kg, dtype=float)
+        is_weather = np.asarray(is_weather, dtype=bool)
+        is_priority = np.asarray(is_priority, dtype=bool)
+        tip = np.asarray(tip, dtype=float)
+        delivery_minute = np.asarray(delivery_minute, dtype=int)
+        
+        price_per_km = self.distance_tiers.lookup_many(distance_km)
+        price_per_km = np.where(np.isnan(price_per_km), 10.00, price_per_km)
+        base_cost = np.maximum(self.minimum_fee, distance_km * price_per_km)
+        
+        weight_fee = np.nan_to_num(self.weight_tiers.lookup_many(weight_kg))
+        weight_fee = np.where(weight_kg > 0, weight_fee, 0.00)
+        
+        priority_fee = np.where(is_priority, base_cost * (self.priority_percentage / 100), 0.00)
+        weather_fee = np.where(is_weather, self.weather_fee, 0.00)
+        
+        has_time = delivery_minute >= 0
+        minute = np.clip(delivery_minute, 0, MINUTES_PER_DAY - 1)
+        peak_percentage = np.where(has_time, np.nan_to_num(self.peak_array[minute]), 0.00)
+        night_percentage = np.where(has_time, np.nan_to_num(self.night_array[minute]), 0.00)
+        peak_fee = base_cost * (peak_percentage / 100)
+        night_fee = base_cost * (night_percentage / 100)
+        
+        total = base_cost + weather_fee + weight_fee + priority_fee + peak_fee + night_fee + tip
+        
+        columns = (base_cost, weather_fee, weight_fee, priority_fee, peak_fee, night_fee, tip, total)
+        names = ('base_cost', 'weather_fee', 'weight_fee', 'priority_fee', 'peak_fee', 'night_fee', 'tip', 'total')
+        return [
+            {name: round(float(value), 2) for name, value in zip(names, row)}
+            for row in zip(*(column.tolist() for column in columns))
+        ]
+
+delivery_pricing_model = None
+delivery_pricing_lock = threading.Lock()
+
+def load_delivery_pricing_model(cursor):
+    """Read the delivery_* tables with an open cursor and compile them."""
+    cursor.execute("SELECT * FROM delivery_settings ORDER BY id DESC LIMIT 1")
+    settings = cursor.fetchone()
+    cursor.execute("SELECT start_km, end_km, price_per_km FROM delivery_distance_tiers")
+    distance_tiers = cursor.fetchall()
+    cursor.execute("SELECT min_kg, max_kg, fee_amount FROM delivery_weight_tiers")
+    weight_tiers = cursor.fetchall()
+    cursor.execute("SELECT start_time, end_time, percentage_increase FROM delivery_peak_hours ORDER BY id ASC")
+    peak_hours = cursor.fetchall()
+    cursor.execute("SELECT start_time, end_time, night_percentage FROM delivery_night_hours ORDER BY id ASC")
+    night_hours = cursor.fetchall()
+    return DeliveryPricingModel(settings, distance_tiers, weight_tiers, peak_hours, night_hours)
+
+def refresh_delivery_pricing_model(cursor=None):
+    """Rebuild the pricing model and swap it in. Returns the new model or None."""
+    global delivery_pricing_model
+    try:
+        if cursor is not None:
+            model = load_delivery_pricing_model(cursor)
+        else:
+            connection = get_db_connection()
+            if not connection:
+                return None
+            try:
+                with connection.cursor() as own_cursor:
+                    model = load_delivery_pricing_model(own_cursor)
+            finally:
+                connection.close()
+    except Exception as e:
+        print(f"Error loading delivery pricing model: {e}")
+        # Drop the old copy so the next quote retries the load
+        delivery_pricing_model = None
+        return None
+    delivery_pricing_model = model
+    return model
+
+def get_delivery_pricing_model():
+    """Return the current pricing model, loading it if missing or expired."""
+    model = delivery_pricing_model
+    if model is None or model.is_expired():
+        with delivery_pricing_lock:
+            model = delivery_pricing_model
+            if model is None or model.is_expired():
+                model = refresh_delivery_pricing_model()
+    return model
+
 def calculate_delivery_cost(distance_km, weight_kg=0, is_weather=False, is_priority=False, tip=0, delivery_time=None):
     """
     Calculate delivery cost using the formula:
@@ -3794,151 +6143,15 @@ def calculate_delivery_cost(distance_km, weight_kg=0, is_weather=False, is_prior
     - WeightFee = fee from matching weight tier
     - PriorityFee = base_cost * (priority_percentage / 100)
     """
-    connection = get_db_connection()
-    if not connection:
+    model = get_delivery_pricing_model()
+    if not model:
         return None
     
     try:
-        with connection.cursor() as cursor:
-            # Get main delivery settings
-            cursor.execute("SELECT * FROM delivery_settings ORDER BY id DESC LIMIT 1")
-            settings = cursor.fetchone()
-            
-            if not settings:
-                # Default values if no settings exist
-                minimum_fee = 150.00
-                weather_fee = 0.00
-                priority_percentage = 0.00
-            else:
-                minimum_fee = float(settings['minimum_fee'])
-                weather_fee = float(settings['weather_fee'])
-                priority_percentage = float(settings['priority_percentage'])
-            
-            # Get price per km from distance tiers
-            cursor.execute("""
-                SELECT price_per_km 
-                FROM delivery_distance_tiers 
-                WHERE start_km <= %s AND end_km >= %s
-                ORDER BY start_km ASC
-                LIMIT 1
-            """, (distance_km, distance_km))
-            
-            tier = cursor.fetchone()
-            if tier:
-                price_per_km = float(tier['price_per_km'])
-            else:
-                # Default price if no tier matches
-                price_per_km = 10.00
-            
-            # Calculate base cost
-            base_cost = max(minimum_fee, distance_km * price_per_km)
-            
-            # Get weight fee
-            weight_fee = 0.00
-            if weight_kg > 0:
-                cursor.execute("""
-                    SELECT fee_amount 
-                    FROM delivery_weight_tiers 
-                    WHERE min_kg <= %s AND max_kg >= %s
-                    ORDER BY min_kg ASC
-                    LIMIT 1
-                """, (weight_kg, weight_kg))
-                weight_tier = cursor.fetchone()
-                if weight_tier:
-                    weight_fee = float(weight_tier['fee_amount'])
-            
-            # Calculate priority fee
-            priority_fee = base_cost * (priority_percentage / 100) if is_priority else 0.00
-            
-            # Calculate peak fee (check if delivery_time falls in any peak hour range)
-            peak_fee = 0.00
-            if delivery_time:
-                from datetime import datetime, time
-                try:
-                    if isinstance(delivery_time, str):
-                        delivery_time_obj = datetime.strptime(delivery_time, '%H:%M').time()
-                    else:
-                        delivery_time_obj = delivery_time if isinstance(delivery_time, time) else delivery_time.time()
-                    
-                    cursor.execute("SELECT * FROM delivery_peak_hours")
-                    peak_hours = cursor.fetchall()
-                    
-                    for peak in peak_hours:
-                        peak_start = peak['start_time'] if isinstance(peak['start_time'], time) else datetime.strptime(str(peak['start_time']), '%H:%M:%S').time()
-                        peak_end = peak['end_time'] if isinstance(peak['end_time'], time) else datetime.strptime(str(peak['end_time']), '%H:%M:%S').time()
-                        peak_percentage = float(peak['percentage_increase'])
-                        
-                        # Handle time ranges that cross midnight
-                        if peak_start <= peak_end:
-                            # Normal range (e.g., 09:00 to 17:00)
-                            if peak_start <= delivery_time_obj <= peak_end:
-                                peak_fee = base_cost * (peak_percentage / 100)
-                                break
-                        else:
-                            # Range crosses midnight (e.g., 22:00 to 06:00)
-                            if delivery_time_obj >= peak_start or delivery_time_obj <= peak_end:
-                                peak_fee = base_cost * (peak_percentage / 100)
-                                break
-                except Exception as e:
-                    print(f"Error calculating peak fee: {e}")
-            
-            # Calculate night fee (check if delivery_time falls in night hour range)
-            night_fee = 0.00
-            if delivery_time:
-                try:
-                    if isinstance(delivery_time, str):
-                        delivery_time_obj = datetime.strptime(delivery_time, '%H:%M').time()
-                    else:
-                        delivery_time_obj = delivery_time if isinstance(delivery_time, time) else delivery_time.time()
-                    
-                    cursor.execute("SELECT * FROM delivery_night_hours")
-                    night_hours = cursor.fetchall()
-                    
-                    for night in night_hours:
-                        night_start = night['start_time'] if isinstance(night['start_time'], time) else datetime.strptime(str(night['start_time']), '%H:%M:%S').time()
-                        night_end = night['end_time'] if isinstance(night['end_time'], time) else datetime.strptime(str(night['end_time']), '%H:%M:%S').time()
-                        night_percentage = float(night['night_percentage'])
-                        
-                        # Handle time ranges that cross midnight
-                        if night_start <= night_end:
-                            # Normal range
-                            if night_start <= delivery_time_obj <= night_end:
-                                night_fee = base_cost * (night_percentage / 100)
-                                break
-                        else:
-                            # Range crosses midnight
-                            if delivery_time_obj >= night_start or delivery_time_obj <= night_end:
-                                night_fee = base_cost * (night_percentage / 100)
-                                break
-                except Exception as e:
-                    print(f"Error calculating night fee: {e}")
-            
-            # Calculate total
-            total = (
-                base_cost +
-                (weather_fee if is_weather else 0) +
-                weight_fee +
-                priority_fee +
-                peak_fee +
-                night_fee +
-                tip
-            )
-            
-            return {
-                'base_cost': round(base_cost, 2),
-                'weather_fee': round(weather_fee if is_weather else 0, 2),
-                'weight_fee': round(weight_fee, 2),
-                'priority_fee': round(priority_fee, 2),
-                'peak_fee': round(peak_fee, 2),
-                'night_fee': round(night_fee, 2),
-                'tip': round(tip, 2),
-                'total': round(total, 2)
-            }
+        return model.quote(distance_km, weight_kg, is_weather, is_priority, tip, delivery_time)
     except Exception as e:
         print(f"Error calculating delivery cost: {e}")
         return None
-    finally:
-        connection.close()
 
 @app.route('/api/admin/delivery-settings', methods=['GET'])
 def get_delivery_settings():
@@ -4048,6 +6261,7 @@ def update_delivery_settings():
                 """, (minimum_fee, weather_fee, priority_percentage))
             
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Settings updated successfully'})
     except Exception as e:
         print(f"Error updating delivery settings: {e}")
@@ -4152,6 +6366,7 @@ def add_distance_tier():
                 VALUES (%s, %s, %s)
             """, (start_km, end_km, price_per_km))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Distance tier added successfully'})
     except Exception as e:
         print(f"Error adding distance tier: {e}")
@@ -4190,6 +6405,7 @@ def update_distance_tier(tier_id):
                 WHERE id = %s
             """, (start_km, end_km, price_per_km, tier_id))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Distance tier updated successfully'})
     except Exception as e:
         print(f"Error updating distance tier: {e}")
@@ -4214,6 +6430,7 @@ def delete_distance_tier(tier_id):
         with connection.cursor() as cursor:
             cursor.execute("DELETE FROM delivery_distance_tiers WHERE id = %s", (tier_id,))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Distance tier deleted successfully'})
     except Exception as e:
         print(f"Error deleting distance tier: {e}")
@@ -4318,6 +6535,7 @@ def add_weight_tier():
                 VALUES (%s, %s, %s)
             """, (min_kg, max_kg, fee_amount))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Weight tier added successfully'})
     except Exception as e:
         print(f"Error adding weight tier: {e}")
@@ -4356,6 +6574,7 @@ def update_weight_tier(tier_id):
                 WHERE id = %s
             """, (min_kg, max_kg, fee_amount, tier_id))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Weight tier updated successfully'})
     except Exception as e:
         print(f"Error updating weight tier: {e}")
@@ -4380,6 +6599,7 @@ def delete_weight_tier(tier_id):
         with connection.cursor() as cursor:
             cursor.execute("DELETE FROM delivery_weight_tiers WHERE id = %s", (tier_id,))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Weight tier deleted successfully'})
     except Exception as e:
         print(f"Error deleting weight tier: {e}")
@@ -4525,6 +6745,7 @@ def add_peak_hour():
                 VALUES (%s, %s, %s)
             """, (start_time, end_time, percentage_increase))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Peak hour range added successfully'})
     except Exception as e:
         print(f"Error adding peak hour: {e}")
@@ -4563,6 +6784,7 @@ def update_peak_hour(hour_id):
                 WHERE id = %s
             """, (start_time, end_time, percentage_increase, hour_id))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Peak hour range updated successfully'})
     except Exception as e:
         print(f"Error updating peak hour: {e}")
@@ -4587,6 +6809,7 @@ def delete_peak_hour(hour_id):
         with connection.cursor() as cursor:
             cursor.execute("DELETE FROM delivery_peak_hours WHERE id = %s", (hour_id,))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Peak hour range deleted successfully'})
     except Exception as e:
         print(f"Error deleting peak hour: {e}")
@@ -4660,6 +6883,7 @@ def add_night_hour():
                 VALUES (%s, %s, %s)
             """, (start_time, end_time, night_percentage))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Night hour range added successfully'})
     except Exception as e:
         print(f"Error adding night hour: {e}")
@@ -4698,6 +6922,7 @@ def update_night_hour(hour_id):
                 WHERE id = %s
             """, (start_time, end_time, night_percentage, hour_id))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Night hour range updated successfully'})
     except Exception as e:
         print(f"Error updating night hour: {e}")
@@ -4722,6 +6947,7 @@ def delete_night_hour(hour_id):
         with connection.cursor() as cursor:
             cursor.execute("DELETE FROM delivery_night_hours WHERE id = %s", (hour_id,))
             connection.commit()
+            refresh_delivery_pricing_model(cursor)
             return jsonify({'success': True, 'message': 'Night hour range deleted successfully'})
     except Exception as e:
         print(f"Error deleting night hour: {e}")
@@ -4729,22 +6955,19 @@ def delete_night_hour(hour_id):
     finally:
         connection.close()
 
-@app.route('/api/admin/delivery-settings/calculate', methods=['POST'])
-def calculate_delivery_cost_api():
-    """Calculate delivery cost using the formula."""
-    data = request.get_json()
-    
+def parse_delivery_quote_input(data):
+    """Validate one quote request body. Returns (arguments, error_message)."""
     # Distance is required
     distance_km = data.get('distance_km')
     if distance_km is None or distance_km == '':
-        return jsonify({'success': False, 'message': 'Distance is required'}), 400
+        return None, 'Distance is required'
     
     try:
         distance_km = float(distance_km)
         if distance_km <= 0:
-            return jsonify({'success': False, 'message': 'Distance must be greater than 0'}), 400
+            return None, 'Distance must be greater than 0'
     except (ValueError, TypeError):
-        return jsonify({'success': False, 'message': 'Invalid distance value'}), 400
+        return None, 'Invalid distance value'
     
     # Weight is optional (default to 0)
     weight_kg = 0
@@ -4769,19 +6992,112 @@ def calculate_delivery_cost_api():
     # Delivery time defaults to current time if not provided
     delivery_time = data.get('delivery_time')
     if not delivery_time or delivery_time == '':
-        from datetime import datetime
         delivery_time = datetime.now().strftime('%H:%M')
     
-    is_weather = data.get('is_weather', False)
-    is_priority = data.get('is_priority', False)
+    return {
+        'distance_km': distance_km,
+        'weight_kg': weight_kg,
+        'is_weather': data.get('is_weather', False),
+        'is_priority': data.get('is_priority', False),
+        'tip': tip,
+        'delivery_time': delivery_time
+    }, None
+
+@app.route('/api/admin/delivery-settings/calculate', methods=['POST'])
+def calculate_delivery_cost_api():
+    """Calculate delivery cost using the formula."""
+    data = request.get_json()
+    
+    quote_args, error = parse_delivery_quote_input(data)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
     
-    result = calculate_delivery_cost(distance_km, weight_kg, is_weather, is_priority, tip, delivery_time)
+    result = calculate_delivery_cost(**quote_args)
     
     if result:
         return jsonify({'success': True, 'cost': result})
     else:
         return jsonify({'success': False, 'message': 'Error calculating cost'}), 500
 
+@app.route('/api/admin/delivery-settings/calculate-batch', methods=['POST'])
+def calculate_delivery_cost_batch_api():
+    """Price many delivery legs in one request.
+    
+    Body: {"legs": [...]} where each leg takes the same fields as /calculate, or
+    origin_lat/origin_lng/dest_lat/dest_lng in place of distance_km. Results come
+    back in request order; invalid legs get success=false and a message.
+    """
+    data = request.get_json(silent=True) or {}
+    legs = data.get('legs')
+    if not isinstance(legs, list) or not legs:
+        return jsonify({'success': False, 'message': 'legs must be a non-empty list'}), 400
+    if len(legs) > DELIVERY_QUOTE_BATCH_LIMIT:
+        return jsonify({'success': False, 'message': f'At most {DELIVERY_QUOTE_BATCH_LIMIT} legs per request'}), 400
+    
+    results = [None] * len(legs)
+    legs = [leg if isinstance(leg, dict) else {} for leg in legs]
+    
+    # Resolve coordinate legs to distances in one vectorized haversine pass
+    coordinate_fields = ('origin_lat', 'origin_lng', 'dest_lat', 'dest_lng')
+    coordinate_indexes = []
+    coordinates = []
+    for index, leg in enumerate(legs):
+        if leg.get('distance_km') not in (None, '') or not any(leg.get(f) not in (None, '') for f in coordinate_fields):
+            continue
+        try:
+            coordinates.append([float(leg[f]) for f in coordinate_fields])
+            coordinate_indexes.append(index)
+        except (KeyError, ValueError, TypeError):
+            results[index] = {'success': False, 'message': 'Missing coordinates'}
+    if coordinates:
+        coordinates = np.array(coordinates)
+        distances = np.round(haversine_km(coordinates[:, 0], coordinates[:, 1], coordinates[:, 2], coordinates[:, 3]), 2)
+        for index, distance_km in zip(coordinate_indexes, distances.tolist()):
+            legs[index] = dict(legs[index], distance_km=distance_km)
+    
+    priced_indexes = []
+    columns = {'distance_km': [], 'weight_kg': [], 'is_weather': [], 'is_priority': [], 'tip': [], 'delivery_minute': []}
+    for index, leg in enumerate(legs):
+        if results[index] is not None:
+            continue
+        quote_args, error = parse_delivery_quote_input(leg)
+        if error:
+            results[index] = {'success': False, 'message': error}
+            continue
+        try:
+            delivery_minute = DeliveryPricingModel.delivery_minute(quote_args['delivery_time'])
+        except Exception:
+            # Same as the single quote: an unreadable time means no peak/night fee
+            delivery_minute = -1
+        priced_indexes.append(index)
+        columns['distance_km'].append(quote_args['distance_km'])
+        columns['weight_kg'].append(quote_args['weight_kg'])
+        columns['is_weather'].append(bool(quote_args['is_weather']))
+        columns['is_priority'].append(bool(quote_args['is_priority']))
+        columns['tip'].append(quote_args['tip'])
+        columns['delivery_minute'].append(delivery_minute)
+    
+    if priced_indexes:
+        model = get_delivery_pricing_model()
+        if not model:
+            return jsonify({'success': False, 'message': 'Error calculating cost'}), 500
+        try:
+            costs = model.quote_many(**columns)
+        except Exception as e:
+            print(f"Error calculating batch delivery cost: {e}")
+            import traceback
+            traceback.print_exc()
+            return jsonify({'success': False, 'message': 'Error calculating cost'}), 500
+        for index, distance_km, cost in zip(priced_indexes, columns['distance_km'], costs):
+            results[index] = {'success': True, 'distance_km': distance_km, 'cost': cost}
+    
+    return jsonify({
+        'success': True,
+        'count': len(results),
+        'priced': len(priced_indexes),
+        'results': results
+    })
+
 @app.route('/dashboard/shop/items')
 def shop_items():
     """Shop items management page."""
@@ -4910,10 +7226,12 @@ def register_shop_item():
                             INDEX idx_shop_id (shop_id),
                             INDEX idx_category (category),
                             INDEX idx_status (status),
+                            INDEX idx_shop_updated_at (shop_id, updated_at),
                             FOREIGN KEY (shop_id) REFERENCES shops(id) ON DELETE CASCADE
                         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
                     """)
                     connection.commit()
+                    invalidate_schema_capabilities()
 
                 # Insert item
                 cursor.execute("""
@@ -4921,6 +7239,7 @@ def register_shop_item():
                     VALUES (%s, %s, %s, %s, %s, %s, %s, 'active')
                 """, (shop_id, category, item_name, description, price, discount_price, item_image))
                 connection.commit()
+                invalidate_shop_pages(shop_id, index=False)
 
                 return jsonify({
                     'success': True,
@@ -5122,6 +7441,7 @@ def update_shop_item(item_id):
                     WHERE id = %s AND shop_id = %s
                 """, (category, item_name, description, price, discount_price, item_image, item_id, shop_id))
                 connection.commit()
+                invalidate_shop_pages(shop_id, index=False)
 
                 return jsonify({
                     'success': True,
@@ -5167,6 +7487,7 @@ def delete_shop_item(item_id):
             # Delete item
             cursor.execute("DELETE FROM shop_items WHERE id = %s AND shop_id = %s", (item_id, shop_id))
             connection.commit()
+            invalidate_shop_pages(shop_id, index=False)
 
             return jsonify({
                 'success': True,
@@ -5218,6 +7539,7 @@ def toggle_item_status(item_id):
                     WHERE id = %s AND shop_id = %s
                 """, (new_status, item_id, shop_id))
                 connection.commit()
+                invalidate_shop_pages(shop_id, index=False)
 
                 return jsonify({
                     'success': True,
@@ -5440,7 +7762,13 @@ def save_shop_order_settings():
                         VALUES (%s, %s, %s)
                     """, (shop_id, start_time, end_time))
             
+            # Orders that were waiting when auto-confirm was switched on are confirmed now
+            if auto_confirm:
+                auto_confirm_orders(cursor, shop_id=shop_id)
+            
             connection.commit()
+            invalidate_shop_full(shop_id)
+            refresh_shop_schedule(cursor, shop_id)
             return jsonify({'success': True, 'message': 'Order settings saved successfully'})
     except Exception as e:
         connection.rollback()
@@ -5451,6 +7779,565 @@ def save_shop_order_settings():
     finally:
         connection.close()
 
+# ==================== ORDER NUMBERS ====================
+# Order numbers are generated locally, Snowflake-style, with no uniqueness probes:
+# 41 bits of milliseconds since ORDER_NUMBER_EPOCH, a 27-bit worker id unique to this
+# process and a 12-bit per-millisecond sequence, written as 16 Crockford base32
+# characters ("ORD-" + 16 = 20, which fits order_number VARCHAR(20)). Numbers sort by
+# creation time. Worker ids come from ORDER_WORKER_ID, or else from the
+# order_number_workers table (one row per process start).
+
+ORDER_NUMBER_EPOCH = datetime(2025, 1, 1)
+ORDER_NUMBER_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+ORDER_WORKER_ID_BITS = 27
+ORDER_SEQUENCE_BITS = 12
+
+class OrderNumberGenerator:
+    """Thread-safe generator of unique, time-sortable ORD- numbers."""
+    
+    def __init__(self, epoch=ORDER_NUMBER_EPOCH):
+        self.epoch_ms = int(epoch.timestamp() * 1000)
+        self.worker_id = None
+        self.pid = None
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+    
+    def allocate_worker_id(self):
+        configured = os.getenv('ORDER_WORKER_ID')
+        if configured:
+            return int(configured) % (1 << ORDER_WORKER_ID_BITS)
+        connection = get_db_connection()
+        if connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO order_number_workers (hostname, pid) VALUES (%s, %s)
+                    """, (os.uname().nodename[:100], os.getpid()))
+                    worker_row_id = cursor.lastrowid
+                connection.commit()
+                return worker_row_id % (1 << ORDER_WORKER_ID_BITS)
+            except Exception as e:
+                print(f"Error allocating order worker id: {e}")
+            finally:
+                connection.close()
+        # No database: a random id collides with another live process only rarely,
+        # and even then only if both issue a number in the same millisecond
+        print("Warning: using a random order worker id")
+        return int.from_bytes(os.urandom(4), 'big') % (1 << ORDER_WORKER_ID_BITS)
+    
+    def next_id(self):
+        """Next 80-bit id; never repeats within a process, even if the clock steps back."""
+        with self.lock:
+            if self.pid != os.getpid():
+                # New process (or a forked child): never share the parent's worker id
+                self.worker_id = self.allocate_worker_id()
+                self.pid = os.getpid()
+                self.last_ms = -1
+            now_ms = int(time_module.time() * 1000) - self.epoch_ms
+            if now_ms > self.last_ms:
+                self.last_ms = now_ms
+                self.sequence = 0
+            else:
+                self.sequence += 1
+                if self.sequence >> ORDER_SEQUENCE_BITS:
+                    # Sequence exhausted (or clock went back): borrow the next millisecond
+                    self.last_ms += 1
+                    self.sequence = 0
+            return ((self.last_ms << (ORDER_WORKER_ID_BITS + ORDER_SEQUENCE_BITS))
+                    | (self.worker_id << ORDER_SEQUENCE_BITS)
+                    | self.sequence)
+    
+    def next(self):
+        value = self.next_id()
+        chars = []
+        for _ in range(16):
+            chars.append(ORDER_NUMBER_ALPHABET[value & 31])
+            value >>= 5
+        return 'ORD-' + ''.join(reversed(chars))
+
+order_numbers = OrderNumberGenerator()
+
+def generate_order_number():
+    """Return a new unique order number, e.g. ORD-01JQ4Z8K2M0001G0."""
+    return order_numbers.next()
+
+# ==================== ORDER WRITER ====================
+# Every order is written through write_order(). It uses an insert plan compiled once
+# per schema snapshot: the orders/order_items columns that exist, the SQL built from
+# them and the default for each column. Handlers pass plain dicts and never branch on
+# the schema or run DDL.
+
+# (column, default) - a column is written when it exists in the table
+ORDER_COLUMNS = (
+    ('order_number', None),
+    ('shop_id', None),
+    ('customer_id', None),
+    ('customer_name', None),
+    ('customer_phone', None),
+    ('customer_email', None),
+    ('order_type', None),
+    ('status', 'pending'),
+    ('subtotal', 0),
+    ('delivery_fee', 0),
+    ('tax', 0),
+    ('discount', 0),
+    ('total', 0),
+    ('total_amount', 0),
+    ('payment_method', 'cash_on_delivery'),
+    ('payment_status', 'pending'),
+    ('promo_code', None),
+    ('notes', None),
+    ('contactless_delivery', 0),
+)
+
+ORDER_ITEM_COLUMNS = (
+    ('item_id', None),
+    ('item_name', None),
+    ('item_image', None),
+    ('quantity', 1),
+    ('unit_price', 0),
+    ('discount_price', None),
+    ('subtotal', 0),
+    ('price', 0),
+)
+
+class OrderInsertPlan:
+    """INSERT statements for orders and order_items, compiled for one schema snapshot."""
+    
+    def __init__(self, orders_schema, order_items_schema):
+        self.orders_schema = orders_schema
+        self.order_items_schema = order_items_schema
+        self.order_columns = [(column, default) for column, default in ORDER_COLUMNS
+                              if orders_schema.has(column)]
+        self.has_order_number = orders_schema.has('order_number')
+        self.order_sql = self.compile('orders', [column for column, _ in self.order_columns],
+                                      orders_schema.has('created_at'))
+        
+        self.item_columns = [(column, default) for column, default in ORDER_ITEM_COLUMNS
+                             if order_items_schema.has(column)]
+        # Package lines have no catalogue item; older tables need 0 instead of NULL
+        self.item_id_fallback = None if order_items_schema.item_id_nullable else 0
+        self.item_sql = None
+        if order_items_schema.has('order_id'):
+            self.item_sql = self.compile('order_items', ['order_id'] + [column for column, _ in self.item_columns],
+                                         order_items_schema.has('created_at'))
+    
+    @staticmethod
+    def compile(table, columns, has_created_at):
+        values = ['%s'] * len(columns)
+        if has_created_at:
+            columns = columns + ['created_at']
+            values = values + ['NOW()']
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(values)})"
+    
+    def order_values(self, order):
+        values = []
+        for column, default in self.order_columns:
+            if column in ('total', 'total_amount'):
+                # Older tables use total, newer ones total_amount; fill whichever exist
+                value = order.get('total', default)
+            else:
+                value = order.get(column, default)
+            values.append(default if value is None else value)
+        return values
+    
+    def item_values(self, order_id, item):
+        values = [order_id]
+        for column, default in self.item_columns:
+            if column == 'item_id':
+                value = item.get('item_id')
+                values.append(self.item_id_fallback if value is None else value)
+            elif column == 'price':
+                values.append(item.get('unit_price', default))
+            else:
+                value = item.get(column, default)
+                values.append(default if value is None else value)
+        return values
+
+order_insert_plan = None
+
+def get_order_insert_plan():
+    """Return the insert plan for the current schema snapshot, compiling it on first use."""
+    global order_insert_plan
+    orders_schema = get_schema_capabilities('orders')
+    order_items_schema = get_schema_capabilities('order_items')
+    plan = order_insert_plan
+    if plan is None or plan.orders_schema is not orders_schema or plan.order_items_schema is not order_items_schema:
+        plan = OrderInsertPlan(orders_schema, order_items_schema)
+        order_insert_plan = plan
+    return plan
+
+def write_order(cursor, order, items=()):
+    """Insert an order and its items; the caller commits.
+    
+    `order` uses logical field names (shop_id, customer_id, customer_name, order_type,
+    status, total, delivery_fee, payment_method, ...); fields without a column are
+    ignored. An order number is generated unless given. Returns (order_id, order_number),
+    with order_number None on tables that have no order_number column.
+    """
+    plan = get_order_insert_plan()
+    order = dict(order)
+    if plan.has_order_number:
+        order.setdefault('order_number', generate_order_number())
+    else:
+        order['order_number'] = None
+    
+    cursor.execute(plan.order_sql, plan.order_values(order))
+    order_id = cursor.lastrowid
+    
+    if items and plan.item_sql:
+        # PyMySQL sends executemany INSERTs as one multi-row statement
+        cursor.executemany(plan.item_sql, [plan.item_values(order_id, item) for item in items])
+    return order_id, order['order_number']
+
+# ==================== ORDER STATE MACHINE ====================
+# Every status change goes through transition_order(): one conditional UPDATE that
+# only matches while the order is in one of the action's source states (and, when
+# the caller passes the version it read, still at that version). Concurrent actions
+# cannot overwrite each other - the loser updates no row and gets a conflict back.
+
+# action -> (statuses it may start from, status it sets)
+ORDER_TRANSITIONS = {
+    'accept': (('pending', 'PENDING', 'confirmed'), 'preparing'),
+    'auto_confirm': (('pending',), 'preparing'),
+    'pack': (('confirmed', 'preparing', 'PROCESSING'), 'ready'),
+    'reject': (('pending', 'PENDING', 'confirmed'), 'cancelled'),
+    'cancel': (('pending', 'PENDING', 'confirmed', 'preparing', 'PROCESSING', 'ready'), 'cancelled'),
+    'payment_confirmed': (('pending', 'PENDING'), 'confirmed'),
+    'package_paid': (('pending', 'PENDING'), 'PROCESSING'),
+    'payment_failed': (('pending', 'PENDING', 'confirmed', 'preparing', 'PROCESSING'), 'cancelled'),
+}
+
+def order_transition_sql(action, alias=''):
+    """Return (set_sql, set_params, where_sql, where_params) applying `action` to orders."""
+    sources, target = ORDER_TRANSITIONS[action]
+    prefix = f"{alias}." if alias else ''
+    set_sql = f"{prefix}status = %s, {prefix}updated_at = NOW()"
+    if get_schema_capabilities('orders').has_version:
+        set_sql += f", {prefix}version = {prefix}version + 1"
+    where_sql = f"{prefix}status IN ({', '.join(['%s'] * len(sources))})"
+    return set_sql, [target], where_sql, list(sources)
+
+def transition_order(cursor, order_id, action, shop_id=None, version=None, fields=None):
+    """Apply a declared transition to one order in a single UPDATE. The caller commits.
+    
+    `fields` are extra columns set in the same statement (those missing from the
+    schema are skipped). Pass `version` to also require that nobody changed the
+    order since it was read. Returns (new_status, None) on success, otherwise
+    (None, current_status) - current_status is None when there is no such order.
+    """
+    orders_schema = get_schema_capabilities('orders')
+    set_sql, params, where_sql, where_params = order_transition_sql(action)
+    for column, value in (fields or {}).items():
+        if orders_schema.has(column):
+            set_sql += f", {column} = %s"
+            params.append(value)
+    
+    where_sql = f"id = %s AND {where_sql}"
+    params += [order_id] + where_params
+    if shop_id is not None:
+        where_sql += " AND shop_id = %s"
+        params.append(shop_id)
+    if version is not None and orders_schema.has_version:
+        where_sql += " AND version = %s"
+        params.append(version)
+    
+    cursor.execute(f"UPDATE orders SET {set_sql} WHERE {where_sql}", params)
+    if cursor.rowcount:
+        target = ORDER_TRANSITIONS[action][1]
+        if target == 'cancelled':
+            release_daily_order_slot(cursor, order_id)
+        return target, None
+    
+    # Not a legal move from where the order is now (or it moved since it was read)
+    if shop_id is not None:
+        cursor.execute("SELECT status FROM orders WHERE id = %s AND shop_id = %s", (order_id, shop_id))
+    else:
+        cursor.execute("SELECT status FROM orders WHERE id = %s", (order_id,))
+    row = cursor.fetchone()
+    return None, ((row.get('status') or 'unknown') if row else None)
+
+def order_transition_error(current_status, verb):
+    """JSON response for a transition_order() that did not apply."""
+    if current_status is None:
+        return jsonify({'success': False, 'message': 'Order not found'}), 404
+    return jsonify({
+        'success': False,
+        'message': f'Order is {current_status.lower()} and cannot be {verb}. Refresh to see its latest state.',
+        'status': current_status
+    }), 409
+
+# ==================== ORDER AUTO-CONFIRM ====================
+# Shops with shop_order_settings.auto_confirm_order move new orders straight from
+# 'pending' to 'preparing'. This runs inside the transaction that creates the order
+# (and once over the backlog when a shop turns the setting on), not on dashboard views.
+
+def auto_confirm_orders(cursor, order_id=None, shop_id=None):
+    """Move pending orders to 'preparing' for shops that auto-confirm.
+    
+    Pass order_id for a freshly created order or shop_id for a shop's whole
+    backlog. Returns the number of orders updated; the caller commits.
+    """
+    if not get_schema_capabilities('orders').has_status:
+        return 0
+    if order_id is not None:
+        condition, param = "o.id = %s", order_id
+    else:
+        condition, param = "o.shop_id = %s", shop_id
+    set_sql, set_params, where_sql, where_params = order_transition_sql('auto_confirm', alias='o')
+    cursor.execute(f"""
+        UPDATE orders o
+        JOIN shop_order_settings s ON s.shop_id = o.shop_id AND s.auto_confirm_order = 1
+        SET {set_sql}
+        WHERE {condition} AND {where_sql}
+    """, set_params + [param] + where_params)
+    return cursor.rowcount
+
+# ==================== DAILY ORDER CAP ====================
+# shop_order_settings.max_daily_orders is enforced with a per-shop, per-day counter
+# row in shop_daily_order_counts. Each order-creating transaction bumps the row (which
+# locks it until commit), so concurrent checkouts are serialised on that one row and
+# the cap holds without COUNT(*) over orders. Cancelled, rejected and failed-payment
+# orders hand their slot back. Public pages read a short-lived cache.
+
+SHOP_FULL_CACHE_TTL = int(os.getenv('SHOP_FULL_CACHE_TTL', '30'))
+
+shop_full_cache = {}  # shop_id -> (expires_at, full)
+shop_full_cache_lock = threading.Lock()
+
+def remember_shop_full(shop_id, full):
+    with shop_full_cache_lock:
+        shop_full_cache[shop_id] = (time_module.monotonic() + SHOP_FULL_CACHE_TTL, full)
+
+def invalidate_shop_full(shop_id):
+    """Forget the cached answer, e.g. after the shop changed max_daily_orders."""
+    with shop_full_cache_lock:
+        shop_full_cache.pop(shop_id, None)
+
+def reserve_daily_order_slot(cursor, shop_id):
+    """Count one more order for the shop today. Call inside the order transaction.
+    
+    Returns an error message when the shop has reached max_daily_orders; the caller
+    must then roll back, which also undoes the increment.
+    """
+    cursor.execute("""
+        INSERT INTO shop_daily_order_counts (shop_id, order_date, order_count)
+        VALUES (%s, CURDATE(), 1)
+        ON DUPLICATE KEY UPDATE order_count = order_count + 1
+    """, (shop_id,))
+    cursor.execute("""
+        SELECT c.order_count, s.max_daily_orders
+        FROM shop_daily_order_counts c
+        LEFT JOIN shop_order_settings s ON s.shop_id = c.shop_id
+        WHERE c.shop_id = %s AND c.order_date = CURDATE()
+    """, (shop_id,))
+    row = cursor.fetchone()
+    cap = row.get('max_daily_orders') if row else None
+    # The page cache is left alone: this transaction may still roll back
+    if cap and row['order_count'] > cap:
+        return 'This shop has reached its order limit for today. Please try again tomorrow.'
+    return None
+
+def release_daily_order_slot(cursor, order_id):
+    """Give back the slot a cancelled order took on the day it was placed.
+    Call in the same transaction as the cancellation."""
+    cursor.execute("""
+        UPDATE shop_daily_order_counts c
+        JOIN orders o ON o.shop_id = c.shop_id AND c.order_date = DATE(o.created_at)
+        SET c.order_count = c.order_count - 1
+        WHERE o.id = %s AND c.order_count > 0
+    """, (order_id,))
+
+def is_shop_full_today(shop_id, cursor=None):
+    """Whether the shop has taken max_daily_orders orders today (cached briefly).
+    Opens its own connection on a cache miss when no cursor is given."""
+    with shop_full_cache_lock:
+        entry = shop_full_cache.get(shop_id)
+    if entry and entry[0] > time_module.monotonic():
+        return entry[1]
+    
+    if cursor is None:
+        connection = get_db_connection()
+        if not connection:
+            return False
+        try:
+            with connection.cursor() as own_cursor:
+                return is_shop_full_today(shop_id, own_cursor)
+        except Exception as e:
+            print(f"Error checking daily order cap for shop {shop_id}: {e}")
+            return False
+        finally:
+            connection.close()
+    
+    cursor.execute("""
+        SELECT s.max_daily_orders, c.order_count
+        FROM shop_order_settings s
+        LEFT JOIN shop_daily_order_counts c ON c.shop_id = s.shop_id AND c.order_date = CURDATE()
+        WHERE s.shop_id = %s
+    """, (shop_id,))
+    row = cursor.fetchone()
+    full = bool(row and row.get('max_daily_orders') and (row.get('order_count') or 0) >= row['max_daily_orders'])
+    remember_shop_full(shop_id, full)
+    return full
+
+# ==================== SHOP ORDER FEED ====================
+# Shop orders are paged by (created_at, id) rather than LIMIT over a join with
+# order_items. Headers are read first and their items are loaded with one
+# IN (...) query, so every page holds exactly `limit` orders with all their items.
+
+SHOP_ORDER_PAGE_SIZE = int(os.getenv('SHOP_ORDER_PAGE_SIZE', '100'))
+SHOP_ORDER_PAGE_MAX = int(os.getenv('SHOP_ORDER_PAGE_MAX', '200'))
+
+def encode_order_cursor(created_at, order_id):
+    """Opaque keyset cursor for the order after which the next page starts."""
+    raw = f"{created_at.strftime('%Y-%m-%d %H:%M:%S')}|{order_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_order_cursor(value):
+    """Return (created_at, order_id) for a cursor, or None if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode((value + '=' * (-len(value) % 4)).encode()).decode()
+        created_at, order_id = raw.split('|')
+        return datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S'), int(order_id)
+    except ValueError:
+        return None
+
+def shop_order_select_clause():
+    """Return (fields, join) for reading order headers in the current schema."""
+    orders_schema = get_schema_capabilities('orders')
+    fields = ["o.id", "o.order_number", "o.payment_method", "o.payment_status",
+              "o.created_at", "o.updated_at"]
+    if orders_schema.has_order_type and orders_schema.has_customer_id:
+        # New schema with order_type and customer_id
+        fields += ["o.order_type", "o.total_amount AS total",
+                   "c.name AS customer_name", "c.phone AS customer_phone"]
+        join = "LEFT JOIN customers c ON o.customer_id = c.id"
+    else:
+        # Old schema keeps the customer on the order row
+        fields += ["o.total", "o.customer_name", "o.customer_phone"]
+        join = ""
+    for column in ('status', 'pickup_code', 'rider_name', 'rider_phone', 'version'):
+        if orders_schema.has(column):
+            fields.append(f"o.{column}")
+    return ', '.join(fields), join
+
+def build_shop_orders(cursor, rows):
+    """Turn order header rows into dashboard order dicts with their items attached."""
+    orders = []
+    orders_by_id = {}
+    for row in rows:
+        order = {
+            'id': row['id'],
+            'order_number': row.get('order_number') or f"ORD-{row['id']}",
+            'order_type': row.get('order_type', 'REGULAR'),
+            'status': row.get('status', 'pending'),
+            'total': float(row.get('total') or 0),
+            'payment_method': row.get('payment_method', 'cash_on_delivery'),
+            'payment_status': row.get('payment_status', 'pending'),
+            'created_at': row.get('created_at'),
+            'updated_at': row.get('updated_at'),
+            'customer_name': row.get('customer_name') or 'N/A',
+            'customer_phone': row.get('customer_phone') or 'N/A',
+            'pickup_code': row.get('pickup_code'),
+            'rider_name': row.get('rider_name'),
+            'rider_phone': row.get('rider_phone'),
+            'version': row.get('version'),
+            'order_items': []  # Not 'items', which would clash with dict.items() in templates
+        }
+        orders.append(order)
+        orders_by_id[row['id']] = order
+    
+    if orders_by_id:
+        placeholders = ', '.join(['%s'] * len(orders_by_id))
+        cursor.execute(f"""
+            SELECT order_id, item_name, quantity, item_image
+            FROM order_items
+            WHERE order_id IN ({placeholders})
+            ORDER BY id
+        """, list(orders_by_id))
+        for item in cursor.fetchall():
+            if item.get('item_name'):
+                orders_by_id[item['order_id']]['order_items'].append({
+                    'name': item['item_name'],
+                    'quantity': item.get('quantity', 1),
+                    'image': image_variant_filter(item.get('item_image'), 'thumb')
+                })
+    return orders
+
+def serialize_shop_orders(orders):
+    """Format the timestamps in build_shop_orders() output for JSON responses."""
+    for order in orders:
+        for key in ('created_at', 'updated_at'):
+            order[key] = order[key].isoformat() if order.get(key) else None
+    return orders
+
+def load_shop_orders_page(cursor, shop_id, limit=SHOP_ORDER_PAGE_SIZE, after=None):
+    """Load one page of a shop's orders, newest first.
+    
+    `after` is a decoded cursor (created_at, id). Returns (orders, next_cursor);
+    next_cursor is None on the last page.
+    """
+    fields, join = shop_order_select_clause()
+    where = "o.shop_id = %s"
+    params = [shop_id]
+    if after:
+        where += " AND (o.created_at < %s OR (o.created_at = %s AND o.id < %s))"
+        params += [after[0], after[0], after[1]]
+    params.append(limit + 1)
+    
+    cursor.execute(f"""
+        SELECT {fields}
+        FROM orders o
+        {join}
+        WHERE {where}
+        ORDER BY o.created_at DESC, o.id DESC
+        LIMIT %s
+    """, params)
+    rows = cursor.fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_order_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    return build_shop_orders(cursor, rows), next_cursor
+
+def current_order_changes_cursor(cursor, shop_id):
+    """Cursor that makes the changes feed start from the shop's latest order update."""
+    cursor.execute("SELECT MAX(updated_at) AS updated_at FROM orders WHERE shop_id = %s", (shop_id,))
+    row = cursor.fetchone()
+    return encode_order_cursor((row and row.get('updated_at')) or datetime(1970, 1, 1), 0)
+
+def load_shop_order_changes(cursor, shop_id, since, limit=SHOP_ORDER_PAGE_SIZE):
+    """Load orders created or updated after `since` (a decoded (updated_at, id) cursor).
+    
+    Returns (orders, next_cursor, has_more), oldest change first. When the changes
+    are drained the cursor is re-anchored at the start of the newest second seen,
+    because updated_at only has one-second resolution. Rows from that second may
+    come back on the next poll, so clients must apply changes idempotently.
+    """
+    fields, join = shop_order_select_clause()
+    cursor.execute(f"""
+        SELECT {fields}
+        FROM orders o
+        {join}
+        WHERE o.shop_id = %s
+          AND (o.updated_at > %s OR (o.updated_at = %s AND o.id > %s))
+        ORDER BY o.updated_at, o.id
+        LIMIT %s
+    """, (shop_id, since[0], since[0], since[1], limit + 1))
+    rows = cursor.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        next_cursor = encode_order_cursor(since[0], since[1])
+    elif has_more:
+        next_cursor = encode_order_cursor(rows[-1]['updated_at'], rows[-1]['id'])
+    else:
+        next_cursor = encode_order_cursor(rows[-1]['updated_at'], 0)
+    return build_shop_orders(cursor, rows), next_cursor, has_more
+
 @app.route('/dashboard/shop')
 def shop_dashboard():
     """Shop dashboard page."""
@@ -5465,6 +8352,7 @@ def shop_dashboard():
     connection = get_db_connection()
     shop = None
     orders = []
+    orders_cursor = None
     error = None
     
     if connection:
@@ -5479,271 +8367,11 @@ def shop_dashboard():
                 """, (shop_id,))
                 shop = cursor.fetchone()
                 
-                # Get all orders for this shop
-                # Check which columns exist in orders table
-                existing_cols = get_table_columns('orders')
-                has_order_type = 'order_type' in existing_cols if existing_cols else False
-                has_status = 'status' in existing_cols if existing_cols else False
-                has_customer_id = 'customer_id' in existing_cols if existing_cols else False
-                has_total_amount = 'total_amount' in existing_cols if existing_cols else False
-                
-                # Check if pickup_code and rider columns exist
-                has_pickup_code = 'pickup_code' in existing_cols if existing_cols else False
-                has_rider_name = 'rider_name' in existing_cols if existing_cols else False
-                has_rider_phone = 'rider_phone' in existing_cols if existing_cols else False
-                
-                # Build query based on available columns
-                if has_order_type and has_customer_id:
-                    # New schema with order_type and customer_id
-                    if has_status:
-                        rider_fields = ""
-                        if has_rider_name and has_rider_phone:
-                            rider_fields = ", o.rider_name, o.rider_phone"
-                        elif has_rider_name:
-                            rider_fields = ", o.rider_name"
-                        elif has_rider_phone:
-                            rider_fields = ", o.rider_phone"
-                        
-                        pickup_field = ", o.pickup_code" if has_pickup_code else ""
-                        
-                        cursor.execute(f"""
-                            SELECT o.id, o.order_number, o.order_type, o.status, o.total_amount as total,
-                                   o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
-                                   c.name as customer_name, c.phone as customer_phone,
-                                   oi.item_name, oi.quantity, oi.item_image
-                            FROM orders o
-                            LEFT JOIN customers c ON o.customer_id = c.id
-                            LEFT JOIN order_items oi ON o.id = oi.order_id
-                            WHERE o.shop_id = %s
-                            ORDER BY o.created_at DESC
-                            LIMIT 100
-                        """, (shop_id,))
-                    else:
-                        rider_fields = ""
-                        if has_rider_name and has_rider_phone:
-                            rider_fields = ", o.rider_name, o.rider_phone"
-                        elif has_rider_name:
-                            rider_fields = ", o.rider_name"
-                        elif has_rider_phone:
-                            rider_fields = ", o.rider_phone"
-                        
-                        pickup_field = ", o.pickup_code" if has_pickup_code else ""
-                        
-                        cursor.execute(f"""
-                            SELECT o.id, o.order_number, o.order_type, o.total_amount as total,
-                                   o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
-                                   c.name as customer_name, c.phone as customer_phone,
-                                   oi.item_name, oi.quantity, oi.item_image
-                            FROM orders o
-                            LEFT JOIN customers c ON o.customer_id = c.id
-                            LEFT JOIN order_items oi ON o.id = oi.order_id
-                            WHERE o.shop_id = %s
-                            ORDER BY o.created_at DESC
-                            LIMIT 100
-                        """, (shop_id,))
-                else:
-                    # Old schema without order_type
-                        rider_fields = ""
-                        if has_rider_name and has_rider_phone:
-                            rider_fields = ", o.rider_name, o.rider_phone"
-                        elif has_rider_name:
-                            rider_fields = ", o.rider_name"
-                        elif has_rider_phone:
-                            rider_fields = ", o.rider_phone"
-                        
-                        pickup_field = ", o.pickup_code" if has_pickup_code else ""
-                        
-                        cursor.execute(f"""
-                            SELECT o.id, o.order_number, o.total,
-                                   o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
-                                   o.customer_name, o.customer_phone,
-                                   oi.item_name, oi.quantity, oi.item_image
-                            FROM orders o
-                            LEFT JOIN order_items oi ON o.id = oi.order_id
-                            WHERE o.shop_id = %s
-                            ORDER BY o.created_at DESC
-                            LIMIT 100
-                        """, (shop_id,))
-                
-                raw_orders = cursor.fetchall()
-                
-                # Get subtotal and delivery_fee columns if they exist
-                existing_cols = get_table_columns('orders')
-                has_subtotal = 'subtotal' in existing_cols if existing_cols else False
-                has_delivery_fee = 'delivery_fee' in existing_cols if existing_cols else False
-                
-                # Group orders by order_id (since order_items creates multiple rows per order)
-                orders_dict = {}
-                for row in raw_orders:
-                    order_id = row['id']
-                    if order_id not in orders_dict:
-                        # Calculate total without delivery cost
-                        total_amount = float(row.get('total', 0) or row.get('total_amount', 0) or 0)
-                        if has_subtotal and row.get('subtotal'):
-                            total_amount = float(row.get('subtotal', 0))
-                        elif has_delivery_fee and row.get('delivery_fee'):
-                            total_amount = total_amount - float(row.get('delivery_fee', 0))
-                        
-                        orders_dict[order_id] = {
-                            'id': order_id,
-                            'order_number': row.get('order_number', f'ORD-{order_id}'),
-                            'order_type': row.get('order_type', 'REGULAR'),
-                            'status': row.get('status', 'pending'),
-                            'total': total_amount,
-                            'payment_method': row.get('payment_method', 'cash_on_delivery'),
-                            'payment_status': row.get('payment_status', 'pending'),
-                            'created_at': row.get('created_at'),
-                            'customer_name': row.get('customer_name') or 'N/A',
-                            'customer_phone': row.get('customer_phone') or 'N/A',
-                            'pickup_code': row.get('pickup_code'),
-                            'rider_name': row.get('rider_name'),
-                            'rider_phone': row.get('rider_phone'),
-                            'order_items': []  # Changed from 'items' to 'order_items' to avoid conflict with dict.items() method
-                        }
-                    
-                    # Add item if exists
-                    if row.get('item_name'):
-                        orders_dict[order_id]['order_items'].append({
-                            'name': row['item_name'],
-                            'quantity': row.get('quantity', 1),
-                            'image': row.get('item_image')
-                        })
-                
-                orders = list(orders_dict.values())
-                
-                # Check if auto-confirm is enabled and auto-accept pending orders
-                cursor.execute("""
-                    SELECT auto_confirm_order
-                    FROM shop_order_settings
-                    WHERE shop_id = %s
-                """, (shop_id,))
-                settings = cursor.fetchone()
-                auto_confirm_enabled = settings and settings.get('auto_confirm_order', 0) == 1
-                
-                if auto_confirm_enabled:
-                    # Get all pending orders for this shop and update them to preparing
-                    if has_status:
-                        cursor.execute("""
-                            UPDATE orders 
-                            SET status = 'preparing', updated_at = NOW()
-                            WHERE shop_id = %s AND status = 'pending'
-                        """, (shop_id,))
-                    if has_status:
-                        connection.commit()
-                        # Re-fetch and re-process orders to get updated statuses
-                        # Re-check columns for the re-fetch
-                        existing_cols = get_table_columns('orders')
-                        has_rider_name = 'rider_name' in existing_cols if existing_cols else False
-                        has_rider_phone = 'rider_phone' in existing_cols if existing_cols else False
-                        
-                        if has_order_type and has_customer_id:
-                            if has_status:
-                                rider_fields = ""
-                                if has_rider_name and has_rider_phone:
-                                    rider_fields = ", o.rider_name, o.rider_phone"
-                                elif has_rider_name:
-                                    rider_fields = ", o.rider_name"
-                                elif has_rider_phone:
-                                    rider_fields = ", o.rider_phone"
-                                
-                                pickup_field = ", o.pickup_code" if has_pickup_code else ""
-                                
-                                cursor.execute(f"""
-                                    SELECT o.id, o.order_number, o.order_type, o.status, o.total_amount as total,
-                                           o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
-                                           c.name as customer_name, c.phone as customer_phone,
-                                           oi.item_name, oi.quantity, oi.item_image
-                                    FROM orders o
-                                    LEFT JOIN customers c ON o.customer_id = c.id
-                                    LEFT JOIN order_items oi ON o.id = oi.order_id
-                                    WHERE o.shop_id = %s
-                                    ORDER BY o.created_at DESC
-                                    LIMIT 100
-                                """, (shop_id,))
-                            else:
-                                rider_fields = ""
-                                if has_rider_name and has_rider_phone:
-                                    rider_fields = ", o.rider_name, o.rider_phone"
-                                elif has_rider_name:
-                                    rider_fields = ", o.rider_name"
-                                elif has_rider_phone:
-                                    rider_fields = ", o.rider_phone"
-                                
-                                pickup_field = ", o.pickup_code" if has_pickup_code else ""
-                                
-                                cursor.execute(f"""
-                                    SELECT o.id, o.order_number, o.order_type, o.total_amount as total,
-                                           o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
-                                           c.name as customer_name, c.phone as customer_phone,
-                                           oi.item_name, oi.quantity, oi.item_image
-                                    FROM orders o
-                                    LEFT JOIN customers c ON o.customer_id = c.id
-                                    LEFT JOIN order_items oi ON o.id = oi.order_id
-                                    WHERE o.shop_id = %s
-                                    ORDER BY o.created_at DESC
-                                    LIMIT 100
-                                """, (shop_id,))
-                        else:
-                            rider_fields = ""
-                            if has_rider_name and has_rider_phone:
-                                rider_fields = ", o.rider_name, o.rider_phone"
-                            elif has_rider_name:
-                                rider_fields = ", o.rider_name"
-                            elif has_rider_phone:
-                                rider_fields = ", o.rider_phone"
-                            
-                            pickup_field = ", o.pickup_code" if has_pickup_code else ""
-                            
-                            cursor.execute(f"""
-                                SELECT o.id, o.order_number, o.total,
-                                       o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
-                                       o.customer_name, o.customer_phone,
-                                       oi.item_name, oi.quantity, oi.item_image
-                                FROM orders o
-                                LEFT JOIN order_items oi ON o.id = oi.order_id
-                                WHERE o.shop_id = %s
-                                ORDER BY o.created_at DESC
-                                LIMIT 100
-                            """, (shop_id,))
-                        
-                        raw_orders = cursor.fetchall()
-                        
-                        # Re-group orders with updated statuses
-                        orders_dict = {}
-                        for row in raw_orders:
-                            order_id = row['id']
-                            if order_id not in orders_dict:
-                                total_amount = float(row.get('total', 0) or row.get('total_amount', 0) or 0)
-                                if has_subtotal and row.get('subtotal'):
-                                    total_amount = float(row.get('subtotal', 0))
-                                elif has_delivery_fee and row.get('delivery_fee'):
-                                    total_amount = total_amount - float(row.get('delivery_fee', 0))
-                                
-                                orders_dict[order_id] = {
-                                    'id': order_id,
-                                    'order_number': row.get('order_number', f'ORD-{order_id}'),
-                                    'order_type': row.get('order_type', 'REGULAR'),
-                                    'status': row.get('status', 'pending'),
-                                    'total': total_amount,
-                                    'payment_method': row.get('payment_method', 'cash_on_delivery'),
-                                    'payment_status': row.get('payment_status', 'pending'),
-                                    'created_at': row.get('created_at'),
-                                    'customer_name': row.get('customer_name') or 'N/A',
-                                    'customer_phone': row.get('customer_phone') or 'N/A',
-                                    'pickup_code': row.get('pickup_code'),
-                                    'rider_name': row.get('rider_name'),
-                                    'rider_phone': row.get('rider_phone'),
-                                    'order_items': []
-                                }
-                            
-                            if row.get('item_name'):
-                                orders_dict[order_id]['order_items'].append({
-                                    'name': row['item_name'],
-                                    'quantity': row.get('quantity', 1),
-                                    'image': row.get('item_image')
-                                })
-                        
-                        orders = list(orders_dict.values())
+                # Later edits are patched in from /api/shop/orders/changes; take the cursor
+                # before reading so nothing updated in between is missed
+                orders_cursor = current_order_changes_cursor(cursor, shop_id)
+                # First page of the order feed; older orders come from /api/shop/orders/feed
+                orders, _ = load_shop_orders_page(cursor, shop_id)
                 
         except Exception as e:
             print(f"Error fetching shop/orders: {e}")
@@ -5759,7 +8387,89 @@ def shop_dashboard():
         session.clear()
         return redirect('/')
     
-    return render_template('shop_dashboard.html', shop=shop, orders=orders, error=error)
+    return render_template('shop_dashboard.html', shop=shop, orders=orders,
+                           orders_cursor=orders_cursor, error=error)
+
+@app.route('/api/shop/orders/feed', methods=['GET'])
+def shop_orders_feed():
+    """Keyset-paginated order feed for the logged-in shop (?cursor=&limit=)."""
+    if not session.get('logged_in') or session.get('user_type') != 'shop':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    
+    shop_id = session.get('shop_id')
+    if not shop_id:
+        return jsonify({'success': False, 'message': 'Shop not found'}), 404
+    
+    try:
+        limit = min(max(int(request.args.get('limit', SHOP_ORDER_PAGE_SIZE)), 1), SHOP_ORDER_PAGE_MAX)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+    
+    after = None
+    if request.args.get('cursor'):
+        after = decode_order_cursor(request.args['cursor'])
+        if after is None:
+            return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    
+    connection = get_db_connection()
+    if not connection:
+        return jsonify({'success': False, 'message': 'Database connection error'}), 500
+    
+    try:
+        with connection.cursor() as cursor:
+            orders, next_cursor = load_shop_orders_page(cursor, shop_id, limit, after)
+        return jsonify({'success': True, 'orders': serialize_shop_orders(orders), 'next_cursor': next_cursor})
+    except Exception as e:
+        print(f"Error loading shop order feed: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': 'Error loading orders'}), 500
+    finally:
+        connection.close()
+
+@app.route('/api/shop/orders/changes', methods=['GET'])
+def shop_order_changes():
+    """Orders created or updated since ?since=<cursor>, for patching the dashboard in place.
+    
+    Without `since` it only returns a cursor for the current state.
+    """
+    if not session.get('logged_in') or session.get('user_type') != 'shop':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    
+    shop_id = session.get('shop_id')
+    if not shop_id:
+        return jsonify({'success': False, 'message': 'Shop not found'}), 404
+    
+    try:
+        limit = min(max(int(request.args.get('limit', SHOP_ORDER_PAGE_SIZE)), 1), SHOP_ORDER_PAGE_MAX)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+    
+    since = None
+    if request.args.get('since'):
+        since = decode_order_cursor(request.args['since'])
+        if since is None:
+            return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    
+    connection = get_db_connection()
+    if not connection:
+        return jsonify({'success': False, 'message': 'Database connection error'}), 500
+    
+    try:
+        with connection.cursor() as cursor:
+            if since is None:
+                return jsonify({'success': True, 'orders': [], 'has_more': False,
+                                'next_cursor': current_order_changes_cursor(cursor, shop_id)})
+            orders, next_cursor, has_more = load_shop_order_changes(cursor, shop_id, since, limit)
+        return jsonify({'success': True, 'orders': serialize_shop_orders(orders),
+                        'next_cursor': next_cursor, 'has_more': has_more})
+    except Exception as e:
+        print(f"Error loading shop order changes: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': 'Error loading orders'}), 500
+    finally:
+        connection.close()
 
 @app.route('/api/shop/order-details/<int:order_id>', methods=['GET'])
 def get_order_details(order_id):
@@ -5778,7 +8488,7 @@ def get_order_details(order_id):
     try:
         with connection.cursor() as cursor:
             # Check which columns exist
-            existing_cols = get_table_columns('orders')
+            existing_cols = get_schema_capabilities('orders').columns
             has_order_type = 'order_type' in existing_cols if existing_cols else False
             has_status = 'status' in existing_cols if existing_cols else False
             has_customer_id = 'customer_id' in existing_cols if existing_cols else False
@@ -5786,6 +8496,7 @@ def get_order_details(order_id):
             has_pickup_code = 'pickup_code' in existing_cols if existing_cols else False
             has_rider_name = 'rider_name' in existing_cols if existing_cols else False
             has_rider_phone = 'rider_phone' in existing_cols if existing_cols else False
+            has_version = 'version' in existing_cols if existing_cols else False
             
             # Build query based on available columns
             if has_order_type and has_customer_id:
@@ -5798,11 +8509,12 @@ def get_order_details(order_id):
                     rider_fields = ", o.rider_phone"
                 
                 pickup_field = ", o.pickup_code" if has_pickup_code else ""
+                version_field = ", o.version" if has_version else ""
                 
                 if has_status:
                     cursor.execute(f"""
                         SELECT o.id, o.order_number, o.order_type, o.status, o.total_amount as total,
-                               o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
+                               o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields}{version_field},
                                c.name as customer_name, c.phone as customer_phone
                         FROM orders o
                         LEFT JOIN customers c ON o.customer_id = c.id
@@ -5811,7 +8523,7 @@ def get_order_details(order_id):
                 else:
                     cursor.execute(f"""
                         SELECT o.id, o.order_number, o.order_type, o.total_amount as total,
-                               o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
+                               o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields}{version_field},
                                c.name as customer_name, c.phone as customer_phone
                         FROM orders o
                         LEFT JOIN customers c ON o.customer_id = c.id
@@ -5827,10 +8539,11 @@ def get_order_details(order_id):
                     rider_fields = ", o.rider_phone"
                 
                 pickup_field = ", o.pickup_code" if has_pickup_code else ""
+                version_field = ", o.version" if has_version else ""
                 
                 cursor.execute(f"""
                     SELECT o.id, o.order_number, o.total,
-                           o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields},
+                           o.payment_method, o.payment_status, o.created_at{pickup_field}{rider_fields}{version_field},
                            o.customer_name, o.customer_phone
                     FROM orders o
                     WHERE o.id = %s AND o.shop_id = %s
@@ -5849,7 +8562,7 @@ def get_order_details(order_id):
             items = cursor.fetchall()
             
             # Calculate total without delivery cost
-            existing_cols = get_table_columns('orders')
+            existing_cols = get_schema_capabilities('orders').columns
             has_subtotal = 'subtotal' in existing_cols if existing_cols else False
             has_delivery_fee = 'delivery_fee' in existing_cols if existing_cols else False
             
@@ -5874,6 +8587,7 @@ def get_order_details(order_id):
                 'pickup_code': order.get('pickup_code'),
                 'rider_name': order.get('rider_name'),
                 'rider_phone': order.get('rider_phone'),
+                'version': order.get('version'),
                 'order_items': []
             }
             
@@ -5881,7 +8595,7 @@ def get_order_details(order_id):
                 order_dict['order_items'].append({
                     'name': item.get('item_name', 'Item'),
                     'quantity': item.get('quantity', 1),
-                    'image': item.get('item_image')
+                    'image': image_variant_filter(item.get('item_image'), 'thumb')
                 })
             
             return jsonify({
@@ -5906,38 +8620,28 @@ def update_order_status(order_id):
     if not shop_id:
         return jsonify({'success': False, 'message': 'Shop not found'}), 404
     
+    data = request.get_json(silent=True) or {}
+    
     connection = get_db_connection()
     if not connection:
         return jsonify({'success': False, 'message': 'Database connection error'}), 500
     
     try:
         with connection.cursor() as cursor:
-            # Check if order belongs to shop
-            cursor.execute("SELECT id, status FROM orders WHERE id = %s AND shop_id = %s", (order_id, shop_id))
-            order = cursor.fetchone()
-            if not order:
-                return jsonify({'success': False, 'message': 'Order not found'}), 404
-            
-            # Check which status column exists
-            existing_cols = get_table_columns('orders')
-            has_status = 'status' in existing_cols if existing_cols else False
-            
-            # Update status to preparing
-            if has_status:
-                cursor.execute("""
-                    UPDATE orders 
-                    SET status = 'preparing', updated_at = NOW()
-                    WHERE id = %s AND shop_id = %s
-                """, (order_id, shop_id))
-            else:
+            if not get_schema_capabilities('orders').has_status:
                 return jsonify({'success': False, 'message': 'Status column not found'}), 500
             
+            status, current_status = transition_order(cursor, order_id, 'accept', shop_id=shop_id,
+                                                      version=data.get('version'))
+            if not status:
+                return order_transition_error(current_status, 'accepted')
+            
             connection.commit()
             
             return jsonify({
                 'success': True,
                 'message': 'Order status updated to preparing',
-                'status': 'preparing'
+                'status': status
             })
     except Exception as e:
         connection.rollback()
@@ -5972,39 +8676,21 @@ def reject_order(order_id):
     
     try:
         with connection.cursor() as cursor:
-            # Check if order belongs to shop
-            cursor.execute("SELECT id, status FROM orders WHERE id = %s AND shop_id = %s", (order_id, shop_id))
-            order = cursor.fetchone()
-            if not order:
-                return jsonify({'success': False, 'message': 'Order not found'}), 404
-            
-            # Check which status column exists
-            existing_cols = get_table_columns('orders')
-            has_status = 'status' in existing_cols if existing_cols else False
-            has_cancellation_reason = 'cancellation_reason' in existing_cols if existing_cols else False
-            
-            # Update status to cancelled
-            if has_status and has_cancellation_reason:
-                cursor.execute("""
-                    UPDATE orders 
-                    SET status = 'cancelled', cancellation_reason = %s, updated_at = NOW()
-                    WHERE id = %s AND shop_id = %s
-                """, (cancellation_reason, order_id, shop_id))
-            elif has_status:
-                cursor.execute("""
-                    UPDATE orders 
-                    SET status = 'cancelled', updated_at = NOW()
-                    WHERE id = %s AND shop_id = %s
-                """, (order_id, shop_id))
-            else:
+            if not get_schema_capabilities('orders').has_status:
                 return jsonify({'success': False, 'message': 'Status column not found'}), 500
             
+            status, current_status = transition_order(cursor, order_id, 'reject', shop_id=shop_id,
+                                                      version=data.get('version'),
+                                                      fields={'cancellation_reason': cancellation_reason})
+            if not status:
+                return order_transition_error(current_status, 'rejected')
+            
             connection.commit()
             
             return jsonify({
                 'success': True,
                 'message': 'Order has been rejected and cancelled',
-                'status': 'cancelled'
+                'status': status
             })
     except Exception as e:
         connection.rollback()
@@ -6027,49 +8713,35 @@ def pack_order(order_id):
     
     import random
     
+    data = request.get_json(silent=True) or {}
+    
     connection = get_db_connection()
     if not connection:
         return jsonify({'success': False, 'message': 'Database connection error'}), 500
     
     try:
         with connection.cursor() as cursor:
-            # Check if order belongs to shop
-            cursor.execute("SELECT id, status FROM orders WHERE id = %s AND shop_id = %s", (order_id, shop_id))
-            order = cursor.fetchone()
-            if not order:
-                return jsonify({'success': False, 'message': 'Order not found'}), 404
-            
-            # Check which status column exists
-            existing_cols = get_table_columns('orders')
-            has_status = 'status' in existing_cols if existing_cols else False
-            has_pickup_code = 'pickup_code' in existing_cols if existing_cols else False
+            orders_schema = get_schema_capabilities('orders')
+            if not orders_schema.has_status:
+                return jsonify({'success': False, 'message': 'Status column not found'}), 500
             
             # Generate random 4-digit code
             pickup_code = f"{random.randint(1000, 9999)}"
             
             # Update status to ready and set pickup code
-            if has_status and has_pickup_code:
-                cursor.execute("""
-                    UPDATE orders 
-                    SET status = 'ready', pickup_code = %s, updated_at = NOW()
-                    WHERE id = %s AND shop_id = %s
-                """, (pickup_code, order_id, shop_id))
-            elif has_status:
-                cursor.execute("""
-                    UPDATE orders 
-                    SET status = 'ready', updated_at = NOW()
-                    WHERE id = %s AND shop_id = %s
-                """, (order_id, shop_id))
-            else:
-                return jsonify({'success': False, 'message': 'Status column not found'}), 500
+            status, current_status = transition_order(cursor, order_id, 'pack', shop_id=shop_id,
+                                                      version=data.get('version'),
+                                                      fields={'pickup_code': pickup_code})
+            if not status:
+                return order_transition_error(current_status, 'packed')
             
             connection.commit()
             
             return jsonify({
                 'success': True,
                 'message': 'Order packed successfully',
-                'status': 'ready',
-                'pickup_code': pickup_code if has_pickup_code else None
+                'status': status,
+                'pickup_code': pickup_code if orders_schema.has_pickup_code else None
             })
     except Exception as e:
         connection.rollback()
@@ -6104,39 +8776,21 @@ def cancel_order(order_id):
     
     try:
         with connection.cursor() as cursor:
-            # Check if order belongs to shop
-            cursor.execute("SELECT id, status FROM orders WHERE id = %s AND shop_id = %s", (order_id, shop_id))
-            order = cursor.fetchone()
-            if not order:
-                return jsonify({'success': False, 'message': 'Order not found'}), 404
-            
-            # Check which status column exists
-            existing_cols = get_table_columns('orders')
-            has_status = 'status' in existing_cols if existing_cols else False
-            has_cancellation_reason = 'cancellation_reason' in existing_cols if existing_cols else False
-            
-            # Update status to cancelled
-            if has_status and has_cancellation_reason:
-                cursor.execute("""
-                    UPDATE orders 
-                    SET status = 'cancelled', cancellation_reason = %s, updated_at = NOW()
-                    WHERE id = %s AND shop_id = %s
-                """, (cancellation_reason, order_id, shop_id))
-            elif has_status:
-                cursor.execute("""
-                    UPDATE orders 
-                    SET status = 'cancelled', updated_at = NOW()
-                    WHERE id = %s AND shop_id = %s
-                """, (order_id, shop_id))
-            else:
+            if not get_schema_capabilities('orders').has_status:
                 return jsonify({'success': False, 'message': 'Status column not found'}), 500
             
+            status, current_status = transition_order(cursor, order_id, 'cancel', shop_id=shop_id,
+                                                      version=data.get('version'),
+                                                      fields={'cancellation_reason': cancellation_reason})
+            if not status:
+                return order_transition_error(current_status, 'cancelled')
+            
             connection.commit()
             
             return jsonify({
                 'success': True,
                 'message': 'Order has been cancelled',
-                'status': 'cancelled'
+                'status': status
             })
     except Exception as e:
         connection.rollback()
@@ -6380,66 +9034,132 @@ def settings():
 @app.route('/shop/<int:shop_id>')
 def view_public_shop(shop_id):
     """Public shop viewing page."""
-    connection = get_db_connection()
     shop = None
     items_by_category = {}
+    validator = last_modified = None
     error = None
     
-    if connection:
-        try:
-            with connection.cursor() as cursor:
-                # Fetch shop details including delivery_mode
-                cursor.execute("""
-                    SELECT id, name, category, email, phone, profile_image, 
-                           location_name, longitude, latitude, 
-                           status, rating, delivery_mode, created_at
-                    FROM shops
-                    WHERE id = %s AND (status = 'open' OR status = 'closed' OR status = 'waiting_approval')
-                """, (shop_id,))
-                shop = cursor.fetchone()
-                
-                if not shop:
-                    error = 'Shop not found or not available'
-                else:
-                    # Only fetch items if delivery_mode is 0 (items with delivery)
-                    delivery_mode = shop.get('delivery_mode', 0)
-                    if delivery_mode == 0:
-                        # Fetch shop items grouped by category
+    page = page_cache.get(shop_page_key(shop_id))
+    if page is not None:
+        shop, items_by_category = page['shop'], page['items_by_category']
+        validator, last_modified = page['validator'], page['last_modified']
+    else:
+        connection = get_db_connection()
+        if connection:
+            try:
+                with connection.cursor() as cursor:
+                    # Fetch shop details including delivery_mode
+                    cursor.execute("""
+                        SELECT id, name, category, email, phone, profile_image, 
+                               location_name, longitude, latitude, 
+                               status, rating, delivery_mode, created_at, updated_at
+                        FROM shops
+                        WHERE id = %s AND (status = 'open' OR status = 'closed' OR status = 'waiting_approval')
+                    """, (shop_id,))
+                    shop = cursor.fetchone()
+                    
+                    if not shop:
+                        error = 'Shop not found or not available'
+                    else:
+                        # Only fetch items if delivery_mode is 0 (items with delivery)
+                        delivery_mode = shop.get('delivery_mode', 0)
+                        if delivery_mode == 0:
+                            # Fetch shop items grouped by category
+                            cursor.execute("""
+                                SELECT id, category, item_name, description, price, discount_price, 
+                                       item_image, status
+                                FROM shop_items
+                                WHERE shop_id = %s AND status = 'active'
+                                ORDER BY category, item_name
+                            """, (shop_id,))
+                            items = cursor.fetchall()
+                            
+                            # Group items by category
+                            for item in items:
+                                category = item.get('category') or 'UNCATEGORIZED'
+                                if category not in items_by_category:
+                                    items_by_category[category] = []
+                                items_by_category[category].append(item)
+                            
+                        # Inactive items count too: hiding one changes the page
                         cursor.execute("""
-                            SELECT id, category, item_name, description, price, discount_price, 
-                                   item_image, status
+                            SELECT MAX(updated_at) AS items_updated_at, COUNT(*) AS item_count, NOW() AS db_now
                             FROM shop_items
-                            WHERE shop_id = %s AND status = 'active'
-                            ORDER BY category, item_name
+                            WHERE shop_id = %s
                         """, (shop_id,))
-                        items = cursor.fetchall()
-                        
-                        # Group items by category
-                        for item in items:
-                            category = item.get('category') or 'UNCATEGORIZED'
-                            if category not in items_by_category:
-                                items_by_category[category] = []
-                            items_by_category[category].append(item)
-        except Exception as e:
-            print(f"Error fetching shop: {e}")
-            import traceback
-            traceback.print_exc()
-            error = 'Error loading shop details'
-        finally:
-            connection.close()
-    else:
-        error = 'Database connection error'
+                        stats = cursor.fetchone()
+                        validator, last_modified = page_validators(
+                            [shop.get('updated_at'), stats['items_updated_at']], stats['item_count'], stats['db_now'])
+                        if validator:
+                            page_cache.set(shop_page_key(shop_id), {
+                                'shop': shop,
+                                'items_by_category': items_by_category,
+                                'validator': validator,
+                                'last_modified': last_modified
+                            })
+            except Exception as e:
+                print(f"Error fetching shop: {e}")
+                import traceback
+                traceback.print_exc()
+                error = 'Error loading shop details'
+            finally:
+                connection.close()
+        else:
+            error = 'Database connection error'
     
     if error:
         return render_template('shop_view.html', error=error, shop=None)
     
-    return render_template('shop_view.html', shop=shop, items_by_category=items_by_category, error=None)
+    shop_full_today = is_shop_full_today(shop_id)
+    
+    # With ?lat=&lng= the ETA includes the ride from the shop to the customer
+    shop_eta = None
+    book = get_shop_schedule_book()
+    if book:
+        location = parse_location_args(request.args)
+        distance_km = None
+        if location and shop.get('latitude') is not None and shop.get('longitude') is not None:
+            distance_km = float(haversine_km(location['lat'], location['lng'],
+                                             float(shop['latitude']), float(shop['longitude'])))
+        shop_eta = book.eta(shop['id'], distance_km)
+    
+    etag = None
+    if validator:
+        etag = page_etag('shop', shop_id, validator, shop_full_today, shop_eta, request.query_string,
+                         template_version('shop_view.html', 'base.html'))
+    return conditional_page(etag, last_modified, lambda: render_template(
+        'shop_view.html', shop=shop, items_by_category=items_by_category,
+        shop_full_today=shop_full_today, shop_eta=shop_eta, error=None))
 
 @app.route('/')
 def index():
-    """Home page."""
+    """Home page. With ?lat=&lng= it lists the nearest open shops per category."""
+    location = parse_location_args(request.args)
+    if location:
+        spatial_index = get_shop_spatial_index()
+        if spatial_index:
+            shops_by_category = add_shop_etas(spatial_index.nearest(**location))
+            # Small result set: the ETag is a hash of the listing itself
+            etag = page_etag('index', request.query_string, shops_by_category, template_version('index.html', 'base.html'))
+            return conditional_page(etag, None, lambda: render_template('index.html', shops_by_category=shops_by_category))
+    
+    page = page_cache.get(INDEX_PAGE_KEY)
+    if page is None:
+        page = load_index_page()
+    shops_by_category = add_shop_etas(page['shops_by_category'])
+    
+    etag = None
+    if page['validator']:
+        etas = [(shop['id'], shop.get('eta')) for shops in shops_by_category.values() for shop in shops]
+        etag = page_etag('index', page['validator'], etas, template_version('index.html', 'base.html'))
+    return conditional_page(etag, page['last_modified'],
+                            lambda: render_template('index.html', shops_by_category=shops_by_category))
+
+def load_index_page():
+    """Read the shops listed on the home page, grouped by category, and cache them."""
+    page = {'shops_by_category': {}, 'validator': None, 'last_modified': None}
+    shops_by_category = page['shops_by_category']
     connection = get_db_connection()
-    shops_by_category = {}
     if connection:
         try:
             with connection.cursor() as cursor:
@@ -6464,17 +9184,116 @@ def index():
                     if category not in shops_by_category:
                         shops_by_category[category] = []
                     shops_by_category[category].append(shop)
+                
+                cursor.execute("""
+                    SELECT MAX(updated_at) AS shops_updated_at, COUNT(*) AS shop_count, NOW() AS db_now
+                    FROM shops
+                    WHERE status = 'open' OR status = 'closed' OR status = 'waiting_approval'
+                """)
+                stats = cursor.fetchone()
+                page['validator'], page['last_modified'] = page_validators(
+                    [stats['shops_updated_at']], stats['shop_count'], stats['db_now'])
+                if page['validator']:
+                    page_cache.set(INDEX_PAGE_KEY, page)
         except Exception as e:
             print(f"Error fetching shops: {e}")
         finally:
             connection.close()
-    return render_template('index.html', shops_by_category=shops_by_category)
+    return page
+
+@app.route('/api/shops/nearby', methods=['GET'])
+def get_nearby_shops():
+    """Nearest open shops per category for ?lat=&lng=[&radius_km=&limit=&category=]."""
+    location = parse_location_args(request.args)
+    if not location:
+        return jsonify({'success': False, 'message': 'Valid lat and lng are required'}), 400
+    
+    spatial_index = get_shop_spatial_index()
+    if not spatial_index:
+        return jsonify({'success': False, 'message': 'Database connection error'}), 500
+    
+    response = jsonify({
+        'success': True,
+        'radius_km': location['radius_km'],
+        'shops_by_category': add_shop_etas(spatial_index.nearest(**location))
+    })
+    # Strong ETag over the body; an unchanged listing costs a 304 instead of the JSON
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+ORDER_MAX_LINES = int(os.getenv('ORDER_MAX_LINES', '200'))
+
+def price_order_items(cursor, shop_id, items):
+    """Check cart lines against shop_items with one IN (...) query and price them from
+    the catalogue rather than the client. Returns (lines, error_message)."""
+    if not items:
+        return None, 'Order has no items'
+    if len(items) > ORDER_MAX_LINES:
+        return None, f'Orders are limited to {ORDER_MAX_LINES} items'
+    
+    quantities = {}  # item_id -> quantity, in cart order; repeated lines are merged
+    for item in items:
+        try:
+            item_id = int(item.get('item_id'))
+            quantity = int(item.get('quantity', 1))
+        except (TypeError, ValueError):
+            return None, 'Invalid item in order'
+        if quantity < 1:
+            return None, 'Item quantities must be at least 1'
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+    
+    placeholders = ', '.join(['%s'] * len(quantities))
+    cursor.execute(f"""
+        SELECT id, item_name, item_image, price, discount_price, status
+        FROM shop_items
+        WHERE shop_id = %s AND id IN ({placeholders})
+    """, [shop_id, *quantities])
+    catalogue = {row['id']: row for row in cursor.fetchall()}
+    
+    lines = []
+    for item_id, quantity in quantities.items():
+        row = catalogue.get(item_id)
+        if not row:
+            return None, 'Some items in your cart are no longer sold by this shop'
+        if row.get('status', 'active') != 'active':
+            return None, f"{row['item_name']} is not available right now"
+        unit_price = float(row['price'])
+        # Same rule as the shop page: a set discount_price is what the customer pays
+        discount_price = float(row['discount_price']) if row.get('discount_price') else None
+        lines.append({
+            'item_id': item_id,
+            'item_name': row['item_name'],
+            'item_image': row['item_image'],
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'discount_price': discount_price,
+            'subtotal': round((discount_price if discount_price is not None else unit_price) * quantity, 2)
+        })
+    return lines, None
+
+def parse_checkout_charges(data):
+    """Read delivery_fee, tax and discount from checkout. Returns (charges, error_message)."""
+    charges = {}
+    for field in ('delivery_fee', 'tax', 'discount'):
+        try:
+            value = float(data.get(field) or 0)
+        except (TypeError, ValueError):
+            return None, f'Invalid {field.replace("_", " ")}'
+        if not math.isfinite(value) or value < 0:
+            return None, f'Invalid {field.replace("_", " ")}'
+        charges[field] = round(value, 2)
+    return charges, None
 
 # Cart and Checkout Routes
 @app.route('/api/orders/create', methods=['POST'])
 def create_order():
     """Create a new order."""
     data = request.get_json()
+    charges, error = parse_checkout_charges(data)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+    
     connection = get_db_connection()
     
     if not connection:
@@ -6482,59 +9301,31 @@ def create_order():
     
     try:
         with connection.cursor() as cursor:
-            # Generate unique order number
-            import random
-            import string
-            order_number = 'ORD' + ''.join(random.choices(string.digits, k=10))
-            
-            # Check if order number exists (unlikely but check anyway)
-            cursor.execute("SELECT id FROM orders WHERE order_number = %s", (order_number,))
-            while cursor.fetchone():
-                order_number = 'ORD' + ''.join(random.choices(string.digits, k=10))
-                cursor.execute("SELECT id FROM orders WHERE order_number = %s", (order_number,))
-            
-            # Create order
-            cursor.execute("""
-                INSERT INTO orders (order_number, shop_id, customer_name, customer_phone, customer_email,
-                                  subtotal, delivery_fee, tax, discount, total, payment_method,
-                                  promo_code, notes, contactless_delivery)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                order_number,
-                data.get('shop_id'),
-                data.get('customer_name'),
-                data.get('customer_phone'),
-                data.get('customer_email'),
-                data.get('subtotal', 0),
-                data.get('delivery_fee', 0),
-                data.get('tax', 0),
-                data.get('discount', 0),
-                data.get('total', 0),
-                data.get('payment_method', 'cash_on_delivery'),
-                data.get('promo_code'),
-                data.get('notes'),
-                data.get('contactless_delivery', 0)
-            ))
-            
-            order_id = cursor.lastrowid
-            
-            # Add order items
-            items = data.get('items', [])
-            for item in items:
-                cursor.execute("""
-                    INSERT INTO order_items (order_id, item_id, item_name, item_image, quantity,
-                                           unit_price, discount_price, subtotal)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    order_id,
-                    item.get('item_id'),
-                    item.get('item_name'),
-                    item.get('item_image'),
-                    item.get('quantity', 1),
-                    item.get('unit_price', 0),
-                    item.get('discount_price'),
-                    item.get('subtotal', 0)
-                ))
+            lines, error = price_order_items(cursor, data.get('shop_id'), data.get('items', []))
+            if error:
+                return jsonify({'success': False, 'message': error}), 400
+            
+            # Totals follow the catalogue prices; fees, tax and discount come from checkout,
+            # and the discount can never take the items below zero
+            subtotal = round(sum(line['subtotal'] for line in lines), 2)
+            charges['discount'] = min(charges['discount'], subtotal)
+            total = round(subtotal + charges['delivery_fee'] + charges['tax'] - charges['discount'], 2)
+            
+            order_id, order_number = write_order(cursor, {
+                'shop_id': data.get('shop_id'),
+                'customer_name': data.get('customer_name'),
+                'customer_phone': data.get('customer_phone'),
+                'customer_email': data.get('customer_email'),
+                'subtotal': subtotal,
+                'delivery_fee': charges['delivery_fee'],
+                'tax': charges['tax'],
+                'discount': charges['discount'],
+                'total': total,
+                'payment_method': data.get('payment_method', 'cash_on_delivery'),
+                'promo_code': data.get('promo_code'),
+                'notes': data.get('notes'),
+                'contactless_delivery': data.get('contactless_delivery', 0)
+            }, lines)
             
             # Add delivery information
             if data.get('delivery_address'):
@@ -6553,12 +9344,20 @@ def create_order():
                     data.get('estimated_time_minutes')
                 ))
             
+            error = reserve_daily_order_slot(cursor, data.get('shop_id'))
+            if error:
+                connection.rollback()
+                return jsonify({'success': False, 'message': error}), 409
+            
+            auto_confirm_orders(cursor, order_id=order_id)
             connection.commit()
+            publish_order_created(cursor, order_id)
             
             return jsonify({
                 'success': True,
                 'order_id': order_id,
                 'order_number': order_number,
+                'total': total,
                 'message': 'Order created successfully'
             })
     except Exception as e:
@@ -6616,9 +9415,16 @@ def order_receipt(order_number):
 
 @app.route('/api/distance/calculate', methods=['POST'])
 def calculate_distance():
-    """Calculate distance and time using Google Distance Matrix API."""
+    """Calculate distance and time using Google Distance Matrix API.
+    
+    Matrix mode: pass origins and destinations (lists of {lat, lng} or [lat, lng])
+    instead of a single pair to get every origin x destination distance and ETA.
+    """
     data = request.get_json()
     
+    if 'origins' in data or 'destinations' in data:
+        return calculate_distance_matrix(data)
+    
     origin_lat = data.get('origin_lat')
     origin_lng = data.get('origin_lng')
     dest_lat = data.get('dest_lat')
@@ -6628,21 +9434,10 @@ def calculate_distance():
         return jsonify({'success': False, 'message': 'Missing coordinates'}), 400
     
     # Calculate approximate distance using Haversine formula
-    import math
-    
-    def haversine_distance(lat1, lon1, lat2, lon2):
-        R = 6371  # Earth radius in km
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a))
-        return R * c
-    
-    distance_km = round(haversine_distance(float(origin_lat), float(origin_lng), float(dest_lat), float(dest_lng)), 2)
+    distance_km = round(float(haversine_km(float(origin_lat), float(origin_lng), float(dest_lat), float(dest_lng))), 2)
     
     # Estimate time (rough calculation: 30 km/h average speed)
-    estimated_minutes = int((distance_km / 30) * 60)
-    estimated_minutes = max(10, min(estimated_minutes, 60))  # Between 10-60 minutes
+    estimated_minutes = int(estimate_travel_minutes(distance_km))
     
     return jsonify({
         'success': True,
@@ -6651,9 +9446,54 @@ def calculate_distance():
         'estimated_time_range': f"{estimated_minutes - 2}-{estimated_minutes + 2}"
     })
 
+def parse_coordinate_list(points):
+    """Turn [{lat, lng}, ...] or [[lat, lng], ...] into an (N, 2) float array, or None."""
+    if not isinstance(points, list) or not points:
+        return None
+    try:
+        rows = []
+        for point in points:
+            if isinstance(point, dict):
+                rows.append((float(point['lat']), float(point['lng'])))
+            else:
+                rows.append((float(point[0]), float(point[1])))
+        return np.array(rows, dtype=float)
+    except (KeyError, IndexError, ValueError, TypeError):
+        return None
+
+def calculate_distance_matrix(data):
+    """Matrix mode of /api/distance/calculate: all pairwise distances in one call."""
+    origins = parse_coordinate_list(data.get('origins'))
+    destinations = parse_coordinate_list(data.get('destinations'))
+    if origins is None or destinations is None:
+        return jsonify({'success': False, 'message': 'origins and destinations must be non-empty lists of coordinates'}), 400
+    
+    if len(origins) * len(destinations) > DISTANCE_MATRIX_MAX_CELLS:
+        return jsonify({'success': False, 'message': f'At most {DISTANCE_MATRIX_MAX_CELLS} origin/destination pairs per request'}), 400
+    
+    # Broadcast (N, 1) origins against (1, M) destinations
+    distances = np.round(haversine_km(
+        origins[:, 0:1], origins[:, 1:2],
+        destinations[:, 0][np.newaxis, :], destinations[:, 1][np.newaxis, :]
+    ), 2)
+    minutes = estimate_travel_minutes(distances)
+    
+    return jsonify({
+        'success': True,
+        'origins_count': len(origins),
+        'destinations_count': len(destinations),
+        'distances_km': distances.tolist(),
+        'estimated_time_minutes': minutes.tolist()
+    })
+
 # Initialize database and run app
 if __name__ == '__main__':
     # Initialize database first
-    init_db()
+    if init_db() and DB_POOL_CONFIG['enabled']:
+        # Pre-open the minimum number of pooled connections
+        try:
+            get_db_pool().warm_up()
+        except Exception as e:
+            print(f"Error warming up connection pool: {e}")
     # Then run the Flask app
     app.run(debug=True, host='0.0.0.0', port=5000)